@@ -0,0 +1,70 @@
+"""
+Append latency of the durable task journal.
+
+Appends tasks shaped like those of ``demo/echo-server.py`` to a TaskJournal
+under every fsync policy, and reports the latency percentiles of an append,
+then the time taken to replay the journal.
+
+Usage::
+
+    python benchmarks/bench_journal.py --tasks 100000 --policy group --policy os
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cmit.journal import FSYNC_POLICIES, TaskJournal  # noqa: E402
+
+
+def bench(policy, tasks, segment_size, complete_ratio):
+    directory = tempfile.mkdtemp(prefix="cmit-journal-")
+    journal = TaskJournal(directory, segment_size, policy)
+    task = {"route": "a.b.c", "task_id": None, "args": [], "kwargs": {}, "data": None, "priority": None}
+
+    latencies = []
+    try:
+        for i in range(tasks):
+            msg_id = "%032x" % i
+            task["task_id"] = msg_id
+            start = time.perf_counter()
+            journal.append(msg_id, task)
+            latencies.append(time.perf_counter() - start)
+            if i % 100 < complete_ratio * 100:
+                journal.complete(msg_id)
+        segments = journal.stats()["segments"]
+        journal.close()
+
+        start = time.perf_counter()
+        replayed = TaskJournal(directory, segment_size, "os")
+        replay = time.perf_counter() - start
+        pending = len(replayed)
+        replayed.close()
+    finally:
+        shutil.rmtree(directory)
+
+    latencies.sort()
+    p50, p99 = (latencies[int(len(latencies) * q)] * 1e6 for q in (0.5, 0.99))
+    print(f"{policy:>6}: append p50={p50:.1f}us p99={p99:.1f}us segments={segments} "
+          f"replay={replay * 1e3:.1f}ms pending={pending}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=100000, help="tasks appended")
+    parser.add_argument("--policy", action="append", choices=FSYNC_POLICIES, help="fsync policies, all by default")
+    parser.add_argument("--segment-size", type=int, default=8 << 20, help="bytes of a segment file")
+    parser.add_argument("--complete", type=float, default=0.9, help="share of the tasks completed")
+    args = parser.parse_args(argv)
+
+    for policy in args.policy or FSYNC_POLICIES:
+        tasks = args.tasks if policy != "always" else min(args.tasks, 2000)
+        bench(policy, tasks, args.segment_size, args.complete)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Zero-downtime restart check for RestartableCMITServer.
+
+Starts a first generation of the server in a subprocess, drives it with client
+threads sending requests continuously (on new and on persistent connections),
+then starts further generations, each taking over the listening socket from the
+previous one, and reports the requests that failed during the restarts.
+
+Usage::
+
+    python benchmarks/bench_restart.py --generations 3 --clients 8
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cmit import CMITStatus, server  # noqa: E402
+from cmit.client import CMITConnection  # noqa: E402
+from cmit.utils import cmit_response  # noqa: E402
+
+
+class RestartHandler(server.SimpleCMITRequestHandler):
+    protocol_version = "CMIT/1.1"
+
+    # Seconds spent in every EXECUTE request
+    delay = 0.05
+
+    @cmit_response
+    def do_EXECUTE(self):
+        time.sleep(self.delay)
+        return CMITStatus.ACCEPTED, self.msg
+
+
+def serve(path, delay):
+    RestartHandler.delay = delay
+    engine = server.RestartableCMITServer(path, RestartHandler)
+    print(f"generation {os.getpid()} serving", flush=True)
+    engine.serve_forever()
+    engine.server_close()
+    print(f"generation {os.getpid()} drained", flush=True)
+
+
+def _client(path, keep_alive, stop, counts, errors):
+    conn = CMITConnection(path)
+    i = 0
+    while not stop.is_set():
+        i += 1
+        try:
+            conn.request("EXECUTE" if i % 2 else "PING", f"restart.{i}", "payload")
+            resp = conn.getresponse()
+            resp.close()
+            if resp.status >= 300:
+                errors.append(resp.status)
+            else:
+                counts.append(1)
+        except OSError as e:
+            errors.append(repr(e))
+            conn.close()
+        finally:
+            if not keep_alive:
+                conn.close()
+    conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--generations", type=int, default=3, help="server generations started one after the other")
+    parser.add_argument("--clients", type=int, default=8, help="client threads, half of them on persistent connections")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between two generations")
+    parser.add_argument("--delay", type=float, default=0.05, help="seconds spent in every EXECUTE request")
+    parser.add_argument("--serve", metavar="PATH", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.serve, args.delay)
+        return
+
+    path = os.path.join(tempfile.mkdtemp(prefix="cmit-restart-"), "restart.sock")
+    command = [sys.executable, os.path.abspath(__file__), "--serve", path, "--delay", str(args.delay)]
+
+    generations = [subprocess.Popen(command)]
+    while not os.path.exists(path):
+        time.sleep(0.01)
+
+    stop = threading.Event()
+    counts, errors = [], []
+    clients = [
+        threading.Thread(target=_client, args=(path, i % 2 == 0, stop, counts, errors))
+        for i in range(args.clients)
+    ]
+    for c in clients:
+        c.start()
+
+    for _ in range(args.generations - 1):
+        time.sleep(args.interval)
+        generations.append(subprocess.Popen(command))
+        # the previous generation exits once it's drained
+        generations[-2].wait()
+
+    time.sleep(args.interval)
+    stop.set()
+    for c in clients:
+        c.join()
+
+    generations[-1].terminate()
+    generations[-1].wait()
+
+    print(f"generations={args.generations} requests={len(counts)} errors={len(errors)}")
+    for error in sorted(set(map(str, errors))):
+        print(f"  {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Throughput/latency benchmark for the CMIT server engines.
+
+Starts the selected server engine, optionally opens a number of idle connections
+against it (to mimic mostly idle webserver workers), then drives it with concurrent
+client threads spread over one or more client processes and reports requests/second
+and latency percentiles.
+
+Usage::
+
+    python benchmarks/bench_servers.py --engine threading --engine async --idle 500
+    python benchmarks/bench_servers.py --engine prefork --command EXECUTE --work 20000 --processes 4
+    python benchmarks/bench_servers.py --engine pooled --command EXECUTE --multiplex --clients 32
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cmit import CMITStatus, aio, reactor, server  # noqa: E402
+from cmit.client import CMITConnection, MultiplexedCMITConnection  # noqa: E402
+from cmit.utils import cmit_response  # noqa: E402
+
+
+def _burn(iterations):
+    total = 0
+    for i in range(iterations):
+        total += i * i
+    return total
+
+
+class BenchHandler(server.SimpleCMITRequestHandler):
+    # CPU bound iterations spent in every EXECUTE request
+    work = 0
+
+    @cmit_response
+    def do_EXECUTE(self):
+        _burn(self.work)
+        return CMITStatus.ACCEPTED, self.msg
+
+
+class AsyncBenchHandler(aio.SimpleAsyncCMITRequestHandler):
+    work = 0
+
+    do_EXECUTE = BenchHandler.do_EXECUTE
+
+
+class _ThreadedRunner:
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.thread = threading.Thread(target=engine.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.engine.shutdown()
+        self.engine.server_close()
+
+
+class _ProcessRunner:
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.pid = None
+
+    def start(self):
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                self.engine.serve_forever()
+            finally:
+                os._exit(0)
+        self.engine.socket.close()
+
+    def stop(self):
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+
+
+def _threading_engine(path, workers):
+    return _ThreadedRunner(server.ThreadingCMITServer(path, BenchHandler))
+
+
+def _pooled_engine(path, workers):
+    return _ThreadedRunner(server.PooledCMITServer(path, BenchHandler))
+
+
+def _async_engine(path, workers):
+    return _ThreadedRunner(aio.AsyncCMITServer(path, AsyncBenchHandler))
+
+
+def _reactor_engine(path, workers):
+    return _ThreadedRunner(reactor.ReactorCMITServer(path, BenchHandler))
+
+
+def _prefork_engine(path, workers):
+    engine = server.PreforkCMITServer(path, BenchHandler)
+    engine.workers = workers
+    return _ProcessRunner(engine)
+
+
+ENGINES = {
+    "threading": _threading_engine,
+    "pooled": _pooled_engine,
+    "async": _async_engine,
+    "reactor": _reactor_engine,
+    "prefork": _prefork_engine,
+}
+
+
+def _pipelined_client(path, command, requests, pipeline, latencies, errors):
+    conn = CMITConnection(path)
+    for i in range(0, requests, pipeline):
+        batch = [(command, f"bench.{j}", "payload") for j in range(i, min(i + pipeline, requests))]
+        start = time.perf_counter()
+        try:
+            responses = conn.pipeline(batch, depth=pipeline)
+            errors.extend(r.status for r in responses if r.status >= 300)
+        except OSError as e:
+            errors.append(e)
+            conn.close()
+        # latency of a request is the time to complete its whole batch
+        latencies.extend([time.perf_counter() - start] * len(batch))
+    conn.close()
+
+
+def _multiplexed_client(conn, command, requests, latencies, errors):
+    for i in range(requests):
+        start = time.perf_counter()
+        try:
+            resp = conn.call(command, f"bench.{i}", "payload")
+            if resp.status >= 300:
+                errors.append(resp.status)
+        except OSError as e:
+            errors.append(e)
+        latencies.append(time.perf_counter() - start)
+
+
+def _client(path, command, requests, keep_alive, latencies, errors):
+    conn = CMITConnection(path)
+    for i in range(requests):
+        start = time.perf_counter()
+        try:
+            conn.request(command, f"bench.{i}", "payload")
+            resp = conn.getresponse()
+            resp.close()
+            if resp.status >= 300:
+                errors.append(resp.status)
+        except OSError as e:
+            errors.append(e)
+            conn.close()
+        finally:
+            if not keep_alive:
+                conn.close()
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def _client_process(path, command, clients, requests, keep_alive, pipeline, multiplex):
+    latencies, errors = [], []
+    mux_conn = None
+    if multiplex:
+        # every client thread of the process shares a single connection
+        mux_conn = MultiplexedCMITConnection(path)
+        target, args = _multiplexed_client, (mux_conn, command, requests, latencies, errors)
+    elif pipeline > 1:
+        target, args = _pipelined_client, (path, command, requests, pipeline, latencies, errors)
+    else:
+        target, args = _client, (path, command, requests, keep_alive, latencies, errors)
+    workers = [threading.Thread(target=target, args=args) for _ in range(clients)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    if mux_conn is not None:
+        mux_conn.close()
+    return latencies, len(errors)
+
+
+def run(engine_name, command, clients, requests, idle, processes, workers, keep_alive, pipeline, multiplex):
+    path = os.path.join(tempfile.mkdtemp(prefix="cmit-bench-"), "bench.sock")
+    runner = ENGINES[engine_name](path, workers)
+    runner.engine.request_queue_size = max(128, clients * processes + idle)
+    runner.engine.socket.listen(runner.engine.request_queue_size)
+    runner.start()
+
+    idle_socks = []
+    for _ in range(idle):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(path)
+        idle_socks.append(s)
+
+    # give the server a moment to pick up the idle connections
+    time.sleep(0.2)
+    server_threads = threading.active_count()
+
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(processes) as pool:
+        start = time.perf_counter()
+        results = pool.starmap(_client_process, [(path, command, clients, requests, keep_alive, pipeline, multiplex)] * processes)
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for result, _ in results for latency in result)
+    errors = sum(e for _, e in results)
+
+    for s in idle_socks:
+        s.close()
+    runner.stop()
+    os.unlink(path)
+
+    total = len(latencies)
+    print(
+        f"{engine_name:>10} {command:<8} clients={clients * processes:<4} idle={idle:<5} keep-alive={keep_alive:d} pipeline={pipeline:<3} mux={multiplex:d} "
+        f"threads={server_threads:<5} req/s={total / elapsed:9.1f} "
+        f"p50={statistics.median(latencies) * 1e3:7.3f}ms "
+        f"p99={latencies[int(total * 0.99) - 1] * 1e3:7.3f}ms "
+        f"errors={errors}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", action="append", choices=sorted(ENGINES), help="engine(s) to benchmark")
+    parser.add_argument("--command", default="PING", help="CMIT command verb to send")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent client threads per process")
+    parser.add_argument("--requests", type=int, default=500, help="requests per client thread")
+    parser.add_argument("--idle", type=int, default=0, help="idle connections held open during the run")
+    parser.add_argument("--processes", type=int, default=1, help="client processes, each running --clients threads")
+    parser.add_argument("--workers", type=int, default=None, help="server worker processes (prefork)")
+    parser.add_argument("--work", type=int, default=0, help="CPU bound iterations per EXECUTE request")
+    parser.add_argument("--keep-alive", action="store_true", help="reuse one persistent connection per client")
+    parser.add_argument("--pipeline", type=int, default=1, help="requests pipelined per batch (implies --keep-alive)")
+    parser.add_argument("--max-in-flight", type=int, default=None,
+                        help="admission control: requests handled concurrently before rejecting further ones")
+    parser.add_argument("--multiplex", action="store_true", help="client threads of a process share one multiplexed connection")
+    args = parser.parse_args(argv)
+
+    if args.pipeline > 1:
+        args.keep_alive = True
+
+    BenchHandler.work = AsyncBenchHandler.work = args.work
+    BenchHandler.max_in_flight = AsyncBenchHandler.max_in_flight = args.max_in_flight
+    if args.multiplex:
+        BenchHandler.protocol_version = AsyncBenchHandler.protocol_version = "CMIT/1.2"
+    elif args.keep_alive:
+        BenchHandler.protocol_version = AsyncBenchHandler.protocol_version = "CMIT/1.1"
+
+    for engine_name in args.engine or sorted(ENGINES):
+        run(engine_name, args.command, args.clients, args.requests, args.idle, args.processes, args.workers,
+            args.keep_alive, args.pipeline, args.multiplex)
+
+
+if __name__ == "__main__":
+    main()
@@ -37,12 +37,15 @@ class CMITStatus(IntEnum):
     # 3xx Client Error
     BAD_REQUEST = 300, 'Bad Request', 'Bad request syntax or unsupported method'
     UNAUTHORIZED = 301, 'Unauthorized', 'No permission -- see authorization schemes'
+    REQUEST_TIMEOUT = 302, 'Request Timeout', 'The deadline of the request passed before it could be handled'
+    DUPLICATE_REQUEST = 303, 'Duplicate Request', 'A request with this id was already handled'
 
     # 4xx Server Error
     INTERNAL_SERVER_ERROR = 400, 'Internal Server Error', 'Server got itself in trouble'
     NOT_IMPLEMENTED = 401, 'Not Implemented', 'Server does not support this operation'
     BAD_GATEWAY = 402, 'Bad Gateway', 'Invalid responses from another server/proxy'
     SERVICE_UNAVAILABLE = 403, 'Service Unavailable', 'The server cannot process the request due to a high load'
+    GATEWAY_TIMEOUT = 404, 'Gateway Timeout', 'The worker handling the request did not complete it in time'
 
     @property
     def is_informational(self):
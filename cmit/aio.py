@@ -0,0 +1,679 @@
+"""
+asyncio CMIT server classes.
+
+:class:`AsyncCMITServer` serves the same protocol as :class:`cmit.server.CMITServer`
+but multiplexes every connection on a single event loop, so a large number of
+mostly idle clients does not cost one OS thread each.
+
+Handlers subclass :class:`AsyncCMITRequestHandler` and may implement their
+``do_*`` methods either as plain functions or as coroutines::
+
+    class TaskHandler(AsyncCMITRequestHandler):
+
+        @cmit_response
+        async def do_EXECUTE(self):
+            await asyncio.sleep(0)
+            return CMITStatus.ACCEPTED, self.msg
+
+The server features of the other modules are mixed into :class:`AsyncCMITServer`
+like into :class:`cmit.server.CMITServer`, and the BATCH, SUBSCRIBE/PUBLISH and
+FETCH/COMMIT commands into the handler with :class:`AsyncBatchHandlerMixIn`,
+:class:`AsyncPubSubHandlerMixIn` and :class:`AsyncTopicLogHandlerMixIn`::
+
+    class TopicServer(PubSubMixIn, AsyncCMITServer):
+        pass
+
+    class TopicHandler(AsyncPubSubHandlerMixIn, SimpleAsyncCMITRequestHandler):
+        pass
+"""
+import asyncio
+import copy
+import inspect
+import io
+import json
+import logging
+import socket
+import threading
+
+from cmit import CMITStatus
+from cmit.messages import CMITMessage
+from cmit.server import (BaseCMITRequestHandler, BatchHandlerMixIn, PubSubHandlerMixIn, SimpleCMITRequestHandler,
+                         TopicLogHandlerMixIn, _MAXLINE)
+from cmit.utils import cmit_response, send_message
+
+
+class _StreamWriterFile:
+    """
+    Minimal file-like wrapper around an :class:`asyncio.StreamWriter`.
+
+    Writes are buffered by the transport, which lets the synchronous response helpers
+    of :class:`BaseCMITRequestHandler` (send_error, send_response, ...) be reused as-is.
+    The handler drains the writer once the request has been handled.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self._writer = writer
+
+    def write(self, data):
+        self._writer.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class AsyncCMITRequestHandler(BaseCMITRequestHandler):
+    """
+    CMIT request handler running on an asyncio event loop.
+
+    Parsing and responding follow :class:`BaseCMITRequestHandler`, only the reads are
+    awaited instead of blocking. ``do_*`` methods may be coroutines.
+    """
+
+    # noinspection PyMissingConstructor
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server):
+        self.reader = reader
+        self.writer = writer
+        self.server = server
+        self.request = writer.get_extra_info("socket")
+        self.client_address = writer.get_extra_info("peername")
+        self.wfile = _StreamWriterFile(writer)
+
+    async def readline(self) -> bytes:
+        """
+        Read a single line, returning at most ``_MAXLINE + 1`` bytes like ``rfile.readline``.
+        """
+        try:
+            return await self.reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+        except asyncio.LimitOverrunError:
+            return await self.reader.read(_MAXLINE + 1)
+
+    async def read_request_line(self) -> bytes:
+        """
+        Read the raw request line, see :meth:`BaseCMITRequestHandler.read_request_line`.
+        """
+        if not self.requests_served:
+            return await self.readline()
+
+        try:
+            return await asyncio.wait_for(self.readline(), self.keep_alive_timeout)
+        except asyncio.TimeoutError:
+            return b""
+
+    async def parse_body(self):
+        """
+        Parse request body (internal)
+        """
+
+        self.msg = None
+
+        spacer = str(await self.readline(), 'latin-1')
+
+        if spacer != "\r\n":
+            self.send_error(CMITStatus.BAD_REQUEST, "Invalid request body")
+            return False
+
+        msg_line = str(await self.readline(), 'latin-1')
+
+        if msg_line == "\r\n":
+            self.send_error(CMITStatus.BAD_REQUEST, "Invalid request body")
+            return False
+
+        try:
+            self.msg = CMITMessage.parse_message(msg_line)
+
+        except (json.JSONDecodeError, ValueError):
+            self.logger.error(f"Invalid request body: {msg_line}")
+            self.send_error(CMITStatus.BAD_REQUEST, "Malformed request body")
+            return False
+
+        if self.msg.oob is not None:
+            # Descriptors aren't received by the event loop's streams, the request is refused
+            return self.attach_oob_payload()
+
+        return True
+
+    # noinspection PyAttributeOutsideInit
+    async def handle_one_request(self):
+        """
+        Handle a single CMIT request.
+
+        See :meth:`BaseCMITRequestHandler.handle_one_request`.
+        """
+
+        try:
+            self.raw_request_line = await self.read_request_line()
+
+            if len(self.raw_request_line) > _MAXLINE:
+                self.request_line = ''
+                self.request_version = ''
+                self.command = ''
+                self.send_error(CMITStatus.BAD_REQUEST)
+                return
+
+            if not self.raw_request_line:
+                self.close_connection = True
+                return
+
+            if not self.parse_request():
+                return
+
+            mname = 'do_' + self.command
+
+            if not await self.parse_body():
+                return
+
+            if not self.check_deadline():
+                return
+
+            if not self.find_route() and not hasattr(self, mname):
+                self.send_error(
+                    CMITStatus.NOT_IMPLEMENTED,
+                    "Unsupported method (%r)" % self.command
+                )
+                return
+
+            if not self.admit_request():
+                return
+
+            if self.multiplexed and self.mux_workers:
+                await self.dispatch_multiplexed()
+                return
+
+            try:
+                if await self.enter_bulkhead():
+                    try:
+                        if self.check_deadline():
+                            await self.invoke_once()
+                    finally:
+                        self.leave_bulkhead()
+            finally:
+                self.release_request()
+
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            self.log_error("Request aborted: %r", e)
+            self.close_connection = True
+
+        finally:
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                self.close_connection = True
+
+    async def invoke_once(self):
+        """
+        Run invoke(), awaiting coroutine routes and do_* methods.
+
+        See :meth:`BaseCMITRequestHandler.invoke_once`.
+        """
+        if not self.claim_request():
+            return
+
+        with self.caching_response():
+            result = self.invoke()
+            if inspect.isawaitable(result):
+                await result
+
+    async def send_stream(self, status, chunks):
+        """
+        Answer the current request with a streamed response, see :meth:`BaseCMITRequestHandler.send_stream`.
+
+        ``chunks`` may also be an async iterator. The writer is drained after every
+        frame, so chunks are only produced as fast as the client reads them.
+        """
+        if not self.allow_streaming:
+            return super().send_stream(status, [chunk async for chunk in _iter_chunks(chunks)])
+
+        self.abandon_request()
+        self.log_request(status)
+
+        chunk_iter = _iter_chunks(chunks)
+        try:
+            while True:
+                try:
+                    chunk = await chunk_iter.__anext__()
+                except StopAsyncIteration:
+                    frame = self.stream_end_frame(status)
+                    break
+                except Exception:
+                    self.logger.exception(f"Error streaming the response to {self.command} request {self.msg.msg_id}")
+                    frame = self.stream_end_frame(CMITStatus.INTERNAL_SERVER_ERROR, failed=True)
+                    break
+
+                self.write_stream_frame(self.response_frame(status, self.stream_message(chunk, more=True)))
+                await self.writer.drain()
+
+            self.write_stream_frame(frame)
+        finally:
+            await chunk_iter.aclose()
+
+    async def enter_bulkhead(self):
+        """
+        Take a slot of the bulkhead of the current request.
+
+        See :meth:`BaseCMITRequestHandler.enter_bulkhead`, waiting for a slot
+        happens on a thread of the loop's default executor.
+        """
+        self._bulkhead = bulkhead = self.find_bulkhead()
+        if bulkhead is None or bulkhead.try_acquire():
+            return True
+
+        if self.bulkhead_wait and bulkhead.max_queue:
+            acquired = await asyncio.get_running_loop().run_in_executor(None, bulkhead.acquire)
+        else:
+            acquired = bulkhead.acquire(blocking=False)
+
+        if acquired:
+            return True
+
+        self._bulkhead = None
+        self.send_service_unavailable()
+        return False
+
+    async def dispatch_multiplexed(self):
+        """
+        Handle the current request of a multiplexed connection in its own task.
+
+        See :meth:`BaseCMITRequestHandler.dispatch_multiplexed`, ``mux_workers``
+        bounds the number of concurrent tasks per connection.
+        """
+        if not hasattr(self, "_mux_tasks"):
+            self._mux_tasks = set()
+            self._mux_slots = asyncio.Semaphore(self.mux_workers)
+
+        # Stop reading further requests while mux_workers requests are in progress
+        await self._mux_slots.acquire()
+
+        request = copy.copy(self)
+        request.wfile = io.BytesIO()
+        request._response_buffer = []
+
+        task = asyncio.ensure_future(request.handle_multiplexed(self))
+        self._mux_tasks.add(task)
+        task.add_done_callback(self._mux_tasks.discard)
+
+    async def handle_multiplexed(self, connection_handler):
+        """
+        Run the route or do_* method on a copy of the connection's handler (internal).
+        """
+        self._stream_wfile = connection_handler.wfile
+        try:
+            try:
+                with self.answering_errors():
+                    if await self.enter_bulkhead():
+                        try:
+                            if self.check_deadline():
+                                await self.invoke_once()
+                        finally:
+                            self.leave_bulkhead()
+            finally:
+                self.release_request()
+
+            connection_handler.writer.write(self.wfile.getvalue())
+            try:
+                await connection_handler.writer.drain()
+            except ConnectionError as e:
+                self.log_error("Failed to send multiplexed response: %r", e)
+        finally:
+            connection_handler._mux_slots.release()
+
+    async def handle(self):
+        """
+        Handle multiple requests if necessary.
+        """
+        self.close_connection = True
+        try:
+            await self.handle_one_request()
+
+            while not self.close_connection:
+                await self.handle_one_request()
+        finally:
+            # Let requests of a multiplexed connection finish before it's closed
+            if getattr(self, "_mux_tasks", None):
+                await asyncio.gather(*self._mux_tasks, return_exceptions=True)
+
+    async def finish(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def _read_until_eof(reader):
+    # Discard what a subscriber sends, until it closes the connection
+    try:
+        while await reader.read(65536):
+            pass
+    except ConnectionError:
+        pass
+
+
+async def _iter_chunks(chunks):
+    # Iterate over the chunks of a streamed response, from an iterator or an async iterator
+    try:
+        if hasattr(chunks, "__aiter__"):
+            async for chunk in chunks:
+                yield chunk
+        else:
+            for chunk in chunks:
+                yield chunk
+    finally:
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+        elif hasattr(chunks, "close"):
+            chunks.close()
+
+
+class AsyncBatchHandlerMixIn(BatchHandlerMixIn):
+    """
+    Asyncio counterpart of :class:`cmit.server.BatchHandlerMixIn`.
+    """
+
+    async def do_BATCH(self):
+        """
+        Serve a BATCH request, see :meth:`cmit.server.BatchHandlerMixIn.do_BATCH`.
+        """
+        entries = self.parse_batch()
+        if entries is None:
+            return
+
+        results = []
+        with self.handling_batch():
+            for entry in entries:
+                with self.handling_batch_entry(results):
+                    if self.begin_batch_entry(entry) and self.check_deadline() and await self.enter_bulkhead():
+                        try:
+                            await self.invoke_once()
+                        finally:
+                            self.leave_bulkhead()
+
+        self.send_batch_results(results)
+
+
+class AsyncPubSubHandlerMixIn(PubSubHandlerMixIn):
+    """
+    Asyncio counterpart of :class:`cmit.server.PubSubHandlerMixIn`.
+    """
+
+    async def do_SUBSCRIBE(self):
+        """
+        Serve a SUBSCRIBE request, see :meth:`cmit.server.PubSubHandlerMixIn.do_SUBSCRIBE`.
+
+        The frames are written as they're published, the subscription ends once
+        the client closes the connection.
+        """
+        subscription = self.begin_subscription()
+        if subscription is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        published = asyncio.Event()
+
+        def wakeup():
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(published.set)
+
+        subscription.wakeup = wakeup
+        disconnected = loop.create_task(_read_until_eof(self.reader))
+        frames = self.subscription_frames(subscription)
+        try:
+            for frame in frames:
+                if frame is not None:
+                    self.write_stream_frame(frame)
+                    await self.writer.drain()
+                    continue
+
+                waiter = loop.create_task(published.wait())
+                try:
+                    await asyncio.wait((waiter, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+                if disconnected.done():
+                    break
+                published.clear()
+        except ConnectionError as e:
+            self.log_error("Subscriber of %s went away: %r", subscription.pattern, e)
+        finally:
+            frames.close()
+            disconnected.cancel()
+
+
+class AsyncTopicLogHandlerMixIn(TopicLogHandlerMixIn):
+    """
+    Asyncio counterpart of :class:`cmit.server.TopicLogHandlerMixIn`.
+    """
+
+    async def do_FETCH(self):
+        """
+        Serve a FETCH request, see :meth:`cmit.server.TopicLogHandlerMixIn.do_FETCH`.
+
+        The messages are copied from the log file to the socket by the event loop
+        (``loop.sendfile``), which falls back to reading the file where it can't.
+        """
+        batch = self.begin_fetch()
+        if batch is None:
+            return
+
+        try:
+            if batch.count:
+                self.write_stream_frame(self.fetch_head())
+                await self.writer.drain()
+                with open(batch.fd, "rb", buffering=0, closefd=False) as f:
+                    await asyncio.get_running_loop().sendfile(self.writer.transport, f, batch.position, batch.size)
+            self.write_stream_frame(self.fetch_end_frame(batch))
+        finally:
+            batch.close()
+
+
+class SimpleAsyncCMITRequestHandler(AsyncCMITRequestHandler):
+    """
+    Asyncio counterpart of :class:`cmit.server.SimpleCMITRequestHandler`.
+    """
+
+    server_version = SimpleCMITRequestHandler.server_version
+    max_poll_wait = SimpleCMITRequestHandler.max_poll_wait
+    max_task_wait = SimpleCMITRequestHandler.max_task_wait
+    poll_deadline_margin = SimpleCMITRequestHandler.poll_deadline_margin
+
+    do_PING = SimpleCMITRequestHandler.do_PING
+    do_EXECUTE = SimpleCMITRequestHandler.do_EXECUTE
+    poll_payload = SimpleCMITRequestHandler.poll_payload
+    poll_watch = SimpleCMITRequestHandler.poll_watch
+    poll_wait = SimpleCMITRequestHandler.poll_wait
+    poll_task_id = SimpleCMITRequestHandler.poll_task_id
+    wait_payload = SimpleCMITRequestHandler.wait_payload
+    wait_watch = SimpleCMITRequestHandler.wait_watch
+    task_wait = SimpleCMITRequestHandler.task_wait
+    wait_budget = SimpleCMITRequestHandler.wait_budget
+
+    @cmit_response
+    async def do_POLL(self):
+        """
+        Handle the POLL command, see :meth:`SimpleCMITRequestHandler.do_POLL`.
+
+        A long poll waits on the loop, see wait_changed().
+        """
+        msg = CMITMessage(self.msg.topic, self.msg.msg_id)
+        wait = self.poll_wait()
+        if wait:
+            key, changed = self.poll_watch()
+            await self.wait_changed(changed, wait, **key)
+        msg.payload = self.poll_payload()
+
+        return CMITStatus.OK, msg
+
+    async def wait_changed(self, changed, wait, **key):
+        """
+        Wait up to ``wait`` seconds for ``changed()`` to return True.
+
+        It's checked whenever the result store updates the task or topic named by
+        ``key``, see :meth:`cmit.results.TaskResultStore.watch`: the store wakes
+        the request up on the loop, so no thread is held while it waits.
+        """
+        loop = asyncio.get_running_loop()
+        updated = asyncio.Event()
+
+        def wakeup():
+            # Called by the thread updating the store
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(updated.set)
+
+        unwatch = self.result_store().watch(wakeup, **key)
+        deadline = loop.time() + wait
+        try:
+            while not changed():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(updated.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                updated.clear()
+        finally:
+            unwatch()
+
+    async def do_WAIT(self):
+        """
+        Handle the WAIT command, see :meth:`SimpleCMITRequestHandler.do_WAIT`.
+
+        The task is waited for on the loop, see wait_changed().
+        """
+        task_id = self.poll_task_id()
+        if task_id is None:
+            self.send_error(CMITStatus.BAD_REQUEST, "Missing msg_id", "WAIT requests name the msg_id of a task")
+            return
+
+        msg = CMITMessage(self.msg.topic, self.msg.msg_id)
+        wait = self.task_wait()
+        if wait:
+            key, finished = self.wait_watch(task_id)
+            await self.wait_changed(finished, wait, **key)
+        status, msg.payload = self.wait_payload(task_id)
+
+        send_message(self, status, msg)
+
+
+class AsyncCMITServer:
+    """
+    CMIT server running every connection on a single asyncio event loop.
+
+    The public interface mirrors :class:`cmit.server.CMITServer`: the socket is bound
+    and listening once the constructor returns, :meth:`serve_forever` blocks the calling
+    thread and :meth:`shutdown` may be called from any other thread.
+    """
+
+    address_family = socket.AF_UNIX
+    socket_type = socket.SOCK_STREAM
+    request_queue_size = 5
+    allow_reuse_address = False
+    logger = logging.getLogger()
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.socket = socket.socket(self.address_family, self.socket_type)
+        self._loop = None
+        self._server = None
+        self._connections = {}
+        self.__is_shut_down = threading.Event()
+        self.__is_shut_down.set()
+
+        if bind_and_activate:
+            try:
+                self.server_bind()
+                self.server_activate()
+            except BaseException:
+                self.server_close()
+                raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    def server_bind(self):
+        """Called by constructor to bind the socket."""
+        self.logger.info(f"Binding to AsyncCMITServer to {self.server_address}")
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+
+    def server_activate(self):
+        """Called by constructor to activate the server."""
+        self.socket.listen(self.request_queue_size)
+
+    def server_close(self):
+        """Called to clean-up the server."""
+        self.socket.close()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        handler = self._connections[task] = self.RequestHandlerClass(reader, writer, self)
+        try:
+            await handler.handle()
+        except Exception:
+            self.handle_error(handler.client_address)
+        finally:
+            try:
+                await handler.finish()
+            finally:
+                self._connections.pop(task, None)
+
+    def handle_error(self, client_address):
+        """Handle an error gracefully. May be overridden."""
+        self.logger.exception(f"Exception occurred during processing of request from {client_address}")
+
+    async def serve(self):
+        """
+        Serve connections on the running event loop until :meth:`shutdown` is called.
+        """
+        self._loop = asyncio.get_running_loop()
+        self.__is_shut_down.clear()
+        try:
+            self._server = await asyncio.start_unix_server(
+                self._handle_connection, sock=self.socket, limit=_MAXLINE + 1
+            )
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # Connections still open at shutdown are closed and awaited here, so they
+            # never outlive the loop. Closing the transport feeds EOF to the handler,
+            # which then finishes its current request and returns normally.
+            connections = list(self._connections.items())
+            for _, handler in connections:
+                handler.writer.close()
+            await asyncio.gather(*(task for task, _ in connections), return_exceptions=True)
+
+            self._server = None
+            self.__is_shut_down.set()
+
+    def serve_forever(self):
+        """Run a new event loop serving connections until :meth:`shutdown` is called."""
+        asyncio.run(self.serve())
+
+    def shutdown(self):
+        """
+        Stops the serve_forever loop.
+
+        Blocks until the loop has finished. This must be called while
+        serve_forever() is running in another thread, or it will deadlock.
+        """
+        loop, server = self._loop, self._server
+        if loop is not None and server is not None:
+            loop.call_soon_threadsafe(server.close)
+        self.__is_shut_down.wait()
+
+
+__all__ = ["AsyncCMITServer", "AsyncCMITRequestHandler", "SimpleAsyncCMITRequestHandler", "AsyncBatchHandlerMixIn",
+           "AsyncPubSubHandlerMixIn", "AsyncTopicLogHandlerMixIn"]
@@ -0,0 +1,170 @@
+"""
+Per-topic bulkheads.
+
+A bulkhead caps the number of requests of some topics handled at the same time,
+so a slow or runaway topic can't take every thread (and the CPU) away from the
+others. Bulkheads are configured on a server mixing in :class:`BulkheadMixIn`,
+for a topic pattern (see :mod:`cmit.routing` for the syntax)::
+
+    class DemoServer(BulkheadMixIn, server.ThreadingCMITServer):
+        pass
+
+    demo_server = DemoServer(SOCKET_PATH, server.SimpleCMITRequestHandler)
+    demo_server.add_bulkhead("reports.#", max_concurrent=2, max_queue=8, queue_timeout=5.0)
+
+Before its route or ``do_*`` method runs, a request takes a slot of the bulkhead
+matching its topic. When all ``max_concurrent`` slots are taken, up to
+``max_queue`` requests wait for one, at most ``queue_timeout`` seconds. Requests
+arriving while the queue is full, or waiting longer than that, are answered with
+SERVICE_UNAVAILABLE. Requests matching no bulkhead are not limited.
+"""
+import threading
+import time
+from typing import Optional
+
+from cmit.routing import TopicRouter
+
+
+class Bulkhead:
+    """
+    Concurrency cap and bounded wait queue shared by the requests of some topics.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int = 0, queue_timeout: Optional[float] = None):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.peak_active = 0
+        self._queue_wait_total = 0.0
+        self._queue_wait_max = 0.0
+        self._queue_waits = 0
+
+    def __repr__(self):
+        return '<%s %s %d/%d>' % (self.__class__.__name__, self.name, self.active, self.max_concurrent)
+
+    def try_acquire(self) -> bool:
+        """
+        Take a slot if one is free, without waiting and without counting a rejection.
+        """
+        with self._cond:
+            if self.active < self.max_concurrent:
+                self._take()
+                return True
+        return False
+
+    def acquire(self, blocking=True) -> bool:
+        """
+        Take a slot, waiting in the queue for one if ``blocking`` and the queue isn't full.
+
+        Return False if the request is rejected.
+        """
+        with self._cond:
+            if self.active < self.max_concurrent:
+                self._take()
+                return True
+
+            if not blocking or self.queued >= self.max_queue:
+                self.rejected += 1
+                return False
+
+            self.queued += 1
+            start = time.monotonic()
+            try:
+                if not self._cond.wait_for(lambda: self.active < self.max_concurrent, self.queue_timeout):
+                    self.rejected += 1
+                    self.timed_out += 1
+                    return False
+            finally:
+                self.queued -= 1
+
+            wait = time.monotonic() - start
+            self._queue_waits += 1
+            self._queue_wait_total += wait
+            self._queue_wait_max = max(self._queue_wait_max, wait)
+
+            self._take()
+            return True
+
+    def _take(self):
+        # Must be called with _cond held.
+        self.active += 1
+        self.admitted += 1
+        self.peak_active = max(self.peak_active, self.active)
+
+    def release(self):
+        """
+        Give back the slot of a completed request.
+        """
+        with self._cond:
+            self.active -= 1
+            self.completed += 1
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        """
+        Return a snapshot of the slots and queue in use, and the requests admitted and rejected so far.
+        """
+        with self._cond:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "active": self.active,
+                "queued": self.queued,
+                "peak_active": self.peak_active,
+                "saturation": self.active / self.max_concurrent,
+                "queue_saturation": self.queued / self.max_queue if self.max_queue else 0.0,
+                "admitted": self.admitted,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "queue_wait_avg": self._queue_wait_total / self._queue_waits if self._queue_waits else 0.0,
+                "queue_wait_max": self._queue_wait_max,
+            }
+
+
+class BulkheadMixIn:
+    """
+    Mix-in class configuring per-topic :class:`Bulkhead` instances on a server.
+    """
+
+    bulkhead_class = Bulkhead
+
+    # TopicRouter mapping topic patterns to their Bulkhead
+    bulkheads = None
+
+    def add_bulkhead(self, pattern: str, max_concurrent: int, max_queue: int = 0,
+                     queue_timeout: Optional[float] = None, command: Optional[str] = None) -> Bulkhead:
+        """
+        Limit the requests whose topic matches ``pattern`` (and ``command``, if given).
+        """
+        if self.bulkheads is None:
+            self.bulkheads = TopicRouter()
+
+        name = pattern if command is None else f"{command.upper()} {pattern}"
+        bulkhead = self.bulkhead_class(name, max_concurrent, max_queue, queue_timeout)
+        self.bulkheads.add(pattern, bulkhead, command)
+        return bulkhead
+
+    def bulkhead_stats(self) -> dict:
+        """
+        Return the stats of every bulkhead, keyed by topic pattern (preceded by the command, if given).
+        """
+        if self.bulkheads is None:
+            return {}
+
+        return {bulkhead.name: bulkhead.stats() for bulkhead in self.bulkheads.handlers()}
+
+
+__all__ = ["Bulkhead", "BulkheadMixIn"]
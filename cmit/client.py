@@ -1,14 +1,19 @@
 import errno
 import io
 import os
+import queue
 import re
 import json
 import socket
+import threading
+import time
 import typing
+from collections import deque
 from secrets import randbits
 from typing import Union
 
 from .messages import CMITMessage
+from .oob import memfd_payload, send_with_fds
 from .typing import PayloadType, TopicType
 from .utils import create_connection, encode as _encode
 
@@ -65,9 +70,15 @@ class CMITResponse(io.BufferedIOBase):
     #   {CMITP Version} {Status Code} {Reason Message}\r\n
     #   {blank line}
     #   {CMITP Message}
-
-    def __init__(self, sock: socket.socket, **kwargs):
-        self.fp = sock.makefile("rb")
+    #
+    # A streamed response is a sequence of such frames, the messages of its chunks
+    # have "more" set to true and the one of its terminator to false.
+
+    def __init__(self, sock: socket.socket, fp=None, **kwargs):
+        # A connection reading several responses from the same socket passes its own
+        # reader, which is shared between responses and not closed with them.
+        self._shared_fp = fp is not None
+        self.fp = fp if fp is not None else sock.makefile("rb")
         self.sock_path = sock.getsockname()
         self.will_close = True
 
@@ -77,6 +88,18 @@ class CMITResponse(io.BufferedIOBase):
 
         self.msg: typing.Optional[CMITMessage] = None
 
+        # Whether the response is streamed, see iter_messages()
+        self.streamed = False
+        # Chunks received and not iterated over yet
+        self._chunks = deque()
+        # Whether the terminator of the stream is still to be read
+        self._stream_open = False
+        self._stream_error = None
+        # Whether the rest of the stream is skipped rather than kept, once the response is closed
+        self._discard = False
+        # Queue the frames of the stream are passed to, when another thread reads the socket
+        self._queue = None
+
     def _read_status(self):
         line = str(self.fp.readline(_MAXLINE + 1), "utf-8")
         if len(line) > _MAXLINE:
@@ -121,29 +144,107 @@ class CMITResponse(io.BufferedIOBase):
 
         self.status = status
         self.reason = reason.strip()
-        if version in ("CMIT/1.0", ):
+        if version == "CMIT/1.0":
             self.version = 10
+        elif version == "CMIT/1.1":
+            self.version = 11
+        elif version == "CMIT/1.2":
+            self.version = 12
         else:
             raise UnknownProtocol(version)
 
+        # A CMIT/1.1 or CMIT/1.2 response line means the server keeps the connection open
+        self.will_close = self.version < 11
+
         self.msg = parse_message(self.fp)
 
+        if self.msg.more is not None:
+            self.streamed = True
+            if self.msg.more:
+                self._chunks.append(self.msg)
+                self._stream_open = True
+            else:
+                self._end_stream(self.status, self.reason, self.msg)
+
+    def iter_messages(self):
+        """
+        Yield the messages of the response.
+
+        Those of a streamed response are its chunks, read from the connection as
+        the iteration goes, so they don't have to fit in memory together. Raise
+        :class:`StreamError` if the server failed to produce all of them. Any
+        other response has a single message.
+        """
+        if not self.streamed:
+            if self.msg is not None:
+                yield self.msg
+            return
+
+        while True:
+            if self._chunks:
+                yield self._chunks.popleft()
+            elif self._stream_open:
+                self._read_chunk()
+            else:
+                break
+
+        if self._stream_error is not None:
+            raise self._stream_error
+
+    def read_stream(self):
+        """
+        Read the rest of a streamed response ahead of iter_messages(), e.g. to use the connection for another one.
+        """
+        while self._stream_open:
+            self._read_chunk(keep=not self._discard)
+
+    def _read_chunk(self, keep=True):
+        try:
+            if self._queue is not None:
+                frame = self._queue.get()
+                if isinstance(frame, BaseException):
+                    raise frame
+                status, reason, msg = frame
+            else:
+                _, status, reason = self._read_status()
+                msg = parse_message(self.fp)
+        except Exception as e:
+            self._stream_open = False
+            self._stream_error = e
+            raise
+
+        if msg.more:
+            if keep:
+                self._chunks.append(msg)
+        else:
+            self._end_stream(status, reason.strip(), msg)
+
+    def _end_stream(self, status, reason, msg):
+        self._stream_open = False
+        self.status = status
+        self.reason = reason
+        if 400 <= status <= 499:
+            self._stream_error = StreamError(status, reason, msg)
+
     def _close_conn(self):
         fp = self.fp
         self.fp = None
-        if fp:
+        if fp and not self._shared_fp:
             fp.close()
 
     def close(self):
         try:
             super().close()
         finally:
-            if self.fp:
+            if self._stream_open:
+                # The connection skips the rest of the stream before reading its next response
+                self._discard = True
+            elif self.fp:
                 self._close_conn()
 
     def flush(self):
         super().flush()
-        if self.fp:
+        if self.fp and not self.fp.closed:
             self.fp.flush()
 
     def isclosed(self):
@@ -152,31 +253,63 @@ class CMITResponse(io.BufferedIOBase):
 
 
 class CMITConnection:
+    """
+    A connection to a CMIT server.
 
-    _cmitp_vsn = 10
-    _cmitp_vsn_str = 'CMIT/1.0'
+    Requests are sent as CMIT/1.1, servers supporting persistent connections keep
+    the socket open after responding, in which case it is reused by the next request.
+    Servers only speaking CMIT/1.0 answer with a CMIT/1.0 response and close it.
+    """
+
+    _cmitp_vsn = 11
+    _cmitp_vsn_str = 'CMIT/1.1'
 
     response_class = CMITResponse
     default_socket = DEFAULT_CMITP_SOCKET
     auto_open = 1
 
+    # Seconds a blocking operation on the socket may take. Overloaded servers answer
+    # with SERVICE_UNAVAILABLE right away when admission control is enabled.
+    timeout = 120.0
+
+    # Number of requests pipeline() keeps in flight before waiting for a response.
+    pipeline_depth = 32
+
+    # Size from which payloads are passed out-of-band, in a memory file whose
+    # descriptor is sent along the request (see cmit.oob). None to always send them inline.
+    # Multiplexed connections always send them inline.
+    oob_threshold = None
+
     def __init__(self, socket_fp=None, block_size=8192):
 
         self.sock = None
         self.block_size = block_size
         self._buffer = []
+        # Descriptors of the out-of-band payloads of the buffered requests
+        self._fds = []
+        self._fp = None
         self.__response = None
         self.__state = _CS_IDLE
+        # Requests sent and not answered yet, in the order they were sent
         self.__messages = {}
+        # Whether the server already confirmed it keeps this connection open
+        self.__persistent = False
+        # Outstanding requests allowed by the server, None until it advertised a window
+        self.__window = None
+        # Whether the server closes the connection once the current streamed response is complete
+        self.__close_after_stream = False
         self.socket = socket_fp if socket_fp is not None else self.default_socket
 
         self._validate_socket_path(self.socket)
 
     def connect(self):
         self.sock = self._create_connection()
+        self._fp = self.sock.makefile("rb")
+        self.__persistent = False
+        self.__window = None
 
         try:
-            self.sock.settimeout(120.0)
+            self.sock.settimeout(self.timeout)
         except OSError as e:
             if e.errno in (errno.ENOPROTOOPT, errno.EPROTONOSUPPORT):
                 raise
@@ -207,8 +340,25 @@ class CMITConnection:
         """
 
         self.__state = _CS_IDLE
+        self.__messages = {}
+        self.__persistent = False
+        self.__window = None
+        self.__close_after_stream = False
+
+        fds, self._fds = self._fds, []
+        for fd in fds:
+            os.close(fd)
+
+        response = self.__response
+        if response is None or not response._discard:
+            self._read_stream()
 
         try:
+            fp = self._fp
+            if fp:
+                self._fp = None
+                fp.close()
+
             sock = self.sock
             if sock:
                 self.sock = None
@@ -219,9 +369,12 @@ class CMITConnection:
                 self.__response = None
                 response.close()
 
-    def end_request(self):
+    def end_request(self, flush=True):
         """
         This method sends the end of request message to the server.
+
+        With ``flush=False`` the request stays buffered, so that several requests
+        can be written to the socket at once (see :meth:`pipeline`).
         """
 
         # Change state to indicate that the request has been sent.
@@ -230,53 +383,117 @@ class CMITConnection:
         else:
             raise ImproperConnectionState("Request not started")
 
-        self.send("\r\n")
+        self._buffer.append(b"\r\n")
+
+        if flush:
+            self._send_output()
+
+    def _send_output(self):
+        """
+        Send the buffered requests in a single write.
+        """
+        data = b"".join(self._buffer)
+        self._buffer = []
+        if not self._fds:
+            self.send(data)
+            return
+
+        fds, self._fds = self._fds, []
+        try:
+            send_with_fds(self.sock, data, fds)
+        finally:
+            # The descriptors in flight are held by the kernel
+            for fd in fds:
+                os.close(fd)
 
-    def request(self, command: str, topic: TopicType, payload: PayloadType = "", msg_id=None):
+    def request(self, command: str, topic: TopicType, payload: PayloadType = "", msg_id=None, deadline=None,
+                priority=None):
         """
         Send a CMITP request to the server.
 
         At this point the topic and payload can be
         strings, bytes, or callable objects.
+
+        ``deadline`` is the POSIX time after which the response won't be waited for,
+        the server drops the request instead of handling it once it has passed.
+        ``priority`` is the priority class of the task, for servers scheduling them.
         """
         if msg_id is None:
             # Generate a new random message id
             msg_id = "%032x" % randbits(128)
 
-        self._send_request(command, topic, payload, msg_id=msg_id)
+        self._send_request(command, topic, payload, msg_id=msg_id, deadline=deadline, priority=priority)
 
         return msg_id
 
-    def _send_request(self, command: str, topic: TopicType, payload: PayloadType, msg_id=None):
+    def _send_request(self, command: str, topic: TopicType, payload: PayloadType, msg_id=None, flush=True,
+                      deadline=None, priority=None):
+
+        message = self._build_message(topic, payload, msg_id, deadline, priority)
+        oob = self.oob_threshold is not None and len(message.payload_view) >= self.oob_threshold
+        if not oob:
+            self._check_inline(message)
 
         if self.__response and self.__response.isclosed():
             self.__response = None
 
-        # Change state to indicate that we are starting a new request.
-        if self.__state == _CS_IDLE:
+        if self.__close_after_stream:
+            self.close()
+
+        # Change state to indicate that we are starting a new request. Further
+        # requests may only be sent before the previous responses were read on a
+        # connection the server keeps open.
+        if self.__state == _CS_IDLE or (self.__state == _CS_REQ_SENT and not flush):
             self.__state = _CS_REQ_STARTED
         else:
             raise CannotSendRequest(self.__state)
 
-        # Create a new message object
-        message = CMITMessage(topic, msg_id=msg_id)
+        if self.sock is None:
+            if self.auto_open:
+                self.connect()
+            else:
+                raise NotConnected()
 
-        # Set the payload, check if it is a string, dict, or callable
-        if isinstance(payload, str) or hasattr(payload, "__call__"):
-            message.payload = payload
-        elif isinstance(payload, dict):
-            message.payload = json.dumps(payload)
+        if oob:
+            self._fds.append(memfd_payload(message.payload_view))
+            message.oob = len(message.payload_view)
+            message.payload = ""
+            # Sent right away, the server receives a limited number of descriptors per read
+            flush = True
 
         # Cache the message object
         self.__messages[msg_id] = message
 
         request_line = f"{command.upper()} {self._cmitp_vsn_str}\r\n"
-        self.sock.sendall(_encode(request_line, "request line"))
-        self.sock.sendall(_encode("\r\n", "blank line"))
-        self.sock.sendall(message())
+        self._buffer.append(_encode(request_line, "request line"))
+        self._buffer.append(_encode("\r\n", "blank line"))
+        self._buffer.append(message())
 
         # Finalize the message
-        self.end_request()
+        self.end_request(flush)
+
+    @staticmethod
+    def _build_message(topic: TopicType, payload: PayloadType, msg_id, deadline=None, priority=None) -> CMITMessage:
+        # Create a new message object
+        message = CMITMessage(topic, msg_id=msg_id)
+        message.deadline = deadline
+        message.priority = priority
+
+        # Set the payload, check if it is a string, bytes, dict, or callable
+        if isinstance(payload, (str, bytes, bytearray, memoryview)) or hasattr(payload, "__call__"):
+            message.payload = payload
+        elif isinstance(payload, dict):
+            message.payload = json.dumps(payload)
+
+        return message
+
+    @staticmethod
+    def _check_inline(message: CMITMessage):
+        # The message line is JSON: only text can be sent inline
+        try:
+            message.payload
+        except UnicodeDecodeError:
+            raise ValueError("A binary payload can only be sent out-of-band, see oob_threshold") from None
 
     def send(self, data: str):
         """
@@ -287,7 +504,8 @@ class CMITConnection:
         if self.sock is None:
             self.connect()
 
-        data = _encode(data, "data")
+        if isinstance(data, str):
+            data = _encode(data, "data")
 
         try:
             self.sock.sendall(data)
@@ -300,14 +518,19 @@ class CMITConnection:
     def getresponse(self):
         """
         Get the response from the server.
+
+        The rest of a streamed response that wasn't read yet is read first, and
+        kept for its iter_messages().
         """
         if self.__response and self.__response.isclosed():
             self.__response = None
 
-        if self.__state != _CS_REQ_SENT or self.__response:
+        if self.__state != _CS_REQ_SENT:
             raise ResponseNotReady(self.__state)
 
-        response = self.response_class(self.sock)
+        self._read_stream()
+
+        response = self.response_class(self.sock, fp=self._fp)
 
         try:
             try:
@@ -316,18 +539,115 @@ class CMITConnection:
                 self.close()
                 raise
             assert response.will_close != _UNKNOWN
-            self.__state = _CS_IDLE
 
+            # Responses arrive in the order the requests were sent
+            if self.__messages:
+                del self.__messages[next(iter(self.__messages))]
+
+            if not self.__messages:
+                self.__state = _CS_IDLE
+
+            self.__response = response
             if response.will_close:
-                self.close()
+                if response._stream_open:
+                    # The stream is read from the socket first
+                    self.__close_after_stream = True
+                else:
+                    self.close()
             else:
-                self.__response = response
+                self.__persistent = True
+                if response.msg.window:
+                    self.__window = response.msg.window
 
             return response
         except:
             response.close()
             raise
 
+    def _read_stream(self):
+        # Read the rest of the previous response if it's an unfinished stream
+        response = self.__response
+        if response is None or not response._stream_open:
+            return
+
+        try:
+            response.read_stream()
+        except (OSError, CMITException, ValueError):
+            # Raised by its iter_messages() once the chunks read are consumed
+            pass
+
+    def pipeline(self, requests, depth=None) -> list:
+        """
+        Send several requests back to back and return their responses in order.
+
+        Up to ``depth`` (default :attr:`pipeline_depth`) requests are written before
+        waiting for the first response, after which a new request is written for
+        every response read. Until the server confirmed that it keeps the connection
+        open, a single request is sent at a time, afterwards no more than the window
+        advertised by the server are in flight. Requests left unanswered because the
+        server closed the connection (e.g. after an error, or a CMIT/1.0 server) were
+        not processed and are sent again on a new connection.
+
+        :param requests: iterable of ``(command, topic, payload)`` or
+            ``(command, topic, payload, msg_id)`` tuples.
+        :param depth: maximum number of requests in flight.
+        :return: list of :class:`CMITResponse`, one per request.
+        """
+        if self.__state != _CS_IDLE:
+            raise CannotSendRequest(self.__state)
+
+        depth = depth or self.pipeline_depth
+        pending = deque()
+        for req in requests:
+            command, topic, payload, msg_id = (tuple(req) + (None,))[:4]
+            if msg_id is None:
+                msg_id = "%032x" % randbits(128)
+            pending.append((command, topic, payload, msg_id))
+
+        responses = []
+        in_flight = deque()
+        # responses read on the current socket, and whether it was reused from a previous call
+        answered, reused = 0, self.sock is not None
+
+        while pending or in_flight:
+            window = min(depth, self.__window or depth) if self.__persistent else 1
+
+            try:
+                while pending and len(in_flight) < window:
+                    req = pending.popleft()
+                    self._send_request(*req, flush=False)
+                    in_flight.append(req)
+
+                if self._buffer:
+                    self._send_output()
+
+            except ConnectionError:
+                # The server closed the connection, the responses it did send can still be read.
+                self._buffer = []
+
+            try:
+                response = self.getresponse()
+            except ConnectionError:
+                # A connection closed before answering anything (e.g. an idle persistent
+                # connection) didn't process the requests, so they can be sent again.
+                if answered or not reused:
+                    raise
+                pending.extendleft(reversed(in_flight))
+                in_flight.clear()
+                reused = False
+                continue
+
+            answered += 1
+            in_flight.popleft()
+            responses.append(response)
+
+            if response.will_close:
+                pending.extendleft(reversed(in_flight))
+                in_flight.clear()
+                answered, reused = 0, False
+
+        return responses
+
     @staticmethod
     def _validate_socket_path(socket_fp: Union[os.PathLike, str]):
 
@@ -343,6 +663,305 @@ class CMITConnection:
             raise InvalidSocketPath(f"File Path for Socket doesn't exist {socket_fp!r}") from fnp
 
 
+class _MuxChannel:
+    """
+    One socket of a :class:`MultiplexedCMITConnection` and the thread reading its responses.
+    """
+
+    def __init__(self, connection: "MultiplexedCMITConnection"):
+        self.connection = connection
+        self.sock = connection._create_connection()
+        self.sock.settimeout(None)
+        self.fp = self.sock.makefile("rb")
+        self.lock = threading.Condition()
+        # msg_id -> [threading.Event, response or exception]
+        self.waiters = {}
+        # msg_id -> streamed response whose terminator wasn't received yet
+        self.streams = {}
+        # Set once a response confirmed the server keeps the connection open
+        self.persistent = False
+        # Requests allowed in flight, a single one until the server advertised its window
+        self.window = 1
+        # Set once the server announced it closes the connection, or the connection broke
+        self.closing = False
+        self.reader = threading.Thread(target=self._read_responses, name="cmit-mux-reader", daemon=True)
+        self.reader.start()
+
+    def send(self, msg_id, data: bytes):
+        waiter = [threading.Event(), None]
+
+        with self.lock:
+            # Wait for a credit. Until the server proved it keeps the connection open,
+            # a request sent while another is in flight could be dropped, so requests
+            # go one at a time.
+            while len(self.waiters) + len(self.streams) >= self.window and not self.closing:
+                self.lock.wait()
+
+            if self.closing:
+                raise RemoteDisconnected("Connection is closing")
+            self.waiters[msg_id] = waiter
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                # The server no longer reads from the connection
+                self.waiters.pop(msg_id, None)
+                self.closing = True
+                raise RequestNotProcessed(f"Failed to send the request ({e!r})") from e
+
+        return waiter
+
+    def _read_responses(self):
+        error = None
+        drained = False
+        try:
+            while True:
+                response = self.connection.response_class(self.sock, fp=self.fp)
+                response.begin()
+
+                with self.lock:
+                    stream = self.streams.get(response.msg.msg_id)
+                    if stream is not None and not response.msg.more:
+                        del self.streams[response.msg.msg_id]
+                        self.lock.notify_all()
+
+                if stream is not None:
+                    # Another frame of a streamed response, queued for its iter_messages()
+                    if not stream._discard:
+                        stream._queue.put((response.status, response.reason, response.msg))
+                    continue
+
+                with self.lock:
+                    if response.will_close:
+                        # No new requests, but responses to requests in progress may still follow
+                        self.closing = drained = True
+                    else:
+                        self.persistent = True
+                        self.window = response.msg.window or self.connection.pipeline_depth
+                    waiter = self.waiters.pop(response.msg.msg_id, None)
+                    if waiter is not None and response._stream_open:
+                        # Still in flight until its terminator arrives
+                        response._queue = queue.SimpleQueue()
+                        self.streams[response.msg.msg_id] = response
+                    self.lock.notify_all()
+
+                if waiter is not None:
+                    waiter[1] = response
+                    waiter[0].set()
+
+        except (OSError, CMITException, ValueError) as e:
+            error = e
+        finally:
+            with self.lock:
+                self.closing = True
+                waiters, self.waiters = self.waiters, {}
+                streams, self.streams = self.streams, {}
+                self.lock.notify_all()
+            for stream in streams.values():
+                stream._queue.put(RemoteDisconnected(f"Connection closed before the end of the response ({error!r})"))
+            for waiter in waiters.values():
+                if drained:
+                    # The server stopped reading requests before announcing the close
+                    waiter[1] = RequestNotProcessed("Connection closed by the server before the request was read")
+                else:
+                    waiter[1] = RemoteDisconnected(f"Connection closed before the response was received ({error!r})")
+                waiter[0].set()
+            self.fp.close()
+            self.sock.close()
+
+    def close(self):
+        # Wakes up the reader thread, which then closes the socket
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class MultiplexedCMITConnection(CMITConnection):
+    """
+    A thread-safe connection multiplexing concurrent requests over one socket.
+
+    Requests are sent as CMIT/1.2: the server handles them concurrently and answers
+    each as soon as it's done, in any order. A reader thread routes every response
+    to the thread waiting for it by its msg_id, so a slow request doesn't hold up
+    the others.
+
+    Usage::
+
+        >>> conn = MultiplexedCMITConnection("/tmp/cmit.sock")
+        >>> response = conn.call("PING", "test", "data")
+
+    The connection may be shared by any number of threads. When the server closes
+    the socket, the next request opens a new one. Requests the server did not answer
+    before closing it were not processed, :meth:`call` sends those once more.
+
+    Until the first response shows the server keeps the connection open, only one
+    request is in flight, so servers speaking only CMIT/1.0 are served one request
+    per connection. CMIT/1.1 servers answer the requests in order. Afterwards, a
+    request is only sent while fewer requests than the window advertised by the
+    server are outstanding, other threads block until a response comes in.
+    """
+
+    _cmitp_vsn = 12
+    _cmitp_vsn_str = 'CMIT/1.2'
+
+    def __init__(self, socket_fp=None, block_size=8192):
+        super().__init__(socket_fp, block_size)
+        self._channel = None
+        self._channel_lock = threading.Lock()
+
+    def _get_channel(self) -> _MuxChannel:
+        with self._channel_lock:
+            channel = self._channel
+            if channel is None or channel.closing:
+                channel = self._channel = _MuxChannel(self)
+            return channel
+
+    def connect(self):
+        self._get_channel()
+
+    def close(self):
+        with self._channel_lock:
+            channel, self._channel = self._channel, None
+        if channel is not None:
+            channel.close()
+
+    def request(self, command: str, topic: TopicType, payload: PayloadType = "", msg_id=None, deadline=None,
+                priority=None):
+        """
+        Send a request without waiting for its response.
+
+        :return: a handle to pass to :meth:`getresponse`.
+        """
+        if msg_id is None:
+            msg_id = "%032x" % randbits(128)
+
+        message = self._build_message(topic, payload, msg_id, deadline, priority)
+        self._check_inline(message)
+        request_line = f"{command.upper()} {self._cmitp_vsn_str}\r\n"
+        data = b"".join([_encode(request_line, "request line"), b"\r\n", message(), b"\r\n"])
+
+        while True:
+            channel = self._get_channel()
+            try:
+                return msg_id, channel.send(msg_id, data)
+            except RemoteDisconnected:
+                # The server is closing this connection, the request goes to a new one
+                continue
+
+    def getresponse(self, handle=None, timeout=None):
+        """
+        Wait for the response to the request identified by ``handle``.
+        """
+        if handle is None:
+            raise ResponseNotReady("A multiplexed connection needs the handle returned by request()")
+
+        msg_id, waiter = handle
+        if not waiter[0].wait(timeout):
+            raise socket.timeout(f"No response to {msg_id} within {timeout}s")
+
+        if isinstance(waiter[1], BaseException):
+            raise waiter[1]
+        return waiter[1]
+
+    def call(self, command: str, topic: TopicType, payload: PayloadType = "", msg_id=None, timeout=None,
+             priority=None):
+        """
+        Send a request and wait for its response, at most ``timeout`` seconds.
+
+        The server is told to drop the request if it can't handle it within ``timeout``.
+        """
+        if msg_id is None:
+            msg_id = "%032x" % randbits(128)
+
+        request = (command, topic, payload, msg_id, None if timeout is None else time.time() + timeout, priority)
+        return self._await_response(request, self.request(*request), timeout)
+
+    def _await_response(self, request, handle, timeout=None):
+        retried = False
+        while True:
+            try:
+                return self.getresponse(handle, timeout)
+            except RequestNotProcessed:
+                pass
+            except RemoteDisconnected:
+                # The request may or may not have been processed, it's only sent once more
+                if retried:
+                    raise
+                retried = True
+            handle = self.request(*request)
+
+    def pipeline(self, requests, depth=None) -> list:
+        """
+        Send several requests at once and return their responses in request order.
+        """
+        requests = [self._with_msg_id(*req) for req in requests]
+        handles = [self.request(*req) for req in requests]
+        return [self._await_response(req, handle) for req, handle in zip(requests, handles)]
+
+    @staticmethod
+    def _with_msg_id(command, topic, payload="", msg_id=None):
+        if msg_id is None:
+            msg_id = "%032x" % randbits(128)
+        return command, topic, payload, msg_id
+
+
+class CMITSubscription:
+    """
+    A subscription to the messages published to the topics matching a pattern, see :mod:`cmit.pubsub`.
+
+    The subscription has a connection of its own, held until it's closed.
+
+    Usage::
+
+        >>> with CMITSubscription("/tmp/cmit.sock", "orders.#") as subscription:
+        ...     for msg in subscription:
+        ...         print(msg.topic, msg.payload)
+
+    Iterating ends when the server ends the subscription, :class:`StreamError` is
+    raised if that's because the subscriber fell too far behind. ``timeout`` is
+    the number of seconds to wait for a message, None to wait forever.
+    """
+
+    connection_class = CMITConnection
+
+    def __init__(self, socket_fp=None, pattern: str = "#", timeout=None):
+        self.pattern = pattern
+        self.connection = self.connection_class(socket_fp)
+        self.connection.timeout = timeout
+
+        try:
+            self.connection.request("SUBSCRIBE", pattern)
+            self.response = self.connection.getresponse()
+            if self.response.status != 200 or not self.response.streamed:
+                raise StreamError(self.response.status, self.response.reason, self.response.msg)
+
+            self._messages = self.response.iter_messages()
+            # The first message acknowledges the subscription
+            next(self._messages)
+        except BaseException:
+            self.connection.close()
+            raise
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> CMITMessage:
+        return next(self._messages)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        End the subscription, closing its connection.
+        """
+        self.response.close()
+        self.connection.close()
+
+
 class CMITException(Exception):
     pass
 
@@ -377,6 +996,10 @@ class CannotSendRequest(ImproperConnectionState):
     pass
 
 
+class NotConnected(CMITException):
+    pass
+
+
 class LineTooLong(CMITException):
     def __init__(self, line_type):
         CMITException.__init__(self, "got more than %d bytes when reading %s" % (_MAXLINE, line_type))
@@ -388,4 +1011,20 @@ class RemoteDisconnected(ConnectionResetError, BadStatusLine):
         ConnectionResetError.__init__(self, *pos, **kw)
 
 
+class RequestNotProcessed(RemoteDisconnected):
+    pass
+
+
+class StreamError(CMITException):
+    """
+    The server failed to produce a streamed response, its terminator has an error status.
+    """
+
+    def __init__(self, status, reason, msg=None):
+        CMITException.__init__(self, "streamed response ended with %d %s" % (status, reason))
+        self.status = status
+        self.reason = reason
+        self.msg = msg
+
+
 error = CMITException
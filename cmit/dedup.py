@@ -0,0 +1,261 @@
+"""
+Deduplication of retried requests.
+
+Clients retry requests whose response didn't arrive, re-using their ``_id``. For
+the commands in the handler's ``dedup_commands`` (EXECUTE by default) the server
+keeps the response frame of every request in a :class:`ResponseCache`, keyed by
+its command, topic and msg_id. A request with the same key as one already
+handled gets that frame again without running its handler, one still being
+handled is answered with PROCESSING.
+
+Deduplication is opt-in: mix :class:`DedupMixIn` into the server class and set
+``dedup_max_entries`` (0 by default) to the number of frames to keep.
+
+Frames are kept for ``dedup_ttl`` seconds, the least recently used ones are
+evicted beyond ``dedup_max_entries`` frames or ``dedup_max_bytes``. For very high
+volumes, ``dedup_bloom_capacity`` adds a :class:`BloomFilter` remembering the
+msg_ids of evicted frames: their duplicates are answered with DUPLICATE_REQUEST
+rather than handled again. Like any Bloom filter it has false positives, about
+``dedup_bloom_error_rate`` of the new requests reaching the filter.
+
+Responses with a server error status (4xx) aren't cached, so retrying them runs
+the handler again.
+
+The cache lives in the memory of the server process. The workers of a
+:class:`cmit.server.PreforkCMITServer` each have their own, so a retry is only
+deduplicated if it reaches the worker that handled the original request.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class BloomFilter:
+    """
+    Set of strings with false positives, sized for ``capacity`` items at ``error_rate``.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.bits / capacity * math.log(2)), 1)
+        self._array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str):
+        array = self._array
+        return all(array[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+
+# ResponseCache.begin() results besides a cached frame
+IN_PROGRESS = "in progress"
+EVICTED = "evicted"
+
+
+class ResponseCache:
+    """
+    Response frames keyed by request (a string such as its msg_id), evicted by TTL and LRU.
+    """
+
+    bloom_filter_class = BloomFilter
+
+    def __init__(self, max_entries: Optional[int] = 10000, ttl: Optional[float] = 300.0,
+                 max_bytes: Optional[int] = 64 << 20, bloom_capacity: Optional[int] = None,
+                 bloom_error_rate: float = 0.001):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+
+        self._lock = threading.Lock()
+        # msg_id -> (frame, expiry), least recently used first
+        self._frames = OrderedDict()
+        self._in_progress = set()
+        self.bytes = 0
+
+        # The msg_ids of evicted frames go to the current filter, the previous
+        # one is still checked. Filters are rotated once full or ttl old.
+        self._bloom = self._previous_bloom = None
+        self._bloom_started = time.monotonic()
+        if bloom_capacity:
+            self._bloom = self.bloom_filter_class(bloom_capacity, bloom_error_rate)
+
+        self.hits = 0
+        self.misses = 0
+        self.in_progress_hits = 0
+        self.bloom_hits = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def begin(self, msg_id: str):
+        """
+        Claim ``msg_id`` for a new request.
+
+        Return None if the request must be handled, and stored or abandoned once it
+        is. Otherwise return its cached frame, :data:`IN_PROGRESS` while it's still
+        being handled or :data:`EVICTED` if its frame was evicted.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._frames.get(msg_id)
+            if entry is not None:
+                if entry[1] is None or entry[1] > now:
+                    self._frames.move_to_end(msg_id)
+                    self.hits += 1
+                    return entry[0]
+                self._remove(msg_id)
+
+            if msg_id in self._in_progress:
+                self.in_progress_hits += 1
+                return IN_PROGRESS
+
+            if self._bloom is not None and (msg_id in self._bloom or
+                                            (self._previous_bloom is not None and msg_id in self._previous_bloom)):
+                self.bloom_hits += 1
+                return EVICTED
+
+            self.misses += 1
+            self._in_progress.add(msg_id)
+            return None
+
+    def store(self, msg_id: str, frame: bytes):
+        """
+        Cache the response frame of a request claimed with :meth:`begin`.
+        """
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+
+        with self._lock:
+            self._in_progress.discard(msg_id)
+            if self.max_bytes is not None and len(frame) > self.max_bytes:
+                return
+
+            self._remove(msg_id)
+            self._frames[msg_id] = (frame, expiry)
+            self.bytes += len(frame)
+            self._evict()
+
+    def abandon(self, msg_id: str):
+        """
+        Release a request claimed with :meth:`begin` without caching its response.
+        """
+        with self._lock:
+            self._in_progress.discard(msg_id)
+
+    def _remove(self, msg_id):
+        # Must be called with _lock held.
+        entry = self._frames.pop(msg_id, None)
+        if entry is not None:
+            self.bytes -= len(entry[0])
+
+    def _evict(self):
+        # Must be called with _lock held.
+        now = time.monotonic()
+        while self._frames:
+            msg_id, (frame, expiry) = next(iter(self._frames.items()))
+            if expiry is not None and expiry <= now:
+                # Retries after the TTL are handled again
+                self._remove(msg_id)
+            elif (self.max_entries is not None and len(self._frames) > self.max_entries) or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self._remove(msg_id)
+                self.evicted += 1
+                if self._bloom is not None:
+                    self._remember(msg_id, now)
+            else:
+                break
+
+    def _remember(self, msg_id, now):
+        # Must be called with _lock held.
+        if len(self._bloom) >= self.bloom_capacity or \
+                (self.ttl is not None and now - self._bloom_started > self.ttl):
+            self._previous_bloom = self._bloom
+            self._bloom = self.bloom_filter_class(self.bloom_capacity, self.bloom_error_rate)
+            self._bloom_started = now
+        self._bloom.add(msg_id)
+
+    def stats(self) -> dict:
+        """
+        Return the number of frames and bytes cached, and how duplicates were answered so far.
+        """
+        with self._lock:
+            return {
+                "frames": len(self._frames),
+                "bytes": self.bytes,
+                "in_progress": len(self._in_progress),
+                "hits": self.hits,
+                "misses": self.misses,
+                "in_progress_hits": self.in_progress_hits,
+                "bloom_hits": self.bloom_hits,
+                "evicted": self.evicted,
+            }
+
+
+class DedupMixIn:
+    """
+    Mix-in class giving a server a :class:`ResponseCache`.
+
+    The cache is per process, it doesn't deduplicate retries across pre-forked workers.
+    """
+
+    response_cache_class = ResponseCache
+
+    # Frames kept at most, None for no limit and 0 (the default) to disable deduplication
+    dedup_max_entries = 0
+
+    # Seconds frames are kept, None to keep them until evicted
+    dedup_ttl = 300.0
+
+    # Bytes of frames kept at most, None for no limit
+    dedup_max_bytes = 64 << 20
+
+    # msg_ids of evicted frames remembered by the Bloom filter, None for no filter
+    dedup_bloom_capacity = None
+    dedup_bloom_error_rate = 0.001
+
+    response_cache = None
+
+    def get_response_cache(self) -> Optional[ResponseCache]:
+        """
+        Return the server's ResponseCache, creating it on first use. None if deduplication is disabled.
+        """
+        if self.dedup_max_entries == 0:
+            return None
+
+        cache = self.response_cache
+        if cache is None:
+            with _response_cache_lock:
+                if self.response_cache is None:
+                    self.response_cache = self.response_cache_class(
+                        self.dedup_max_entries, self.dedup_ttl, self.dedup_max_bytes,
+                        self.dedup_bloom_capacity, self.dedup_bloom_error_rate
+                    )
+                cache = self.response_cache
+        return cache
+
+
+_response_cache_lock = threading.Lock()
+
+
+__all__ = ["BloomFilter", "DedupMixIn", "EVICTED", "IN_PROGRESS", "ResponseCache"]
@@ -0,0 +1,463 @@
+"""
+Durable journal of accepted tasks.
+
+Tasks queued in memory are lost when the server restarts. A :class:`TaskJournal`
+appends every accepted task to segment files in a directory, and replays the
+tasks not completed yet when it's opened again. Servers get one by mixing in
+:class:`JournalMixIn`::
+
+    class DemoServer(JournalMixIn, server.ThreadingCMITServer):
+        journal_directory = "/var/lib/demo/journal"
+
+    journal = demo_server.get_journal()
+    journal.append(handler.msg.msg_id, {"topic": handler.msg.topic, "payload": handler.msg.payload})
+    ...
+    journal.complete(msg_id)
+
+    # After a restart
+    for msg_id, task in demo_server.get_journal().pending():
+        requeue(msg_id, task)
+
+Segments are preallocated files of ``segment_size`` bytes, memory-mapped: an
+append is a copy into the page cache, with no system call, so it survives the
+process crashing. When the pages reach the disk depends on the ``fsync`` policy:
+
+- ``"always"``: every append is written to disk (``msync``) before returning.
+- ``"group"``: appends return at once, a background thread writes them to disk
+  ``commit_interval`` seconds after the first one, along with those written
+  meanwhile. At most that much is lost on power failure. The thread sleeps
+  while nothing is appended.
+- ``"os"``: the kernel writes the pages back whenever it sees fit.
+
+Every record carries a CRC32, a record torn by a crash ends the replay of its
+segment. Completing a task appends a record as well. Once a segment other than
+the one being written holds no pending task, and neither do the older ones, it's
+deleted; the pending tasks of old, mostly completed segments are appended again
+so that they can be (see :meth:`TaskJournal.compact`).
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import Any, Iterator, Optional, Tuple
+
+FSYNC_POLICIES = ("always", "group", "os")
+
+# Record header: length of the body, CRC32 of the type and body, type
+_HEADER = struct.Struct("<IIB")
+
+# The body of an append record is the length of the msg_id, the msg_id and the JSON task
+_ID_LENGTH = struct.Struct("<H")
+
+_encode_task = json.JSONEncoder(separators=(",", ":")).encode
+
+_APPEND = 1
+_COMPLETE = 2
+
+# CRC32 of the type byte, the CRC of a record continues over its body
+_TYPE_CRC = {kind: zlib.crc32(bytes((kind,))) for kind in (_APPEND, _COMPLETE)}
+
+_SUFFIX = ".journal"
+
+
+class JournalError(Exception):
+    """A journal record can't be written."""
+
+
+class _Segment:
+
+    __slots__ = ("index", "path", "fd", "mm", "size", "offset", "live", "records", "dirty_from")
+
+    def __init__(self, index, path, size):
+        self.index = index
+        self.path = path
+        self.size = size
+        # Offset of the next record
+        self.offset = 0
+        # Pending tasks whose last copy is in this segment, and tasks appended to it
+        self.live = 0
+        self.records = 0
+        # Offset from which appends weren't written to disk yet, None if there are none
+        self.dirty_from = None
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(self.fd).st_size < size:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(self.fd, 0, size)
+                else:
+                    os.ftruncate(self.fd, size)
+            self.mm = mmap.mmap(self.fd, size)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def records_from(self, offset=0) -> Iterator[Tuple[int, int, bytes]]:
+        # Yield the (end offset, type, body) of the valid records, up to the first torn or empty one
+        mm = self.mm
+        while offset + _HEADER.size <= self.size:
+            length, crc, kind = _HEADER.unpack_from(mm, offset)
+            if kind not in _TYPE_CRC:
+                return
+
+            end = offset + _HEADER.size + length
+            if end > self.size:
+                return
+
+            body = mm[offset + _HEADER.size:end]
+            if zlib.crc32(body, _TYPE_CRC[kind]) != crc:
+                return
+
+            yield end, kind, body
+            offset = end
+
+    def flush(self, start, end):
+        # Write the records between two offsets to disk, the start of a flush must be page aligned
+        start -= start % mmap.ALLOCATIONGRANULARITY
+        self.mm.flush(start, end - start)
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+
+class TaskJournal:
+    """
+    Append-only journal of pending tasks, on memory-mapped segment files.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 64 << 20, fsync: str = "group",
+                 commit_interval: float = 0.005, compact_ratio: float = 0.25):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync!r}")
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.commit_interval = commit_interval
+        # Sealed segments with a smaller share of pending tasks are compacted
+        self.compact_ratio = compact_ratio
+
+        self._lock = threading.Lock()
+        # Held while writing to disk, so that segments aren't closed meanwhile
+        self._sync_lock = threading.Lock()
+        self._segments = []
+        # msg_id -> (segment of its last copy, task), in the order the tasks were appended
+        self._pending = {}
+        self._closed = False
+        # Whether records were written since the committer last synced, notified when one is
+        self._unsynced = False
+        self._written = threading.Condition(self._lock)
+
+        self.appended = 0
+        self.completed = 0
+        self.compacted = 0
+        self.removed = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._replay()
+
+        self._committer = None
+        if fsync == "group":
+            self._committer = threading.Thread(target=self._commit_loop, name="cmit-journal", daemon=True)
+            self._committer.start()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, msg_id):
+        return msg_id in self._pending
+
+    def _replay(self):
+        indexes = sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(self.directory)
+                         if name.endswith(_SUFFIX) and name[:-len(_SUFFIX)].isdigit())
+
+        for index in indexes:
+            segment = _Segment(index, self._segment_path(index), self.segment_size)
+            self._segments.append(segment)
+
+            for end, kind, body in segment.records_from():
+                segment.offset = end
+                if kind == _APPEND:
+                    msg_id, task = _decode_append(body)
+                    self._place(msg_id, segment, task)
+                    segment.records += 1
+                else:
+                    self._remove(body.decode("utf-8"))
+
+        if not self._segments:
+            self._segments.append(self._new_segment(0))
+
+        self._collect()
+
+    def _segment_path(self, index):
+        return os.path.join(self.directory, "%016d%s" % (index, _SUFFIX))
+
+    def _new_segment(self, index):
+        return _Segment(index, self._segment_path(index), self.segment_size)
+
+    def _place(self, msg_id, segment, task):
+        # Must be called with _lock held, or while replaying.
+        previous = self._pending.get(msg_id)
+        if previous is not None:
+            previous[0].live -= 1
+        self._pending[msg_id] = (segment, task)
+        segment.live += 1
+
+    def _remove(self, msg_id):
+        # Must be called with _lock held, or while replaying.
+        entry = self._pending.pop(msg_id, None)
+        if entry is not None:
+            entry[0].live -= 1
+        return entry
+
+    def append(self, msg_id: str, task: Any = None):
+        """
+        Record a pending task, ``task`` must be JSON serializable.
+
+        Raise :class:`JournalError` if the record doesn't fit in a segment.
+        """
+        body = _encode_append(msg_id, task)
+
+        with self._lock:
+            segment = self._write(_APPEND, body)
+            self._place(msg_id, segment, task)
+            segment.records += 1
+            self.appended += 1
+
+        if self.fsync == "always":
+            self.sync()
+
+    def complete(self, msg_id: str):
+        """
+        Record that a task is done, so it isn't replayed. Tasks not in the journal are ignored.
+        """
+        with self._lock:
+            if self._remove(msg_id) is None:
+                return
+            self._write(_COMPLETE, msg_id.encode("utf-8"))
+            self.completed += 1
+            self._collect()
+
+        if self.fsync == "always":
+            self.sync()
+
+    def _write(self, kind, body):
+        # Must be called with _lock held. Return the segment the record was written to.
+        if self._closed:
+            raise JournalError("The journal is closed")
+
+        size = _HEADER.size + len(body)
+        if size > self.segment_size:
+            raise JournalError(f"Record of {size} bytes exceeds the segment size")
+
+        segment = self._segments[-1]
+        if segment.offset + size > segment.size:
+            segment = self._roll()
+
+        offset = segment.offset
+        segment.mm[offset + _HEADER.size:offset + size] = body
+        # The header goes last, a record cut short by a crash reads as the end of the segment
+        _HEADER.pack_into(segment.mm, offset, len(body), zlib.crc32(body, _TYPE_CRC[kind]), kind)
+        segment.offset = offset + size
+        if segment.dirty_from is None:
+            segment.dirty_from = offset
+        if not self._unsynced:
+            self._unsynced = True
+            self._written.notify()
+        return segment
+
+    def _roll(self):
+        # Must be called with _lock held. Start a new segment, the previous one is sealed.
+        sealed = self._segments[-1]
+        if self.fsync != "os" and sealed.dirty_from is not None:
+            with self._sync_lock:
+                sealed.flush(sealed.dirty_from, sealed.offset)
+            sealed.dirty_from = None
+
+        segment = self._new_segment(sealed.index + 1)
+        self._segments.append(segment)
+        self._compact()
+        self._collect()
+        return segment
+
+    def compact(self):
+        """
+        Append again the pending tasks of sealed segments that are mostly completed, and delete the segments left empty.
+        """
+        with self._lock:
+            self._compact()
+            self._collect()
+
+    def _compact(self):
+        # Must be called with _lock held. Moving the pending tasks of the oldest segments
+        # first lets _collect() delete them, only the oldest segments can be deleted.
+        active = self._segments[-1]
+        for segment in self._segments[:-1]:
+            if segment.live > segment.records * self.compact_ratio:
+                break
+
+            for msg_id, (owner, task) in list(self._pending.items()):
+                if owner is segment:
+                    body = _encode_append(msg_id, task)
+                    if active.offset + _HEADER.size + len(body) > active.size:
+                        # No room left, the next roll goes on
+                        return
+                    self._write(_APPEND, body)
+                    self._place(msg_id, active, task)
+                    active.records += 1
+                    self.compacted += 1
+
+    def _collect(self):
+        # Must be called with _lock held. Delete the oldest sealed segments without pending
+        # tasks: a completion record may only go if the task it completes is gone too.
+        while len(self._segments) > 1 and self._segments[0].live == 0:
+            segment = self._segments.pop(0)
+            with self._sync_lock:
+                segment.close()
+            try:
+                os.unlink(segment.path)
+            except FileNotFoundError:
+                pass
+            self.removed += 1
+
+    def pending(self) -> list:
+        """
+        Return the ``(msg_id, task)`` of the tasks not completed yet, in the order they were appended.
+        """
+        with self._lock:
+            return [(msg_id, task) for msg_id, (_, task) in self._pending.items()]
+
+    def sync(self):
+        """
+        Write the records appended so far to disk.
+        """
+        with self._lock:
+            dirty = []
+            for segment in self._segments:
+                if segment.dirty_from is not None:
+                    dirty.append((segment, segment.dirty_from, segment.offset))
+                    segment.dirty_from = None
+
+        with self._sync_lock:
+            for segment, start, end in dirty:
+                if not segment.mm.closed:
+                    segment.flush(start, end)
+
+    def _commit_loop(self):
+        while True:
+            with self._written:
+                # Idle until a record is written
+                self._written.wait_for(lambda: self._unsynced or self._closed)
+                if self._closed:
+                    return
+                # The records written within commit_interval go to disk together,
+                # close() ends the wait early
+                self._written.wait(self.commit_interval)
+                self._unsynced = False
+
+            try:
+                self.sync()
+            except (OSError, ValueError):
+                # Closed meanwhile
+                pass
+
+    def close(self):
+        """
+        Write the records to disk and close the segment files.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._written.notify_all()
+
+        if self._committer is not None:
+            self._committer.join()
+
+        self.sync()
+        with self._sync_lock:
+            for segment in self._segments:
+                segment.close()
+
+    def stats(self) -> dict:
+        """
+        Return the number of pending tasks and segments, and the records written so far.
+        """
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "segments": len(self._segments),
+                "appended": self.appended,
+                "completed": self.completed,
+                "compacted": self.compacted,
+                "removed": self.removed,
+            }
+
+
+def _encode_append(msg_id, task):
+    msg_id = msg_id.encode("utf-8")
+    return _ID_LENGTH.pack(len(msg_id)) + msg_id + _encode_task(task).encode("utf-8")
+
+
+def _decode_append(body):
+    end = _ID_LENGTH.size + _ID_LENGTH.unpack_from(body)[0]
+    return body[_ID_LENGTH.size:end].decode("utf-8"), json.loads(body[end:])
+
+
+class JournalMixIn:
+    """
+    Mix-in class giving a server a :class:`TaskJournal`.
+    """
+
+    journal_class = TaskJournal
+
+    # Directory of the segment files, None to disable the journal
+    journal_directory: Optional[str] = None
+
+    # Size of a segment file, records larger than that are rejected
+    journal_segment_size = 64 << 20
+
+    # When appends are written to disk, see cmit.journal
+    journal_fsync = "group"
+    journal_commit_interval = 0.005
+
+    journal = None
+
+    def get_journal(self) -> Optional[TaskJournal]:
+        """
+        Return the server's TaskJournal, opening it (and replaying it) on first use. None if the journal is disabled.
+        """
+        if self.journal_directory is None:
+            return None
+
+        journal = self.journal
+        if journal is None:
+            with _journal_lock:
+                if self.journal is None:
+                    self.journal = self.journal_class(
+                        self.journal_directory, self.journal_segment_size, self.journal_fsync,
+                        self.journal_commit_interval
+                    )
+                journal = self.journal
+        return journal
+
+    def close_journal(self):
+        """
+        Close the journal, its pending tasks are replayed when it's opened again.
+        """
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def server_close(self):
+        super().server_close()
+        self.close_journal()
+
+
+_journal_lock = threading.Lock()
+
+
+__all__ = ["FSYNC_POLICIES", "JournalError", "JournalMixIn", "TaskJournal"]
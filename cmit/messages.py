@@ -11,17 +11,40 @@ from .typing import PayloadType, TopicType
 from .utils import encode as _encode
 
 
+def _is_priority(value):
+    # A priority class is given by name or index, if at all
+    return value is None or isinstance(value, str) or (isinstance(value, int) and not isinstance(value, bool))
+
+
+def _is_deadline(value):
+    # A deadline is a POSIX timestamp, if any
+    return value is None or (isinstance(value, (int, float)) and not isinstance(value, bool))
+
+
 class CMITMessage(object):
     """
     Base class for all messages sent to and from the CMIT protocol server.
     """
 
-    __slots__ = ["timestamp", "msg_id", "_topic", "_payload"]
+    __slots__ = ["timestamp", "msg_id", "_topic", "_payload", "window", "deadline", "priority", "more", "offset", "oob"]
 
     def __init__(self, topic: TopicType, msg_id="0"):
         self.timestamp = datetime.utcnow()
         self.msg_id = msg_id
         self._payload = b""
+        # Number of requests the client may have outstanding on the connection,
+        # advertised by the server in responses on persistent connections.
+        self.window = None
+        # POSIX time after which the client no longer waits for the response to a request.
+        self.deadline = None
+        # Priority class of the task requested, by name or index (see cmit.scheduling).
+        self.priority = None
+        # Set on the frames of a streamed response: True on every chunk, False on the terminator.
+        self.more = None
+        # Offset of a message in the log of its topic, set on the messages of FETCH responses.
+        self.offset = None
+        # Size of a payload passed out-of-band, in a memory file sent along the request (see cmit.oob).
+        self.oob = None
         if isinstance(topic, bytes):
             self._topic = topic
         elif isinstance(topic, str):
@@ -60,6 +83,24 @@ class CMITMessage(object):
             "payload": self.payload
         }
 
+        if self.window is not None:
+            msg["window"] = self.window
+
+        if self.deadline is not None:
+            msg["deadline"] = self.deadline
+
+        if self.priority is not None:
+            msg["priority"] = self.priority
+
+        if self.more is not None:
+            msg["more"] = self.more
+
+        if self.offset is not None:
+            msg["offset"] = self.offset
+
+        if self.oob is not None:
+            msg["oob"] = self.oob
+
         return json.dumps(msg, indent=indent)
 
     @classmethod
@@ -87,6 +128,16 @@ class CMITMessage(object):
         m = cls(decoded_msg["topic"], msg_id=decoded_msg["_id"])
         m.payload = decoded_msg["payload"]
         m.timestamp = datetime.fromtimestamp(decoded_msg["timestamp"])
+        m.window = decoded_msg.get("window")
+        m.deadline = decoded_msg.get("deadline")
+        if not _is_deadline(m.deadline):
+            raise ValueError(f"Invalid deadline: {m.deadline!r}")
+        m.priority = decoded_msg.get("priority")
+        if not _is_priority(m.priority):
+            raise ValueError(f"Invalid priority: {m.priority!r}")
+        m.more = decoded_msg.get("more")
+        m.offset = decoded_msg.get("offset")
+        m.oob = decoded_msg.get("oob")
         return m
 
     @property
@@ -117,7 +168,14 @@ class CMITMessage(object):
 
     @property
     def payload(self):
-        return self._payload.decode("utf-8")
+        return str(self._payload, "utf-8")
+
+    @property
+    def payload_view(self) -> memoryview:
+        """
+        The encoded payload, without copying it, e.g. a payload passed out-of-band.
+        """
+        return memoryview(self._payload)
 
     @payload.setter
     def payload(self, value: PayloadType):
@@ -126,6 +184,8 @@ class CMITMessage(object):
                 payload = _encode(value, 'payload')
             elif isinstance(value, bytes):
                 payload = value
+            elif isinstance(value, (bytearray, memoryview)):
+                payload = memoryview(value)
             elif callable(value):
                 payload = _encode(value(), 'payload')
             else:
@@ -0,0 +1,489 @@
+"""
+Process-pool offloading of CPU-bound handlers.
+
+Handlers run on the server's threads (or event loop), so pure Python work in
+``do_EXECUTE`` holds the GIL and stalls every other connection. Functions
+offloaded for a topic pattern (see :mod:`cmit.routing` for the syntax) run in a
+pool of worker processes instead, on servers mixing in :class:`OffloadMixIn`::
+
+    class DemoServer(OffloadMixIn, ResultStoreMixIn, server.ThreadingCMITServer):
+        pass
+
+    demo_server = DemoServer(SOCKET_PATH, server.SimpleCMITRequestHandler)
+
+    @demo_server.offload("reports.#", wait=True, timeout=30.0)
+    def render_report(msg):
+        return {"pages": build_pages(msg.payload)}
+
+The function receives the decoded :class:`cmit.messages.CMITMessage` of the
+request, it must therefore be importable by the workers (defined at module level)
+and both the message and its result must be picklable. With ``wait=True`` the
+result is the payload of an OK response; otherwise the request is answered with
+ACCEPTED as soon as it's submitted and the result is handed to the server's
+:meth:`OffloadMixIn.task_done`, which records it in the server's result store if
+it has one (see :mod:`cmit.results`). A ``str`` or ``bytes`` result too large for a single
+response line is streamed, the client joins the payloads of its frames::
+
+    response = session.execute(fp, "reports.monthly")
+    report = "".join(msg.payload for msg in response.iter_messages())
+
+Tasks running longer than their ``timeout`` (or past the deadline of the request)
+are interrupted with :class:`OffloadTimeout` and answered with GATEWAY_TIMEOUT.
+Workers are replaced after ``offload_max_tasks_per_child`` tasks. ``str`` and
+``bytes`` results of at least ``offload_shm_threshold`` bytes are handed back
+through :mod:`multiprocessing.shared_memory` rather than pickled through the
+pool's pipe (Python 3.8+).
+"""
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, NamedTuple, Optional
+
+from cmit import CMITStatus
+from cmit.messages import CMITMessage
+from cmit.routing import RoutingMixIn
+from cmit.utils import send_message
+
+
+class OffloadTimeout(Exception):
+    """An offloaded task ran longer than its timeout."""
+
+
+class _SharedResult(NamedTuple):
+    # A result left in a shared memory block by a worker.
+    name: str
+    size: int
+    text: bool
+
+
+def _interrupt_task(signum, frame):
+    raise OffloadTimeout("Offloaded task timed out")
+
+
+def _run_task(func, msg, timeout, shm_threshold):
+    # Runs in the worker process, interrupted by SIGALRM after timeout seconds.
+    if timeout is not None:
+        signal.signal(signal.SIGALRM, _interrupt_task)
+        signal.setitimer(signal.ITIMER_REAL, max(timeout, 0.001))
+    try:
+        result = func(msg)
+    finally:
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    if shm_threshold is None or not isinstance(result, (str, bytes, bytearray)) or len(result) < shm_threshold:
+        return result
+
+    from multiprocessing import shared_memory
+
+    text = isinstance(result, str)
+    data = result.encode("utf-8") if text else result
+
+    shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    try:
+        shm.buf[:len(data)] = data
+    finally:
+        shm.close()
+    return _SharedResult(shm.name, len(data), text)
+
+
+def _shutdown_executor(executor, wait):
+    # Pending tasks are cancelled where the executor can (Python 3.9+).
+    if sys.version_info >= (3, 9):
+        executor.shutdown(wait=wait, cancel_futures=True)
+    else:
+        executor.shutdown(wait=wait)
+
+
+def _running_loop():
+    # The event loop of the calling thread, if any (asyncio.get_running_loop() is Python 3.7+).
+    try:
+        return asyncio.get_running_loop()
+    except (AttributeError, RuntimeError):
+        return None
+
+
+def _collect_result(result):
+    # Copy a shared memory result out of its block, which is then released.
+    if not isinstance(result, _SharedResult):
+        return result
+
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=result.name)
+    try:
+        data = bytes(shm.buf[:result.size])
+    finally:
+        shm.close()
+        shm.unlink()
+    return data.decode("utf-8") if result.text else data
+
+
+class ProcessOffloader:
+    """
+    Pool of worker processes running offloaded tasks.
+
+    The pool is started on the first submitted task. ``max_tasks_per_child``
+    recycles workers after that many tasks, ``mp_context`` names the
+    :mod:`multiprocessing` start method of the workers (Python 3.7+, the default
+    one is used before). ``shm_threshold`` is ignored before Python 3.8.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, max_tasks_per_child: Optional[int] = None,
+                 mp_context: str = "forkserver", shm_threshold: Optional[int] = 1 << 20):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_tasks_per_child = max_tasks_per_child
+        self.mp_context = mp_context
+        # multiprocessing.shared_memory is Python 3.8+
+        self.shm_threshold = shm_threshold if sys.version_info >= (3, 8) else None
+
+        self._lock = threading.Lock()
+        self._executor = None
+        # Tasks submitted to the current executor, to recycle it as a whole
+        # where ProcessPoolExecutor can't recycle single workers.
+        self._executor_tasks = 0
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.recycled = 0
+
+    def __repr__(self):
+        return '<%s %d workers>' % (self.__class__.__name__, self.max_workers)
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        # Must be called with _lock held.
+        if self._executor is not None and getattr(self._executor, "_broken", False):
+            # A worker died, the pool refuses any further task
+            self._discard_executor()
+
+        if self._executor is not None and self.max_tasks_per_child and sys.version_info < (3, 11):
+            if self._executor_tasks >= self.max_tasks_per_child * self.max_workers:
+                self._discard_executor()
+
+        if self._executor is None:
+            kwargs = {}
+            if sys.version_info >= (3, 7):
+                kwargs["mp_context"] = multiprocessing.get_context(self.mp_context)
+            if self.max_tasks_per_child and sys.version_info >= (3, 11):
+                kwargs["max_tasks_per_child"] = self.max_tasks_per_child
+
+            self._executor = concurrent.futures.ProcessPoolExecutor(self.max_workers, **kwargs)
+            self._executor_tasks = 0
+
+        self._executor_tasks += 1
+        return self._executor
+
+    def _discard_executor(self):
+        # Must be called with _lock held.
+        self._executor.shutdown(wait=False)
+        self._executor = None
+        self.recycled += 1
+
+    def submit(self, func: Callable, msg: CMITMessage, timeout: Optional[float] = None) -> concurrent.futures.Future:
+        """
+        Run ``func(msg)`` on a worker, interrupting it after ``timeout`` seconds.
+
+        The returned future resolves to the result of the function, shared memory
+        results are already copied out of their block. Raise :class:`BrokenProcessPool`
+        if no worker can be started.
+        """
+        result = concurrent.futures.Future()
+
+        with self._lock:
+            try:
+                task = self._get_executor().submit(_run_task, func, msg, timeout, self.shm_threshold)
+            except BrokenProcessPool:
+                # The pool broke since the last task, it's replaced once
+                self._discard_executor()
+                task = self._get_executor().submit(_run_task, func, msg, timeout, self.shm_threshold)
+            self.submitted += 1
+
+        def done(task):
+            try:
+                value = _collect_result(task.result())
+            except BaseException as e:
+                with self._lock:
+                    self.failed += 1
+                    if isinstance(e, OffloadTimeout):
+                        self.timed_out += 1
+                result.set_exception(e)
+            else:
+                with self._lock:
+                    self.completed += 1
+                result.set_result(value)
+
+        task.add_done_callback(done)
+        return result
+
+    def recycle(self):
+        """
+        Replace every worker, terminating the tasks they are running.
+
+        Used when a task doesn't return after its timeout, e.g. while stuck in C code
+        the timeout signal can't interrupt. Other tasks of the pool fail with
+        :class:`BrokenProcessPool`.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+            if executor is None:
+                return
+            self.recycled += 1
+
+        processes = list((getattr(executor, "_processes", None) or {}).values())
+        _shutdown_executor(executor, False)
+        for process in processes:
+            process.terminate()
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers, once their current tasks are done if ``wait``.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            _shutdown_executor(executor, wait)
+
+    def stats(self) -> dict:
+        """
+        Return the number of tasks submitted, completed and failed so far.
+        """
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "submitted": self.submitted,
+                "in_flight": self.submitted - self.completed - self.failed,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timed_out": self.timed_out,
+                "recycled": self.recycled,
+            }
+
+
+class OffloadedRoute:
+    """
+    Route submitting the message of a request to the server's :class:`ProcessOffloader`.
+    """
+
+    # Extra seconds given to a task past its timeout before its workers are recycled
+    kill_grace = 5.0
+
+    # Size of the largest response line, results that don't fit are streamed
+    max_result_line = 63 << 10
+
+    # Characters per frame of a streamed result, small enough for a line however they're escaped
+    result_chunk_size = 4 << 10
+
+    def __init__(self, server, func: Callable, wait: bool = False, timeout: Optional[float] = None):
+        self.server = server
+        self.func = func
+        self.wait = wait
+        self.timeout = timeout
+        functools.update_wrapper(self, func)
+
+    def task_timeout(self, msg: CMITMessage) -> Optional[float]:
+        """
+        Return the seconds ``msg`` may run for: the route's timeout, bounded by the request's deadline.
+        """
+        timeout = self.timeout
+        if msg.deadline is not None:
+            remaining = msg.deadline - time.time()
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def __call__(self, handler):
+        msg = handler.msg
+        timeout = self.task_timeout(msg)
+        try:
+            future = self.server.get_offloader().submit(self.func, msg, timeout)
+        except BrokenProcessPool as e:
+            handler.logger.error(f"Offloaded task {msg.msg_id} couldn't be submitted: {e!r}")
+            handler.send_error(CMITStatus.BAD_GATEWAY, topic=msg.topic, msg_id=msg.msg_id)
+            return None
+
+        if not self.wait:
+            self.server.task_submitted(msg)
+            future.add_done_callback(functools.partial(self.server.task_done, msg))
+
+            response = CMITMessage(msg.topic, msg.msg_id)
+            response.payload = {"res": "Offloaded"}
+            send_message(handler, CMITStatus.ACCEPTED, response)
+            return None
+
+        wait_timeout = None if timeout is None else timeout + self.kill_grace
+
+        if _running_loop() is not None:
+            return self._await_result(handler, future, wait_timeout)
+
+        try:
+            result = future.result(wait_timeout)
+        except BaseException as e:
+            self.task_failed(handler, future, e)
+        else:
+            self.send_result(handler, result)
+
+    async def _await_result(self, handler, future, wait_timeout):
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), wait_timeout)
+        except asyncio.TimeoutError as e:
+            self.task_failed(handler, future, concurrent.futures.TimeoutError(e))
+        except Exception as e:
+            self.task_failed(handler, future, e)
+        else:
+            sent = self.send_result(handler, result)
+            if asyncio.iscoroutine(sent):
+                await sent
+
+    def send_result(self, handler, result):
+        """
+        Answer the request with the result of its task.
+
+        A ``str`` or ``bytes`` result too large for a single response line is streamed
+        in frames of ``result_chunk_size`` characters, whose payloads the client joins.
+        Return what the handler's send_stream() returns, if it's called.
+        """
+        response = CMITMessage(handler.msg.topic, handler.msg.msg_id)
+        response.payload = result
+
+        if isinstance(result, (str, bytes, bytearray)) and len(result) > self.result_chunk_size and \
+                (len(result) >= self.max_result_line or len(response()) >= self.max_result_line):
+            if not handler.allow_streaming:
+                handler.send_error(CMITStatus.INTERNAL_SERVER_ERROR, "Offloaded result too large",
+                                   "The result can't be streamed in a batch", topic=handler.msg.topic,
+                                   msg_id=handler.msg.msg_id)
+                return None
+
+            if not isinstance(result, str):
+                result = bytes(result).decode("utf-8", "replace")
+            size = self.result_chunk_size
+            return handler.send_stream(CMITStatus.OK, (result[i:i + size] for i in range(0, len(result), size)))
+
+        send_message(handler, CMITStatus.OK, response)
+        return None
+
+    def task_failed(self, handler, future, error):
+        if isinstance(error, concurrent.futures.TimeoutError) and not future.done():
+            # The worker ignored the timeout signal
+            self.server.get_offloader().recycle()
+            error = OffloadTimeout("Offloaded task timed out")
+
+        if isinstance(error, OffloadTimeout):
+            handler.send_error(CMITStatus.GATEWAY_TIMEOUT, topic=handler.msg.topic, msg_id=handler.msg.msg_id)
+        elif isinstance(error, BrokenProcessPool):
+            handler.send_error(CMITStatus.BAD_GATEWAY, topic=handler.msg.topic, msg_id=handler.msg.msg_id)
+        else:
+            handler.logger.error(f"Offloaded task {handler.msg.msg_id} failed: {error!r}")
+            handler.send_error(
+                CMITStatus.INTERNAL_SERVER_ERROR, topic=handler.msg.topic, msg_id=handler.msg.msg_id
+            )
+
+
+class OffloadMixIn(RoutingMixIn):
+    """
+    Mix-in class running handlers of some topics on a :class:`ProcessOffloader`.
+
+    The offloaded functions are routes of the server, see :class:`cmit.routing.RoutingMixIn`.
+    """
+
+    offloader_class = ProcessOffloader
+    offloaded_route_class = OffloadedRoute
+
+    # Number of worker processes, defaults to the number of CPUs
+    offload_workers = None
+
+    # Tasks run by a worker process before it's replaced, None to keep workers
+    offload_max_tasks_per_child = None
+
+    # multiprocessing start method of the workers
+    offload_mp_context = "forkserver"
+
+    # Size from which str and bytes results go through shared memory, None to always pickle them
+    offload_shm_threshold = 1 << 20
+
+    offloader = None
+
+    def offload(self, pattern: str, command: Optional[str] = "EXECUTE", wait: bool = False,
+                timeout: Optional[float] = None):
+        """
+        Decorator running the decorated function on a worker process for the requests matching ``pattern``.
+
+        See :mod:`cmit.offload`.
+        """
+
+        def decorator(func):
+            self.route(pattern, command)(self.offloaded_route_class(self, func, wait, timeout))
+            return func
+
+        return decorator
+
+    def get_offloader(self) -> ProcessOffloader:
+        """
+        Return the server's ProcessOffloader, creating it on first use.
+        """
+        offloader = self.offloader
+        if offloader is None:
+            with _offloader_lock:
+                if self.offloader is None:
+                    self.offloader = self.offloader_class(
+                        self.offload_workers, self.offload_max_tasks_per_child,
+                        self.offload_mp_context, self.offload_shm_threshold
+                    )
+                offloader = self.offloader
+        return offloader
+
+    def task_submitted(self, msg: CMITMessage):
+        """
+        Called when an offloaded task answered with ACCEPTED is submitted. May be overridden.
+
+        The task is recorded as queued in the server's result store, if it has one.
+        """
+        get_result_store = getattr(self, "get_result_store", None)
+        if get_result_store is not None:
+            get_result_store().add(msg.msg_id, msg.topic)
+
+    def task_done(self, msg: CMITMessage, future: concurrent.futures.Future):
+        """
+        Called with the future of an offloaded task answered with ACCEPTED once it's done. May be overridden.
+
+        The result, or the failure, is stored in the server's result store, if it has one.
+        """
+        error = future.exception()
+        if error is not None:
+            self.logger.error(f"Offloaded task {msg.msg_id} ({msg.topic}) failed: {error!r}")
+
+        get_result_store = getattr(self, "get_result_store", None)
+        if get_result_store is None:
+            return
+
+        if error is not None:
+            get_result_store().fail(msg.msg_id, repr(error))
+        else:
+            result = future.result()
+            if isinstance(result, (bytes, bytearray)):
+                result = result.decode("utf-8", "replace")
+            get_result_store().complete(msg.msg_id, result)
+
+    def close_offloader(self):
+        """
+        Stop the worker processes, if they were started.
+        """
+        if self.offloader is not None:
+            self.offloader.shutdown()
+
+    def server_close(self):
+        super().server_close()
+        self.close_offloader()
+
+
+_offloader_lock = threading.Lock()
+
+
+__all__ = ["OffloadMixIn", "OffloadTimeout", "OffloadedRoute", "ProcessOffloader"]
@@ -0,0 +1,131 @@
+"""
+Out-of-band payloads.
+
+A payload sent in a request is JSON encoded, embedded in the message, base64
+encoded and read back line by line: a large one is copied and inflated several
+times. Over a UNIX socket it can be passed out-of-band instead. The client
+writes it once into an anonymous memory file (``memfd_create``), seals the file
+so that it can no longer change, and sends its descriptor along with the request
+(``SCM_RIGHTS``). The message of the request carries the size of the payload in
+its ``oob`` field and an empty payload.
+
+The server maps the file read-only and sets the mapping as the payload of the
+message, :attr:`CMITMessage.payload_view` gives it as a memoryview without
+copying it::
+
+    connection = CMITConnection("/tmp/cmit.sock")
+    connection.oob_threshold = 32 << 10
+    connection.request("EXECUTE", "images.resize", image_bytes)
+
+    # In the handler
+    digest = hashlib.sha256(self.msg.payload_view).hexdigest()
+
+Only the threading, thread pool and pre-fork servers receive descriptors, the
+asyncio and reactor servers answer such requests with BAD_REQUEST. Sending them
+needs Linux and Python 3.8+ (``os.memfd_create``).
+"""
+import array
+import fcntl
+import io
+import mmap
+import os
+import socket
+from collections import deque
+
+# Seals the sender sets, and the receiver requires: the file can't change size or content anymore.
+# They're only defined on Linux, elsewhere out-of-band payloads can't be sent or received.
+_SEALS = sum(getattr(fcntl, name, 0) for name in ("F_SEAL_SHRINK", "F_SEAL_GROW", "F_SEAL_WRITE", "F_SEAL_SEAL"))
+_REQUIRED_SEALS = getattr(fcntl, "F_SEAL_SHRINK", 0) | getattr(fcntl, "F_SEAL_WRITE", 0)
+
+# Descriptors received with a single read at most, the kernel closes any beyond
+_MAX_FDS = 16
+_FDS_SIZE = array.array("i").itemsize
+
+
+def memfd_payload(data) -> int:
+    """
+    Return the descriptor of a sealed memory file holding ``data``, a bytes-like object.
+    """
+    fd = os.memfd_create("cmit-payload", os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+    try:
+        view = memoryview(data).cast("B")
+        written = 0
+        while written < len(view):
+            written += os.write(fd, view[written:])
+        fcntl.fcntl(fd, fcntl.F_ADD_SEALS, _SEALS)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def map_payload(fd: int, size: int) -> memoryview:
+    """
+    Return a read-only memoryview of the ``size`` bytes of the sealed memory file ``fd``.
+
+    Raise ValueError if it isn't a memory file sealed against writes and shrinking,
+    or if its size differs. The mapping is released with the last view of it, the
+    descriptor can be closed right away.
+    """
+    try:
+        seals = fcntl.fcntl(fd, fcntl.F_GET_SEALS)
+    except (AttributeError, OSError):
+        raise ValueError("The out-of-band payload isn't a sealed memory file")
+
+    if seals & _REQUIRED_SEALS != _REQUIRED_SEALS:
+        raise ValueError("The out-of-band payload isn't sealed against writes")
+    if os.fstat(fd).st_size != size:
+        raise ValueError(f"The out-of-band payload isn't {size} bytes")
+
+    if not size:
+        return memoryview(b"")
+    return memoryview(mmap.mmap(fd, size, prot=mmap.PROT_READ))
+
+
+def send_with_fds(sock: socket.socket, data: bytes, fds):
+    """
+    Send ``data`` on ``sock`` with the descriptors ``fds`` attached to its first byte.
+    """
+    sent = sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+    if sent < len(data):
+        sock.sendall(memoryview(data)[sent:])
+
+
+class FDReceiver(io.RawIOBase):
+    """
+    Raw reader of a UNIX socket keeping the descriptors received along with the data.
+
+    They are queued in ``fds`` in the order they were received, and closed with the
+    reader unless taken.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+        self.fds = deque()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        try:
+            nbytes, ancdata, _, _ = self._sock.recvmsg_into([b], socket.CMSG_SPACE(_MAX_FDS * _FDS_SIZE))
+        except BlockingIOError:
+            return None
+
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds = array.array("i")
+                fds.frombytes(data[:len(data) - len(data) % _FDS_SIZE])
+                self.fds.extend(fds)
+        return nbytes
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        while self.fds:
+            os.close(self.fds.popleft())
+        super().close()
+
+
+__all__ = ["FDReceiver", "map_payload", "memfd_payload", "send_with_fds"]
@@ -0,0 +1,332 @@
+"""
+Publish/subscribe.
+
+Rather than POLLing for changes, a client sends ``SUBSCRIBE`` with a topic
+pattern (see :mod:`cmit.routing` for the syntax) as the topic of its request. The
+connection is then given over to the subscription: the server acknowledges it,
+and pushes every message published to a matching topic as a frame of a streamed
+response (see :meth:`cmit.server.BaseCMITRequestHandler.send_stream`), until the
+client closes the connection.
+
+Servers opt in by mixing in :class:`PubSubMixIn`, and their handlers
+:class:`cmit.server.PubSubHandlerMixIn` (:class:`cmit.aio.AsyncPubSubHandlerMixIn`
+for asyncio servers)::
+
+    class DemoServer(PubSubMixIn, server.ThreadingCMITServer):
+        pass
+
+    class DemoHandler(server.PubSubHandlerMixIn, server.SimpleCMITRequestHandler):
+        pass
+
+Messages are published by ``PUBLISH`` requests, or by any handler::
+
+    demo_server.publish("orders.42.shipped", {"carrier": "acme"})
+
+A message is encoded into a frame once, the same frame is queued for every
+matching subscriber. Each subscriber has a buffer of at most ``max_frames`` frames
+and ``max_bytes``, so that a slow subscriber doesn't hold up the others. When a
+subscriber falls further behind, its oldest frames are dropped (``"drop"``) or its
+subscription ends (``"disconnect"``), with a SERVICE_UNAVAILABLE terminator.
+
+Subscriptions are kept by the :class:`PubSubBroker` of a server, messages are
+only pushed to the subscribers of the same process.
+"""
+import threading
+from collections import deque
+from secrets import randbits
+from typing import Callable, Optional
+
+from cmit import CMITStatus
+from cmit.messages import CMITMessage
+from cmit.routing import TopicRouter
+
+OVERFLOW_POLICIES = ("drop", "disconnect")
+
+# Status line of the pushed frames. The client only reads the version of the first
+# frame of a streamed response, the acknowledgement.
+_FRAME_HEAD = ("CMIT/1.1 %d %s\r\n\r\n" % (CMITStatus.OK, CMITStatus.OK.phrase)).encode("latin-1")
+
+
+class Subscription:
+    """
+    Bounded buffer of the frames published to the topics matching a pattern, for one subscriber.
+    """
+
+    def __init__(self, pattern: str, max_frames: Optional[int] = 1000, max_bytes: Optional[int] = 8 << 20,
+                 overflow: str = "drop"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}")
+
+        self.pattern = pattern
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+
+        self._cond = threading.Condition()
+        self._frames = deque()
+        self.bytes = 0
+        self.closed = False
+        # Whether the subscription was ended because the subscriber fell behind
+        self.overflowed = False
+
+        # Called, from any thread, when frames are queued or the subscription is closed.
+        # Subscribers not blocking in take() use it to be woken up.
+        self.wakeup: Optional[Callable[[], None]] = None
+
+        self.delivered = 0
+        self.dropped = 0
+
+    def __repr__(self):
+        return '<%s %s %d queued>' % (self.__class__.__name__, self.pattern, len(self._frames))
+
+    def push(self, frame: bytes) -> bool:
+        """
+        Queue a frame for the subscriber, without blocking. Return False if the subscription is closed.
+        """
+        with self._cond:
+            if self.closed:
+                return False
+
+            self._frames.append(frame)
+            self.bytes += len(frame)
+
+            if self._over_limits():
+                if self.overflow == "disconnect":
+                    self._frames.clear()
+                    self.bytes = 0
+                    self.closed = self.overflowed = True
+                else:
+                    # The newest frame is kept, whatever its size
+                    while len(self._frames) > 1 and self._over_limits():
+                        self.bytes -= len(self._frames.popleft())
+                        self.dropped += 1
+
+            self._cond.notify()
+            wakeup = self.wakeup
+
+        if wakeup is not None:
+            wakeup()
+        return not self.overflowed
+
+    def _over_limits(self):
+        return (self.max_frames is not None and len(self._frames) > self.max_frames) or \
+            (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def take(self, timeout: Optional[float] = 0.0) -> Optional[list]:
+        """
+        Return the frames queued, waiting up to ``timeout`` seconds for one.
+
+        The list is empty if none arrived in time, None once the subscription is
+        closed and every frame was taken.
+        """
+        with self._cond:
+            if not self._frames and not self.closed and timeout != 0:
+                self._cond.wait(timeout)
+
+            if self._frames:
+                frames = list(self._frames)
+                self._frames.clear()
+                self.bytes = 0
+                self.delivered += len(frames)
+                return frames
+
+            return None if self.closed else []
+
+    def close(self):
+        """
+        End the subscription, the frames still queued can be taken.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+            wakeup = self.wakeup
+
+        if wakeup is not None:
+            wakeup()
+
+
+class PubSubBroker:
+    """
+    Subscriptions by topic pattern, and the fanout of published messages to them.
+    """
+
+    subscription_class = Subscription
+
+    def __init__(self, max_frames: Optional[int] = 1000, max_bytes: Optional[int] = 8 << 20,
+                 overflow: str = "drop"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}")
+
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+
+        self._lock = threading.Lock()
+        # The handler of every pattern is the set of its subscriptions
+        self._router = TopicRouter()
+        self._subscriptions = {}
+        self._closed = False
+
+        self.published = 0
+        self.delivered = 0
+        self.disconnected = 0
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def subscribe(self, pattern: str) -> Subscription:
+        """
+        Return a new subscription to the topics matching ``pattern``.
+
+        Raise ValueError if the pattern is invalid.
+        """
+        subscription = self.subscription_class(pattern, self.max_frames, self.max_bytes, self.overflow)
+
+        with self._lock:
+            if self._closed:
+                subscription.close()
+                return subscription
+
+            subscriptions = self._subscriptions.get(pattern)
+            if subscriptions is None:
+                subscriptions = set()
+                self._router.add(pattern, subscriptions)
+                self._subscriptions[pattern] = subscriptions
+            subscriptions.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Close a subscription and forget it.
+        """
+        subscription.close()
+
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.pattern)
+            if subscriptions is None or subscription not in subscriptions:
+                return
+
+            subscriptions.discard(subscription)
+            if subscription.overflowed:
+                self.disconnected += 1
+            if not subscriptions:
+                del self._subscriptions[subscription.pattern]
+                self._router.remove(subscription.pattern)
+
+    def publish(self, topic: str, payload="", msg_id=None) -> int:
+        """
+        Push a message to the subscribers of ``topic``, return the number of subscribers it was queued for.
+
+        ``payload`` is set as the payload of a :class:`CMITMessage`. The frame is
+        encoded once, whatever the number of subscribers.
+        """
+        with self._lock:
+            self.published += 1
+            subscriptions = [subscription for match in self._router.match_all(None, topic)
+                             for subscription in match.handler]
+
+        if not subscriptions:
+            return 0
+
+        frame = self.encode(topic, payload, msg_id)
+        delivered = sum(subscription.push(frame) for subscription in subscriptions)
+
+        with self._lock:
+            self.delivered += delivered
+        return delivered
+
+    @staticmethod
+    def encode(topic: str, payload="", msg_id=None) -> bytes:
+        """
+        Return the frame pushed to subscribers for a message.
+        """
+        msg = CMITMessage(topic, msg_id=msg_id or "%032x" % randbits(128))
+        msg.payload = payload
+        msg.more = True
+        return _FRAME_HEAD + msg() + b"\r\n"
+
+    def close(self):
+        """
+        End every subscription, e.g. when the server is closed.
+        """
+        with self._lock:
+            self._closed = True
+            subscriptions = [subscription for subscriptions in self._subscriptions.values()
+                             for subscription in subscriptions]
+
+        for subscription in subscriptions:
+            subscription.close()
+
+    def stats(self) -> dict:
+        """
+        Return the number of subscriptions and patterns, and the messages published and delivered so far.
+        """
+        with self._lock:
+            subscriptions = [subscription for subscriptions in self._subscriptions.values()
+                             for subscription in subscriptions]
+            return {
+                "subscriptions": len(subscriptions),
+                "patterns": len(self._subscriptions),
+                "queued": sum(len(subscription._frames) for subscription in subscriptions),
+                "dropped": sum(subscription.dropped for subscription in subscriptions),
+                "published": self.published,
+                "delivered": self.delivered,
+                "disconnected": self.disconnected,
+            }
+
+
+class PubSubMixIn:
+    """
+    Mix-in class giving a server a :class:`PubSubBroker` and the :meth:`publish` method.
+    """
+
+    broker_class = PubSubBroker
+
+    # Frames and bytes queued per subscriber at most, None for no limit
+    subscriber_max_frames = 1000
+    subscriber_max_bytes = 8 << 20
+
+    # What happens to subscribers falling further behind: "drop" drops their
+    # oldest frames, "disconnect" ends their subscription
+    subscriber_overflow = "drop"
+
+    broker = None
+
+    def get_broker(self) -> PubSubBroker:
+        """
+        Return the server's PubSubBroker, creating it on first use.
+        """
+        broker = self.broker
+        if broker is None:
+            with _broker_lock:
+                if self.broker is None:
+                    self.broker = self.broker_class(
+                        self.subscriber_max_frames, self.subscriber_max_bytes, self.subscriber_overflow
+                    )
+                broker = self.broker
+        return broker
+
+    def publish(self, topic: str, payload="", msg_id=None) -> int:
+        """
+        Push a message to the subscribers of ``topic``, see :meth:`PubSubBroker.publish`.
+        """
+        return self.get_broker().publish(topic, payload, msg_id)
+
+    def close_broker(self):
+        """
+        End every subscription.
+        """
+        if self.broker is not None:
+            self.broker.close()
+
+    def server_close(self):
+        super().server_close()
+        self.close_broker()
+
+
+_broker_lock = threading.Lock()
+
+
+__all__ = ["OVERFLOW_POLICIES", "PubSubBroker", "PubSubMixIn", "Subscription"]
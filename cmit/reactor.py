@@ -0,0 +1,491 @@
+"""
+Single-threaded, event-driven CMIT server.
+
+:class:`ReactorCMITServer` multiplexes every connection on one
+:class:`selectors.DefaultSelector` (epoll/kqueue where available). Reads are
+non-blocking and fed into a :class:`CMITFrameParser`, which splits the stream
+into complete request frames (request line, blank line and message line). Only
+once a full frame has arrived is it dispatched to the ``do_*`` methods of the
+regular request handler class, so a slow client never blocks the loop.
+
+Any :class:`cmit.server.BaseCMITRequestHandler` subclass can be used unchanged::
+
+    from cmit import reactor, server
+
+    reactor.ReactorCMITServer("/tmp/cmit.sock", server.SimpleCMITRequestHandler).serve_forever()
+
+Handlers run on the reactor thread and must therefore not block. The frames of
+a streamed response are produced as the connection drains, further requests of
+the connection are handled once it's complete. A stream yielding None is paused
+until :meth:`ReactorCMITServer.wake` is called for its connection, e.g. by a
+subscription (see :mod:`cmit.pubsub`) when a message is published, or until the
+delay given to it passed. Long POLLs and WAIT requests are parked that way until
+the result store changes, see
+:meth:`cmit.server.SimpleCMITRequestHandler.park_response`.
+"""
+import functools
+import heapq
+import io
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from cmit.server import CMITServer, _MAXLINE
+
+
+class CMITFrameParser:
+    """
+    Incremental parser splitting a byte stream into CMIT request frames.
+
+    A frame is made of three lines: the request line, the blank separator line and
+    the base64 encoded message line. Bytes are passed to :meth:`feed` as they are
+    read and every frame completed by them is returned.
+
+    A line longer than ``maxline`` is not buffered further: the frame collected so
+    far, truncated to ``maxline + 1`` bytes for the offending line, is returned as a
+    last frame (so the handler answers it with its usual BAD_REQUEST) and
+    :attr:`overflow` is set. No frames are returned after that.
+    """
+
+    lines_per_frame = 3
+
+    def __init__(self, maxline=_MAXLINE):
+        self.maxline = maxline
+        self.overflow = False
+        self._buffer = bytearray()
+        # offset where the line currently being scanned starts
+        self._line_start = 0
+        # offset up to which the buffer was already searched for a newline
+        self._scanned = 0
+        self._lines = 0
+
+    def feed(self, data: bytes) -> list:
+        if self.overflow:
+            return []
+
+        self._buffer += data
+        frames = []
+
+        while True:
+            end = self._buffer.find(b"\n", self._scanned)
+
+            if end < 0:
+                self._scanned = len(self._buffer)
+                if self._scanned - self._line_start > self.maxline:
+                    self.overflow = True
+                    frames.append(bytes(self._buffer[:self._line_start + self.maxline + 1]))
+                    self._buffer.clear()
+                return frames
+
+            end += 1
+            self._scanned = end
+
+            if end - self._line_start > self.maxline + 1:
+                self.overflow = True
+                frames.append(bytes(self._buffer[:self._line_start + self.maxline + 1]))
+                self._buffer.clear()
+                return frames
+
+            self._line_start = end
+            self._lines += 1
+
+            if self._lines == self.lines_per_frame:
+                frames.append(bytes(self._buffer[:end]))
+                del self._buffer[:end]
+                self._line_start = self._scanned = self._lines = 0
+
+    @property
+    def pending(self) -> int:
+        """Number of buffered bytes not yet part of a complete frame."""
+        return len(self._buffer)
+
+
+class _BufferWriter(io.RawIOBase):
+    """Write-only file appending to a connection's output buffer."""
+
+    def __init__(self, buffer: bytearray):
+        self._out = buffer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._out += data
+        return len(data)
+
+
+class _FrameRequest:
+    """
+    Stand-in for the socket given to the request handler.
+
+    ``makefile`` hands out the already received frame for reading and the
+    connection's output buffer for writing, so the stock socketserver
+    ``setup``/``finish`` methods work without touching the socket.
+    """
+
+    def __init__(self, conn: "_ReactorConnection", frame: bytes):
+        self.conn = conn
+        self.frame = frame
+
+    def makefile(self, mode="r", buffering=None, **kwargs):
+        if "r" in mode:
+            return io.BytesIO(self.frame)
+        return _BufferWriter(self.conn.out)
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def getsockname(self):
+        return self.conn.sock.getsockname()
+
+    def fileno(self):
+        return self.conn.sock.fileno()
+
+
+class _ReactorConnection:
+
+    __slots__ = ("sock", "client_address", "parser", "out", "closing", "events", "requests_served", "last_active",
+                 "stream", "backlog", "paused")
+
+    def __init__(self, sock, client_address, parser):
+        self.sock = sock
+        self.client_address = client_address
+        self.parser = parser
+        self.out = bytearray()
+        self.closing = False
+        self.events = selectors.EVENT_READ
+        self.requests_served = 0
+        self.last_active = time.monotonic()
+        # Frames of the streamed response being written, and the requests received meanwhile
+        self.stream = None
+        self.backlog = deque()
+        # Whether the stream has nothing to send until the connection is woken up
+        self.paused = False
+
+    def start_stream(self, frames):
+        self.stream = frames
+        self.paused = False
+
+
+# Selector data of the socket waking the loop up, see ReactorCMITServer.wake()
+_WAKEUP = object()
+
+
+class ReactorCMITServer(CMITServer):
+    """
+    CMIT server handling every connection from a single thread with a selector loop.
+    """
+
+    frame_parser_class = CMITFrameParser
+
+    # Bytes read from a readable connection at once.
+    read_size = 65536
+
+    # Maximum number of connections accepted per wake-up of the listening socket.
+    accept_batch = 64
+
+    # Bytes queued on a connection before the next frames of a streamed response are produced.
+    stream_high_water = 65536
+
+    _shutdown_request = False
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+        self.connections = {}
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+        self._selector = None
+        self._wakeup_socks = None
+        self._woken = deque()
+        # (when, sequence, connection) of the delayed wake() calls, a heap
+        self._timers = []
+        self._timers_lock = threading.Lock()
+        self._timer_count = 0
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Run the selector loop until shutdown() is called.
+        """
+        self._is_shut_down.clear()
+        self.socket.setblocking(False)
+
+        try:
+            with selectors.DefaultSelector() as selector:
+                self._selector = selector
+                selector.register(self.socket, selectors.EVENT_READ, None)
+
+                self._wakeup_socks = socket.socketpair()
+                for sock in self._wakeup_socks:
+                    sock.setblocking(False)
+                selector.register(self._wakeup_socks[0], selectors.EVENT_READ, _WAKEUP)
+
+                while not self._shutdown_request:
+                    for key, mask in selector.select(self._select_timeout(poll_interval)):
+                        conn = key.data
+
+                        if conn is None:
+                            self._accept()
+                            continue
+
+                        if conn is _WAKEUP:
+                            self._resume()
+                            continue
+
+                        if mask & selectors.EVENT_READ:
+                            self._read(conn)
+
+                        if mask & selectors.EVENT_WRITE and conn.sock.fileno() >= 0:
+                            self._write(conn)
+
+                    self._run_timers()
+                    self.service_actions()
+
+                for conn in list(self.connections.values()):
+                    self._close(conn)
+        finally:
+            if self._wakeup_socks is not None:
+                for sock in self._wakeup_socks:
+                    sock.close()
+                self._wakeup_socks = None
+            self._selector = None
+            with self._timers_lock:
+                self._timers.clear()
+            self._shutdown_request = False
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        """
+        Stops the serve_forever loop.
+
+        Blocks until the loop has finished. This must be called while
+        serve_forever() is running in another thread, or it will deadlock.
+        """
+        self._shutdown_request = True
+        self._is_shut_down.wait()
+
+    def wake(self, conn: _ReactorConnection, delay=None):
+        """
+        Resume the paused stream of a connection, after ``delay`` seconds if given. May be called from any thread.
+        """
+        if delay is not None:
+            with self._timers_lock:
+                self._timer_count += 1
+                heapq.heappush(self._timers, (time.monotonic() + delay, self._timer_count, conn))
+        else:
+            self._woken.append(conn)
+
+        # Also recomputes the select() timeout for a new timer
+        socks = self._wakeup_socks
+        if socks is None:
+            return
+
+        try:
+            socks[1].send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # The loop is woken up already
+            pass
+        except OSError:
+            # The loop has stopped
+            pass
+
+    def _select_timeout(self, poll_interval):
+        with self._timers_lock:
+            if not self._timers:
+                return poll_interval
+            return min(poll_interval, max(self._timers[0][0] - time.monotonic(), 0))
+
+    def _run_timers(self):
+        now = time.monotonic()
+        with self._timers_lock:
+            while self._timers and self._timers[0][0] <= now:
+                self._woken.append(heapq.heappop(self._timers)[2])
+        self._resume_woken()
+
+    def _resume(self):
+        try:
+            while self._wakeup_socks[0].recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        self._resume_woken()
+
+    def _resume_woken(self):
+        while self._woken:
+            conn = self._woken.popleft()
+            if conn.paused and self.connections.get(conn.sock.fileno()) is conn:
+                conn.paused = False
+                self._write(conn)
+
+    def _accept(self):
+        for _ in range(self.accept_batch):
+            try:
+                sock, client_address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.logger.error(f"Failed to accept CMIT connection: {e!r}")
+                return
+
+            sock.setblocking(False)
+            conn = _ReactorConnection(sock, client_address, self.frame_parser_class())
+            self.connections[sock.fileno()] = conn
+            self._selector.register(sock, conn.events, conn)
+
+    def _read(self, conn: _ReactorConnection):
+        try:
+            data = conn.sock.recv(self.read_size)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close(conn)
+            return
+
+        if not data:
+            self._close(conn)
+            return
+
+        conn.last_active = time.monotonic()
+
+        for frame in conn.parser.feed(data):
+            if conn.stream is not None or conn.backlog:
+                # Responses are written in order, after the streamed one
+                conn.backlog.append(frame)
+                continue
+            self.dispatch(conn, frame)
+            if conn.closing:
+                break
+
+        if conn.parser.overflow:
+            conn.closing = True
+
+        self._write(conn)
+
+    def dispatch(self, conn: _ReactorConnection, frame: bytes):
+        """
+        Run the request handler on a complete frame, its output is queued on the connection.
+
+        The handler is set up the way socketserver would, but only a single request is
+        handled, whether the connection is kept open is then read from the handler.
+        """
+        request = _FrameRequest(conn, frame)
+        cls = self.RequestHandlerClass
+
+        # Bypass BaseRequestHandler.__init__, which would loop over handle_one_request().
+        handler = cls.__new__(cls)
+        handler.request = request
+        handler.client_address = conn.client_address
+        handler.server = self
+        handler.close_connection = True
+        handler.requests_served = conn.requests_served
+        # Requests of multiplexed connections are handled inline as well, in arrival order
+        handler.mux_workers = 0
+        # ...and full bulkheads reject requests rather than block the loop
+        handler.bulkhead_wait = False
+        # Streamed responses are produced by _write() as the connection drains, long POLLs and
+        # WAITs are parked as paused streams
+        handler.stream_writer = conn.start_stream
+        handler.stream_wakeup = functools.partial(self.wake, conn)
+
+        try:
+            handler.setup()
+            try:
+                handler.handle_one_request()
+            finally:
+                handler.finish()
+        except Exception:
+            self.handle_error(request, conn.client_address)
+            conn.closing = True
+            return
+
+        conn.requests_served = handler.requests_served
+        if handler.close_connection:
+            conn.closing = True
+
+    def _fill(self, conn: _ReactorConnection):
+        # Produce the frames of a streamed response while little output is queued,
+        # then handle the requests received meanwhile.
+        while conn.stream is not None and not conn.paused and len(conn.out) < self.stream_high_water:
+            try:
+                frame = next(conn.stream)
+                if frame is None:
+                    conn.paused = True
+                else:
+                    conn.out += frame
+                continue
+            except StopIteration:
+                conn.stream = None
+            except Exception:
+                self.handle_error(None, conn.client_address)
+                conn.stream = None
+                conn.closing = True
+                return
+
+            while conn.backlog and conn.stream is None and not conn.closing:
+                self.dispatch(conn, conn.backlog.popleft())
+
+    def _write(self, conn: _ReactorConnection):
+        self._fill(conn)
+
+        if conn.out:
+            try:
+                sent = conn.sock.send(conn.out)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self._close(conn)
+                return
+            del conn.out[:sent]
+
+        if not conn.out and conn.stream is None and conn.closing:
+            self._close(conn)
+            return
+
+        streaming = conn.stream is not None and not conn.paused
+        events = selectors.EVENT_WRITE if conn.out or streaming else selectors.EVENT_READ
+        if conn.closing and not conn.paused:
+            events = selectors.EVENT_WRITE
+
+        if events != conn.events:
+            conn.events = events
+            self._selector.modify(conn.sock, events, conn)
+
+    def service_actions(self):
+        """
+        Close persistent connections idle for longer than the handler's keep_alive_timeout.
+        """
+        super().service_actions()
+
+        timeout = getattr(self.RequestHandlerClass, "keep_alive_timeout", None)
+        if not timeout:
+            return
+
+        deadline = time.monotonic() - timeout
+        for conn in list(self.connections.values()):
+            if conn.last_active < deadline and not conn.out and conn.stream is None and not conn.parser.pending:
+                self._close(conn)
+
+    def _close(self, conn: _ReactorConnection):
+        if conn.stream is not None:
+            conn.stream.close()
+            conn.stream = None
+        self.connections.pop(conn.sock.fileno(), None)
+        try:
+            self._selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        self.shutdown_request(conn.sock)
+
+    def server_close(self):
+        super().server_close()
+        for conn in list(self.connections.values()):
+            conn.sock.close()
+        self.connections.clear()
+
+
+__all__ = ["CMITFrameParser", "ReactorCMITServer"]
@@ -9,7 +9,7 @@ Basic PING usage:
     200
 """
 
-from .api import request, ping, execute, poll
+from .api import request, ping, execute, poll, wait, batch, publish, subscribe, fetch, commit
 from .exceptions import (
     CMITException, CMITError, CMITConnectionError, CMITTimeout, MissingSchema, InvalidSchema, InvalidSocketPath
 )
@@ -6,11 +6,14 @@ This module contains the transport adapters tha cmit.requests uses to
 define and maintain connections.
 """
 
+import socket
+import time
 import typing
 from secrets import randbits
 
-from cmit.client import CMITConnection, error
+from cmit.client import CMITConnection, CMITSubscription, error
 
+from .exceptions import CMITTimeout
 from .models import PreparedRequest, Request, Response
 from ._internal_utils import parse_socket_path
 
@@ -32,6 +35,20 @@ class BaseAdapter:
         """
         raise NotImplementedError
 
+    @staticmethod
+    def subscribe(fp, pattern, timeout=None) -> CMITSubscription:
+        """
+        Subscribes to the topics matching ``pattern``, over a connection of its own.
+
+        :param fp: A file-like object to subscribe on.
+        :param timeout: (optional) How long to wait for each message
+        :rtype: cmit.client.CMITSubscription
+        """
+        try:
+            return CMITSubscription(parse_socket_path(fp).socket_path, pattern, timeout)
+        except socket.timeout as e:
+            raise CMITTimeout(e)
+
     def close(self):
         """Closes the connection to the server"""
         raise NotImplementedError
@@ -59,6 +76,9 @@ class CMITAdapter(BaseAdapter):
         """
         Builds a :class:`Response <Response>` object from a CMIT response.
 
+        The chunks of a streamed response are left on the connection, to be read by
+        :meth:`Response.iter_messages`.
+
         :param request: :class:`PreparedRequest<PreparedRequest>` that was used to generate the response.
         :type request: cmit.requests.models.PreparedRequest
         :param response: :class:`CMITResponse<CMITResponse>` object.
@@ -75,7 +95,10 @@ class CMITAdapter(BaseAdapter):
         resp.request = request
         resp.msg = response.msg
         resp.connection = self
-        response.close()
+        if response.streamed:
+            resp.raw = response
+        else:
+            response.close()
 
         return resp
 
@@ -96,6 +119,7 @@ class CMITAdapter(BaseAdapter):
             self.connection = None
             connection.close()
             connection = CMITConnection(socket_path)
+            self.connection = connection
 
         elif self.connection is not None and self.connection.socket == socket_path:
             connection = self.connection
@@ -110,18 +134,41 @@ class CMITAdapter(BaseAdapter):
         """
         Sends the request to the server
 
+        A connection kept open by the server (CMIT/1.1) is reused. If such a connection
+        turns out to have been closed by the server in the meantime, the request is
+        sent once more over a new connection.
+
+        With a ``timeout``, the request carries a deadline: the server answers it with
+        REQUEST_TIMEOUT rather than handling it once the timeout has passed.
+
         :param request: :class:`PreparedRequest<PreparedRequest>` to send.
         :type request: cmit.requests.models.PreparedRequest
         :param timeout: (optional) How long to wait for the server to send data
         :type timeout: float or tuple
         """
         msg_id = kwargs.get("msg_id", "%032x" % randbits(128))
+
+        if isinstance(timeout, tuple):
+            # (connect, read) timeouts, the read timeout bounds the response
+            timeout = timeout[-1]
+        deadline = None if timeout is None else time.time() + timeout
+
         try:
             connection = self.get_connection(request.socket_path)
-            connection.connect()
-            msg_id = connection.request(request.command, request.topic, request.payload, msg_id=msg_id)
-            request.msg_id = msg_id
-            response = connection.getresponse()
+            reused = connection.sock is not None
+
+            try:
+                response = self._send_request(connection, request, msg_id, deadline, kwargs.get("priority"))
+            except ConnectionError:
+                if not reused:
+                    raise
+                connection.close()
+                response = self._send_request(connection, request, msg_id, deadline, kwargs.get("priority"))
+
+        except socket.timeout as e:
+            # The response may still arrive, the connection can't be reused
+            self.close()
+            raise CMITTimeout(e, request=request)
         except error as e:
             raise e
         except Exception as e:
@@ -129,6 +176,25 @@ class CMITAdapter(BaseAdapter):
 
         return self.build_response(request, response)
 
+    @staticmethod
+    def _send_request(connection, request, msg_id, deadline=None, priority=None):
+        if connection.sock is None:
+            connection.connect()
+
+        if deadline is None:
+            connection.sock.settimeout(connection.timeout)
+        else:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                # A timeout of 0 would make the socket non-blocking
+                raise CMITTimeout("The timeout expired before the request was sent", request=request)
+            connection.sock.settimeout(remaining)
+
+        request.msg_id = connection.request(
+            request.command, request.topic, request.payload, msg_id=msg_id, deadline=deadline, priority=priority
+        )
+        return connection.getresponse()
+
     def close(self):
         """Closes the connection to the server"""
         if self.connection is not None:
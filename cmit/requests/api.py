@@ -97,7 +97,7 @@ def execute(socket_fp, topic, data=None, msg_args=None, msg_kwargs=None):
     return request('EXECUTE', socket_fp, topic, data, msg_args, msg_kwargs)
 
 
-def poll(socket_fp, topic):
+def poll(socket_fp, topic, msg_id=None, wait=None, last=None):
     """
     Send a poll request to the CMIT server.
 
@@ -105,18 +105,180 @@ def poll(socket_fp, topic):
     :type socket_fp: str or PathLike
     :param topic: The topic to send in the request.
     :type topic: str
+    :param msg_id: (optional) The msg_id of the EXECUTE request whose task to poll, rather than the number of tasks.
+    :type msg_id: str
+    :param wait: (optional) How long the server may wait for the result to differ from ``last``.
+    :type wait: float
+    :param last: (optional) The result of the previous poll.
+    :type last: int or str
     :return: :class:`CMITResponse<CMITResponse>`
     :rtype: cmit.requests.Response
 
     Usage::
 
         >>> from cmit import requests
-        >>> req = requests.poll('cmit://tmp/cmit.sock', 'test')
+        >>> req = requests.poll('cmit://tmp/cmit.sock', 'test', wait=10, last=3)
         >>> req
         <CMITResponse [200]>
     """
 
-    return request('POLL', socket_fp, topic)
+    with sessions.Session() as session:
+        return session.poll(socket_fp, topic, msg_id, wait=wait, last=last)
+
+
+def wait(socket_fp, msg_id, timeout=None):
+    """
+    Wait for the task of an EXECUTE request to finish.
+
+    :param socket_fp: A file-like object to send the request to.
+    :type socket_fp: str or PathLike
+    :param msg_id: The msg_id of the EXECUTE request.
+    :type msg_id: str
+    :param timeout: (optional) How long to wait for the task, None to wait until it's finished.
+    :type timeout: float
+    :return: :class:`CMITResponse<CMITResponse>`
+    :rtype: cmit.requests.Response
+
+    Usage::
+
+        >>> from cmit import requests
+        >>> req = requests.execute('cmit://tmp/cmit.sock', 'test')
+        >>> requests.wait('cmit://tmp/cmit.sock', req.msg_id, timeout=30)
+        <CMITResponse [200]>
+    """
+
+    with sessions.Session() as session:
+        return session.wait(socket_fp, msg_id, timeout=timeout)
+
+
+def batch(socket_fp, requests):
+    """
+    Send many requests to the CMIT server in BATCH requests.
+
+    :param socket_fp: A file-like object to send the requests to.
+    :type socket_fp: str or PathLike
+    :param requests: ``(command, topic[, data[, msg_args[, msg_kwargs]]])`` tuples.
+    :type requests: list
+    :return: a :class:`Response <Response>` for every request, in order
+    :rtype: list
+
+    Usage::
+
+        >>> from cmit import requests
+        >>> resps = requests.batch('cmit://tmp/cmit.sock', [('EXECUTE', 'jobs.1'), ('EXECUTE', 'jobs.2', 'data')])
+        >>> resps
+        [<Response [202]>, <Response [202]>]
+    """
+
+    with sessions.Session() as session:
+        return session.batch(socket_fp, requests)
+
+
+def publish(socket_fp, topic, data=None):
+    """
+    Publish a message to the subscribers of a topic.
+
+    :param socket_fp: A file-like object to send the request to.
+    :type socket_fp: str or PathLike
+    :param topic: The topic to publish to.
+    :type topic: str
+    :param data: The payload of the message.
+    :type data: str or dict
+    :return: :class:`CMITResponse<CMITResponse>`
+    :rtype: cmit.requests.Response
+
+    Usage::
+
+        >>> from cmit import requests
+        >>> req = requests.publish('cmit://tmp/cmit.sock', 'orders.42.shipped', {'carrier': 'acme'})
+        >>> req
+        <CMITResponse [200]>
+    """
+
+    return request('PUBLISH', socket_fp, topic, data)
+
+
+def subscribe(socket_fp, pattern, timeout=None):
+    """
+    Subscribe to the messages published to the topics matching a pattern.
+
+    :param socket_fp: A file-like object to subscribe on.
+    :type socket_fp: str or PathLike
+    :param pattern: The topic pattern, see cmit.routing.
+    :type pattern: str
+    :param timeout: How long to wait for each message, None to wait forever.
+    :type timeout: float
+    :return: :class:`CMITSubscription <cmit.client.CMITSubscription>`
+    :rtype: cmit.client.CMITSubscription
+
+    Usage::
+
+        >>> from cmit import requests
+        >>> with requests.subscribe('cmit://tmp/cmit.sock', 'orders.#') as subscription:
+        ...     for msg in subscription:
+        ...         print(msg.topic, msg.payload)
+    """
+
+    return sessions.Session().subscribe(socket_fp, pattern, timeout=timeout)
+
+
+def fetch(socket_fp, topic, offset=None, max_bytes=None, group=None):
+    """
+    Fetch a batch of the messages of the log of a topic.
+
+    :param socket_fp: A file-like object to send the request to.
+    :type socket_fp: str or PathLike
+    :param topic: The topic of the log.
+    :type topic: str
+    :param offset: (optional) The offset of the first message, by default the one committed by ``group``.
+    :type offset: int
+    :param max_bytes: (optional) The size of the messages returned at most.
+    :type max_bytes: int
+    :param group: (optional) The consumer group.
+    :type group: str
+    :return: :class:`CMITResponse<CMITResponse>`
+    :rtype: cmit.requests.Response
+
+    Usage::
+
+        >>> from cmit import requests
+        >>> resp = requests.fetch('cmit://tmp/cmit.sock', 'orders', offset=0)
+        >>> [msg.offset for msg in resp.iter_messages()]
+        [0, 1, 2]
+    """
+
+    with sessions.Session() as session:
+        resp = session.fetch(socket_fp, topic, offset, max_bytes, group)
+        if resp.raw is not None:
+            # Read before the session closes the connection
+            resp.raw.read_stream()
+        return resp
+
+
+def commit(socket_fp, topic, group, offset):
+    """
+    Commit the offset a consumer group goes on from in the log of a topic.
+
+    :param socket_fp: A file-like object to send the request to.
+    :type socket_fp: str or PathLike
+    :param topic: The topic of the log.
+    :type topic: str
+    :param group: The consumer group.
+    :type group: str
+    :param offset: The offset of the next message to fetch.
+    :type offset: int
+    :return: :class:`CMITResponse<CMITResponse>`
+    :rtype: cmit.requests.Response
+
+    Usage::
+
+        >>> from cmit import requests
+        >>> requests.commit('cmit://tmp/cmit.sock', 'orders', 'billing', 3)
+        <CMITResponse [200]>
+    """
+
+    with sessions.Session() as session:
+        return session.commit(socket_fp, topic, group, offset)
 
 
-__all__ = ['request', 'ping', 'execute', 'poll']
+__all__ = ['request', 'ping', 'execute', 'poll', 'wait', 'batch', 'publish', 'subscribe', 'fetch', 'commit']
@@ -7,11 +7,13 @@ This module contains the models that power the cmit.requests package.
 import json
 import os
 import datetime
+import socket
 from urllib.parse import urlunparse
 from requests.utils import requote_uri
 
+from cmit.client import StreamError
 from cmit.requests._internal_utils import to_native_str, parse_socket_path
-from cmit.requests.exceptions import InvalidSocketPath, MissingSchema
+from cmit.requests.exceptions import CMITError, CMITTimeout, InvalidSocketPath, MissingSchema
 
 _NULL_TOPIC = "topic.null"
 
@@ -194,9 +196,12 @@ class Response:
         # The prepared request that was sent to create the response.
         self.request = None
 
-        # The CMITMessage object
+        # The CMITMessage object, the first chunk of a streamed response
         self.msg = None
 
+        # The CMITResponse a streamed response is read from
+        self.raw = None
+
     def __repr__(self):
         return f"<Response [{self.status_code}]>"
 
@@ -213,10 +218,43 @@ class Response:
         for name, value in state.items():
             setattr(self, name, value)
 
+    def iter_messages(self):
+        """
+        Iterate over the messages of the response.
+
+        A streamed response yields its chunks, read from the connection as the
+        iteration goes, so that memory use doesn't grow with the size of the
+        response. They must be consumed before the session sends another request,
+        or they are read ahead of it and kept in memory. Other responses yield
+        their only message.
+
+        Usage::
+
+            >>> with session.request("EXECUTE", "cmit://tmp/cmit.sock", "report.export") as response:
+            ...     for msg in response.iter_messages():
+            ...         write_rows(msg.payload)
+        """
+        if self.raw is None:
+            if self.msg is not None:
+                yield self.msg
+            return
+
+        try:
+            yield from self.raw.iter_messages()
+        except StreamError as e:
+            raise CMITError(e, response=self)
+        except socket.timeout as e:
+            # The rest of the stream may still arrive, the connection can't be reused
+            self.connection.close()
+            raise CMITTimeout(e, response=self)
+
     def close(self):
         """
         Releases the connection back to the CMITConnection pool. Once this
         method has been called the underlying raw socket must not be accessed
         again.
+
+        The chunks of a streamed response that weren't read yet are skipped.
         """
-        pass
+        if self.raw is not None:
+            self.raw.close()
@@ -1,10 +1,14 @@
 import datetime
+import json
 import time
 from collections import OrderedDict
+from secrets import randbits
 
+from cmit import CMITStatus
+from cmit.messages import CMITMessage
 from cmit.requests.adapters import CMITAdapter
-from cmit.requests.exceptions import InvalidSchema
-from cmit.requests.models import PreparedRequest, Request
+from cmit.requests.exceptions import CMITError, InvalidSchema
+from cmit.requests.models import PreparedRequest, Request, Response
 
 
 class Session:
@@ -64,25 +68,177 @@ class Session:
         )
         return p
 
-    def request(self, command, fp, topic, data=None, msg_args=None, msg_kwargs=None):
+    def request(self, command, fp, topic, data=None, msg_args=None, msg_kwargs=None, timeout=None, priority=None):
 
         req = Request(command=command.upper(), socket_path=fp, topic=topic, data=data,
                       rpc_args=msg_args, rpc_kwargs=msg_kwargs)
 
         prep = self.prepare_request(req)
 
-        resp = self.send(prep)
+        resp = self.send(prep, timeout=timeout, priority=priority)
 
         return resp
 
-    def ping(self, fp):
-        return self.request('PING', fp, 'ping')
+    def ping(self, fp, timeout=None):
+        return self.request('PING', fp, 'ping', timeout=timeout)
 
-    def execute(self, fp, topic, data=None, msg_args=None, msg_kwargs=None):
-        return self.request('EXECUTE', fp, topic, data=data, msg_args=msg_args, msg_kwargs=msg_kwargs)
+    def execute(self, fp, topic, data=None, msg_args=None, msg_kwargs=None, timeout=None, priority=None):
+        return self.request('EXECUTE', fp, topic, data=data, msg_args=msg_args, msg_kwargs=msg_kwargs,
+                            timeout=timeout, priority=priority)
 
-    def poll(self, fp, topic):
-        return self.request('POLL', fp, topic)
+    def poll(self, fp, topic, msg_id=None, timeout=None, wait=None, last=None):
+        """
+        Poll for the state of the task ``msg_id``, or the number of tasks of ``topic`` queued or running.
+
+        With ``wait``, the server answers once the value polled differs from ``last``
+        (the state or depth seen in the previous response, by default the current
+        one), or after ``wait`` seconds.
+        """
+        msg_kwargs = {}
+        if msg_id is not None:
+            msg_kwargs["msg_id"] = msg_id
+        if wait is not None:
+            msg_kwargs["wait"] = wait
+        if last is not None:
+            msg_kwargs["last"] = last
+        return self.request('POLL', fp, topic, msg_kwargs=msg_kwargs or None, timeout=timeout)
+
+    def wait(self, fp, msg_id, timeout=None):
+        """
+        Wait for the task of the EXECUTE request ``msg_id`` to finish, and return the response with its result.
+
+        The server holds each WAIT request for a limited time, they're sent again until
+        the task is finished, at most once a second for servers answering right away.
+        With a ``timeout``, each one asks to be held for the time left and they stop
+        once less than a second is: if the task isn't finished within ``timeout``
+        seconds, the status code of the response is ACCEPTED. A ``timeout`` of 0
+        sends a single WAIT answered right away, to check on the task.
+        """
+        msg_kwargs = {"msg_id": msg_id}
+        if timeout is not None and timeout <= 0:
+            msg_kwargs["wait"] = 0
+            return self.request('WAIT', fp, 'wait', msg_kwargs=msg_kwargs)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0.0)
+                msg_kwargs["wait"] = remaining
+
+            resp = self.request('WAIT', fp, 'wait', msg_kwargs=msg_kwargs, timeout=remaining)
+            if resp.status_code != CMITStatus.ACCEPTED:
+                return resp
+
+            pause = max(1.0 - resp.elapsed.total_seconds(), 0.0)
+            if deadline is not None and deadline - time.monotonic() < pause + 1.0:
+                return resp
+            time.sleep(pause)
+
+    def publish(self, fp, topic, data=None, timeout=None):
+        return self.request('PUBLISH', fp, topic, data=data, timeout=timeout)
+
+    def fetch(self, fp, topic, offset=None, max_bytes=None, group=None, timeout=None):
+        """
+        Fetch a batch of the messages of the log of ``topic``, from ``offset`` on.
+
+        Without an offset, the batch starts at the offset committed by ``group``, or
+        else the oldest message retained. The response is streamed, its messages
+        carry their ``offset``; the payload of its terminator (or of its only
+        message if there are none) gives the ``next_offset`` to fetch from.
+        """
+        msg_kwargs = {}
+        if offset is not None:
+            msg_kwargs["offset"] = offset
+        if max_bytes is not None:
+            msg_kwargs["max_bytes"] = max_bytes
+        if group is not None:
+            msg_kwargs["group"] = group
+        return self.request('FETCH', fp, topic, msg_kwargs=msg_kwargs or None, timeout=timeout)
+
+    def commit(self, fp, topic, group, offset, timeout=None):
+        """
+        Record ``offset`` as the next one the consumers of ``group`` fetch from the log of ``topic``.
+        """
+        return self.request('COMMIT', fp, topic, msg_kwargs={"group": group, "offset": offset}, timeout=timeout)
+
+    def subscribe(self, fp, pattern, timeout=None):
+        """
+        Subscribe to the messages published to the topics matching ``pattern``.
+
+        :param timeout: (optional) How long to wait for each message
+        :return: a :class:`CMITSubscription <cmit.client.CMITSubscription>` yielding the messages
+        """
+        return self.get_adapter(uri=fp).subscribe(fp, pattern, timeout=timeout)
+
+    def batch(self, fp, requests, timeout=None, batch_size=200, max_batch_bytes=24 << 10):
+        """
+        Send many requests in BATCH requests, and return their responses in order.
+
+        Each request is a ``(command, topic[, data[, msg_args[, msg_kwargs]]])`` tuple.
+        They are sent ``batch_size`` at a time, fewer if their messages would take
+        more than ``max_batch_bytes``: a BATCH request and its response must each fit
+        on a single line.
+
+        :param timeout: (optional) How long to wait for the response to each BATCH request
+        :return: a :class:`Response <Response>` for every request
+        :rtype: list
+        """
+        entries = []
+        for command, topic, *args in requests:
+            prep = self.prepare_request(Request(command.upper(), fp, topic, *args))
+            entries.append({
+                "command": prep.command,
+                "_id": "%032x" % randbits(128),
+                "topic": prep.topic,
+                "payload": prep.payload,
+            })
+
+        responses = []
+        chunk, size = [], 0
+        for entry in entries:
+            entry_size = len(json.dumps(entry))
+            if chunk and (len(chunk) >= batch_size or size + entry_size > max_batch_bytes):
+                responses.extend(self._send_batch(fp, chunk, timeout))
+                chunk, size = [], 0
+            chunk.append(entry)
+            size += entry_size
+
+        if chunk:
+            responses.extend(self._send_batch(fp, chunk, timeout))
+        return responses
+
+    def _send_batch(self, fp, entries, timeout):
+        prep = self.prepare_request(Request('BATCH', fp, 'batch'))
+        prep.payload = json.dumps({"messages": entries})
+
+        resp = self.send(prep, timeout=timeout)
+        if resp.status_code != CMITStatus.OK:
+            raise CMITError(f"BATCH request failed: {resp.status_code} {resp.reason}", response=resp)
+
+        results = json.loads(resp.msg.payload)["results"]
+        if len(results) != len(entries):
+            raise CMITError(f"BATCH response has {len(results)} results for {len(entries)} messages", response=resp)
+
+        responses = []
+        for entry, result in zip(entries, results):
+            item = Response()
+            item.status_code = result["status"]
+            try:
+                item.reason = CMITStatus(result["status"]).phrase
+            except ValueError:
+                item.reason = ""
+            item.socket_path = resp.socket_path
+            item.topic = result.get("topic", entry["topic"])
+            item.msg_id = result.get("_id") or entry["_id"]
+            item.msg = CMITMessage(item.topic, msg_id=item.msg_id)
+            item.msg.payload = result.get("payload", "")
+            item.request = prep
+            item.elapsed = resp.elapsed
+            item.connection = resp.connection
+            responses.append(item)
+
+        return responses
 
     def send(self, prep, **kwargs):
         """
@@ -0,0 +1,393 @@
+"""
+In-memory store of task results.
+
+EXECUTE requests are often answered with ACCEPTED before their work is done, the
+client then POLLs for the result. A server mixing in :class:`ResultStoreMixIn`
+keeps the state and result of every task in a :class:`TaskResultStore`, keyed by
+the msg_id of its EXECUTE request::
+
+    class DemoServer(ResultStoreMixIn, server.ThreadingCMITServer):
+        pass
+
+    store = demo_server.get_result_store()
+    store.add(handler.msg.msg_id, handler.msg.topic)
+    ...
+    store.complete(msg_id, {"rows": 42})
+
+A POLL request naming a task in its payload (``{"kwargs": {"msg_id": ...}}``, or
+simply ``{"msg_id": ...}``) is answered with the task's state and result,
+a dictionary lookup; otherwise with the number of unfinished tasks of its topic.
+With a ``wait`` budget the POLL is a long poll: it's only answered once the
+task's state (or the number of tasks) differs from the ``last`` one seen by the
+client (see :meth:`TaskResultStore.wait_state`), or once the budget is spent.
+A WAIT request naming a task is only answered once the task is finished, see
+:meth:`TaskResultStore.wait_finished`. Waiters are registered per task and per
+topic (see :meth:`TaskResultStore.watch`), an update only wakes up those
+waiting for what it changed.
+
+Finished tasks are kept for ``ttl`` seconds. Beyond ``max_entries`` tasks or
+``max_bytes`` of results, the least recently used tasks are evicted first.
+"""
+import enum
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+
+class TaskState(str, enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    @property
+    def finished(self):
+        return self in (TaskState.DONE, TaskState.FAILED)
+
+
+class TaskResult:
+    """
+    State and result of a single task.
+    """
+
+    __slots__ = ["msg_id", "topic", "state", "result", "error", "created", "updated", "expires", "size"]
+
+    def __init__(self, msg_id: str, topic: Optional[str] = None):
+        self.msg_id = msg_id
+        self.topic = topic
+        self.state = TaskState.QUEUED
+        self.result = None
+        self.error = None
+        self.created = self.updated = time.monotonic()
+        # Monotonic time after which the task is evicted, None while unfinished
+        self.expires = None
+        # Approximate size of the result, in bytes
+        self.size = 0
+
+    def __repr__(self):
+        return '<%s %s %s>' % (self.__class__.__name__, self.msg_id, self.state.value)
+
+    def as_payload(self) -> dict:
+        """
+        Return the payload of a POLL response for this task.
+        """
+        payload = {"msg_id": self.msg_id, "state": self.state.value}
+        if self.state is TaskState.DONE:
+            payload["result"] = self.result
+        elif self.state is TaskState.FAILED:
+            payload["error"] = self.error
+        return payload
+
+
+class TaskResultStore:
+    """
+    Tasks keyed by msg_id, evicted by TTL once finished and by LRU beyond the caps.
+    """
+
+    def __init__(self, ttl: Optional[float] = 300.0, max_entries: Optional[int] = 10000,
+                 max_bytes: Optional[int] = 64 << 20):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # Least recently used first
+        self._tasks = OrderedDict()
+        self._pending = 0
+        # Unfinished tasks per topic
+        self._pending_topics = {}
+        # Callbacks per task ("task", msg_id) and per topic ("topic", topic), see watch()
+        self._watchers = {}
+        self.bytes = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __contains__(self, msg_id):
+        return self.get(msg_id) is not None
+
+    def add(self, msg_id: str, topic: Optional[str] = None) -> TaskResult:
+        """
+        Record a new task, queued.
+        """
+        task = TaskResult(msg_id, topic)
+        with self._lock:
+            self._remove(self._tasks.get(msg_id))
+            self._tasks[msg_id] = task
+            self._count_pending(task, 1)
+            self._notify(("task", msg_id))
+            self._evict()
+        return task
+
+    def start(self, msg_id: str):
+        """
+        Mark a task as running.
+        """
+        self._update(msg_id, TaskState.RUNNING)
+
+    def complete(self, msg_id: str, result: Any = None):
+        """
+        Store the result of a task, which must be JSON serializable.
+
+        A result larger than ``max_bytes`` isn't stored, the task fails instead.
+        """
+        size = len(json.dumps(result))
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.fail(msg_id, f"Result of {size} bytes exceeds the store's limit")
+            return
+        self._update(msg_id, TaskState.DONE, result=result, size=size)
+
+    def fail(self, msg_id: str, error: Any = None):
+        """
+        Mark a task as failed, ``error`` describes the failure.
+        """
+        error = None if error is None else str(error)
+        self._update(msg_id, TaskState.FAILED, error=error, size=len(error or ""))
+
+    def _update(self, msg_id, state, result=None, error=None, size=0):
+        now = time.monotonic()
+
+        with self._lock:
+            task = self._tasks.get(msg_id)
+            if task is None:
+                # Evicted meanwhile, or never added
+                task = self._tasks[msg_id] = TaskResult(msg_id)
+                self._count_pending(task, 1)
+            else:
+                self._tasks.move_to_end(msg_id)
+
+            if state.finished and not task.state.finished:
+                self._count_pending(task, -1)
+
+            task.state = state
+            task.updated = now
+            if state.finished:
+                task.result = result
+                task.error = error
+                task.expires = None if self.ttl is None else now + self.ttl
+                self.bytes += size - task.size
+                task.size = size
+
+            self._notify(("task", msg_id))
+            self._evict()
+
+    def get(self, msg_id: str) -> Optional[TaskResult]:
+        """
+        Return the task recorded for ``msg_id``, None if it's unknown or was evicted.
+        """
+        with self._lock:
+            task = self._tasks.get(msg_id)
+            if task is None:
+                return None
+
+            if task.expires is not None and task.expires <= time.monotonic():
+                self._remove(task)
+                self.expired += 1
+                return None
+
+            self._tasks.move_to_end(msg_id)
+            return task
+
+    def discard(self, msg_id: str):
+        """
+        Forget a task.
+        """
+        with self._lock:
+            self._remove(self._tasks.get(msg_id))
+
+    def pending(self, topic: Optional[str] = None) -> int:
+        """
+        Return the number of tasks of ``topic`` queued or running, of any topic if it's None.
+        """
+        if topic is None:
+            return self._pending
+        return self._pending_topics.get(topic, 0)
+
+    def state(self, msg_id: str) -> str:
+        """
+        Return the :class:`TaskState` value of a task, "unknown" if it isn't recorded.
+        """
+        task = self._tasks.get(msg_id)
+        return task.state.value if task is not None else "unknown"
+
+    def watch(self, callback: Callable[[], Any], msg_id: Optional[str] = None, topic: Optional[str] = None) \
+            -> Callable[[], None]:
+        """
+        Call ``callback`` whenever the task ``msg_id`` changes, or else the number of unfinished tasks of ``topic``.
+
+        Without either, it's called whenever the number of unfinished tasks changes.
+        The callback runs with the store's lock held, on the thread updating the
+        store: it must return quickly and not use the store, e.g. set an event.
+        Return a function removing it.
+        """
+        key = ("task", msg_id) if msg_id is not None else ("topic", topic)
+        with self._lock:
+            self._watchers.setdefault(key, []).append(callback)
+
+        def unwatch():
+            with self._lock:
+                callbacks = self._watchers.get(key)
+                if callbacks is not None and callback in callbacks:
+                    callbacks.remove(callback)
+                    if not callbacks:
+                        del self._watchers[key]
+
+        return unwatch
+
+    def wait_for(self, changed: Callable[[], bool], timeout: Optional[float] = None, msg_id: Optional[str] = None,
+                 topic: Optional[str] = None) -> bool:
+        """
+        Wait up to ``timeout`` seconds for ``changed()`` to return True, checking it when ``msg_id`` or ``topic`` change.
+
+        See :meth:`watch`. Return the last value returned by ``changed()``.
+        """
+        event = threading.Event()
+        unwatch = self.watch(event.set, msg_id, topic)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while not changed():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0 or not event.wait(remaining):
+                    return changed()
+                event.clear()
+            return True
+        finally:
+            unwatch()
+
+    def wait_state(self, msg_id: str, last: Optional[str] = None, timeout: Optional[float] = None) \
+            -> Optional[TaskResult]:
+        """
+        Wait up to ``timeout`` seconds for the state of a task to differ from ``last``, then return the task.
+
+        ``last`` is a :class:`TaskState` value, or "unknown" for a task that isn't
+        recorded. If it's None, the state of the task when called is used.
+        """
+        if last is None:
+            last = self.state(msg_id)
+        self.wait_for(lambda: self.state(msg_id) != last, timeout, msg_id=msg_id)
+        return self.get(msg_id)
+
+    def wait_finished(self, msg_id: str, timeout: Optional[float] = None) -> Optional[TaskResult]:
+        """
+        Wait up to ``timeout`` seconds for a task to be done or failed, then return it.
+
+        None is returned if the task isn't recorded, or stops being meanwhile.
+        """
+        self.wait_for(lambda: self.finished(msg_id), timeout, msg_id=msg_id)
+        return self.get(msg_id)
+
+    def finished(self, msg_id: str) -> bool:
+        """
+        Return True if a task is done or failed, or isn't recorded.
+        """
+        return self.state(msg_id) not in (TaskState.QUEUED.value, TaskState.RUNNING.value)
+
+    def wait_pending(self, last: Optional[int] = None, timeout: Optional[float] = None,
+                     topic: Optional[str] = None) -> int:
+        """
+        Wait up to ``timeout`` seconds for the number of unfinished tasks of ``topic`` to differ from ``last``.
+
+        Then return it. Tasks of any topic are counted if ``topic`` is None. If
+        ``last`` is None, the number of tasks when called is used.
+        """
+        if last is None:
+            last = self.pending(topic)
+        self.wait_for(lambda: self.pending(topic) != last, timeout, topic=topic)
+        return self.pending(topic)
+
+    def _notify(self, key):
+        # Must be called with _lock held.
+        for callback in self._watchers.get(key, ()):
+            callback()
+
+    def _count_pending(self, task, delta):
+        # Must be called with _lock held. Count a task in or out of the unfinished ones.
+        self._pending += delta
+        count = self._pending_topics.get(task.topic, 0) + delta
+        if count:
+            self._pending_topics[task.topic] = count
+        else:
+            self._pending_topics.pop(task.topic, None)
+
+        self._notify(("topic", None))
+        if task.topic is not None:
+            self._notify(("topic", task.topic))
+
+    def _remove(self, task):
+        # Must be called with _lock held.
+        if task is None:
+            return
+        del self._tasks[task.msg_id]
+        self.bytes -= task.size
+        if not task.state.finished:
+            self._count_pending(task, -1)
+        self._notify(("task", task.msg_id))
+
+    def _evict(self):
+        # Must be called with _lock held. Expired tasks are dropped from the LRU end,
+        # the others are found expired on lookup.
+        now = time.monotonic()
+        while self._tasks:
+            task = next(iter(self._tasks.values()))
+            if task.expires is not None and task.expires <= now:
+                self.expired += 1
+            elif (self.max_entries is not None and len(self._tasks) > self.max_entries) or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self.evicted += 1
+            else:
+                break
+            self._remove(task)
+
+    def stats(self) -> dict:
+        """
+        Return the number of tasks and bytes stored, and the tasks dropped so far.
+        """
+        with self._lock:
+            return {
+                "tasks": len(self._tasks),
+                "pending": self._pending,
+                "bytes": self.bytes,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+class ResultStoreMixIn:
+    """
+    Mix-in class giving a server a :class:`TaskResultStore`.
+    """
+
+    result_store_class = TaskResultStore
+
+    # Seconds finished tasks are kept, None to keep them until evicted
+    result_ttl = 300.0
+
+    # Tasks and bytes of results kept at most, None for no limit
+    result_max_entries = 10000
+    result_max_bytes = 64 << 20
+
+    results = None
+
+    def get_result_store(self) -> TaskResultStore:
+        """
+        Return the server's TaskResultStore, creating it on first use.
+        """
+        results = self.results
+        if results is None:
+            with _results_lock:
+                if self.results is None:
+                    self.results = self.result_store_class(
+                        self.result_ttl, self.result_max_entries, self.result_max_bytes
+                    )
+                results = self.results
+        return results
+
+
+_results_lock = threading.Lock()
+
+
+__all__ = ["ResultStoreMixIn", "TaskResult", "TaskResultStore", "TaskState"]
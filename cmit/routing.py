@@ -0,0 +1,267 @@
+"""
+Topic based request routing.
+
+Instead of dispatching on ``self.msg.topic`` inside every ``do_*`` method, handlers
+can be registered on a server mixing in :class:`RoutingMixIn` for a topic pattern
+and, optionally, a command::
+
+    class DemoServer(RoutingMixIn, server.CMITServer):
+        pass
+
+    demo_server = DemoServer(SOCKET_PATH, server.SimpleCMITRequestHandler)
+
+    @demo_server.route("billing.*.refresh", command="EXECUTE")
+    @cmit_response
+    def refresh_billing(handler):
+        account = handler.route.args[0]
+        ...
+        return CMITStatus.ACCEPTED, handler.msg
+
+Topics are split in segments at the dots. In a pattern, ``*`` matches exactly one
+segment and ``#``, which must be the last segment, matches any number of
+segments, including none. When several patterns match a topic, literal segments
+win over ``*``, which wins over ``#``, and routes registered for the command of
+the request win over routes registered for any command (``command=None``).
+
+Requests without a matching route fall back to the handler's ``do_*`` method.
+
+The patterns are compiled into one segment trie per command, so matching a topic
+costs O(number of segments) however many routes are registered.
+"""
+import threading
+from typing import Callable, NamedTuple, Optional, Tuple
+
+
+class RouteMatch(NamedTuple):
+    """A route matching the topic of a request."""
+
+    pattern: str
+    handler: Callable
+    # Topic segments matched by the wildcards of the pattern, in order.
+    args: Tuple[str, ...]
+
+
+class _TrieNode:
+
+    __slots__ = ("children", "star", "rest", "route")
+
+    def __init__(self):
+        self.children = {}
+        # Node of the "*" segment
+        self.star = None
+        # Route of a trailing "#" segment
+        self.rest = None
+        # (pattern, handler) of the route ending at this node
+        self.route = None
+
+
+class TopicRouter:
+    """
+    Registry of topic pattern routes, compiled into segment tries.
+    """
+
+    separator = "."
+
+    def __init__(self):
+        self._routes = []
+        self._tries = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def add(self, pattern: str, handler: Callable, command: Optional[str] = None):
+        """
+        Register ``handler`` for the topics matching ``pattern``.
+
+        ``handler`` is called with the request handler as its only argument, just like
+        a ``do_*`` method. ``command`` restricts the route to one command verb.
+        """
+        segments = pattern.split(self.separator)
+
+        if any(not segment for segment in segments):
+            raise ValueError(f"Empty segment in topic pattern {pattern!r}")
+
+        if "#" in segments[:-1]:
+            raise ValueError(f"'#' must be the last segment of topic pattern {pattern!r}")
+
+        if command is not None:
+            command = command.upper()
+
+        with self._lock:
+            for registered in self._routes:
+                if registered[0] == pattern and registered[2] == command:
+                    raise ValueError(f"Topic pattern {pattern!r} is already routed for {command or 'any command'}")
+
+            self._routes.append((pattern, handler, command))
+            # Compiled again on the next match
+            self._tries = None
+
+    def remove(self, pattern: str, command: Optional[str] = None):
+        """
+        Unregister the route of ``pattern`` for ``command``.
+        """
+        if command is not None:
+            command = command.upper()
+
+        with self._lock:
+            for index, registered in enumerate(self._routes):
+                if registered[0] == pattern and registered[2] == command:
+                    del self._routes[index]
+                    self._tries = None
+                    return
+
+        raise KeyError(pattern)
+
+    def handlers(self) -> list:
+        """
+        Return the registered handlers, in registration order.
+        """
+        with self._lock:
+            return [handler for _, handler, _ in self._routes]
+
+    def route(self, pattern: str, command: Optional[str] = None):
+        """
+        Decorator registering the decorated function for ``pattern``, see :meth:`add`.
+        """
+
+        def decorator(func):
+            self.add(pattern, func, command)
+            return func
+
+        return decorator
+
+    def compile(self) -> dict:
+        """
+        Build the segment trie of every command from the registered routes.
+        """
+        with self._lock:
+            tries = {}
+
+            for pattern, handler, command in self._routes:
+                node = tries.setdefault(command, _TrieNode())
+                segments = pattern.split(self.separator)
+
+                for segment in segments:
+                    if segment == "#":
+                        node.rest = (pattern, handler)
+                        break
+
+                    if segment == "*":
+                        if node.star is None:
+                            node.star = _TrieNode()
+                        node = node.star
+                    else:
+                        node = node.children.setdefault(segment, _TrieNode())
+                else:
+                    node.route = (pattern, handler)
+
+            self._tries = tries
+            return tries
+
+    def match(self, command: str, topic: str) -> Optional[RouteMatch]:
+        """
+        Return the route of ``topic`` for ``command``, None if no route matches.
+        """
+        tries = self._tries
+        if tries is None:
+            tries = self.compile()
+
+        if not tries:
+            return None
+
+        segments = topic.split(self.separator)
+
+        for key in (command, None):
+            root = tries.get(key)
+            if root is not None:
+                found = self._match(root, segments, 0, ())
+                if found is not None:
+                    return found
+
+        return None
+
+    def match_all(self, command: Optional[str], topic: str) -> list:
+        """
+        Return every route matching ``topic`` for ``command``, however specific, in no particular order.
+        """
+        tries = self._tries
+        if tries is None:
+            tries = self.compile()
+
+        matches = []
+        segments = topic.split(self.separator)
+
+        for key in {command, None}:
+            root = tries.get(key)
+            if root is not None:
+                self._match_all(root, segments, 0, (), matches)
+
+        return matches
+
+    def _match_all(self, node, segments, index, args, matches):
+        if node.rest is not None:
+            matches.append(RouteMatch(node.rest[0], node.rest[1], args + (self.separator.join(segments[index:]),)))
+
+        if index == len(segments):
+            if node.route is not None:
+                matches.append(RouteMatch(node.route[0], node.route[1], args))
+            return
+
+        segment = segments[index]
+
+        child = node.children.get(segment)
+        if child is not None:
+            self._match_all(child, segments, index + 1, args, matches)
+
+        if node.star is not None:
+            self._match_all(node.star, segments, index + 1, args + (segment,), matches)
+
+    def _match(self, node, segments, index, args):
+        if index == len(segments):
+            if node.route is not None:
+                return RouteMatch(node.route[0], node.route[1], args)
+            if node.rest is not None:
+                return RouteMatch(node.rest[0], node.rest[1], args + ("",))
+            return None
+
+        segment = segments[index]
+
+        child = node.children.get(segment)
+        if child is not None:
+            found = self._match(child, segments, index + 1, args)
+            if found is not None:
+                return found
+
+        if node.star is not None:
+            found = self._match(node.star, segments, index + 1, args + (segment,))
+            if found is not None:
+                return found
+
+        if node.rest is not None:
+            return RouteMatch(node.rest[0], node.rest[1], args + (self.separator.join(segments[index:]),))
+
+        return None
+
+
+class RoutingMixIn:
+    """
+    Mix-in class giving a server a :class:`TopicRouter` and the :meth:`route` decorator.
+    """
+
+    router_class = TopicRouter
+
+    router = None
+
+    def route(self, pattern: str, command: Optional[str] = None):
+        """
+        Decorator routing the requests whose topic matches ``pattern`` to the decorated function.
+
+        See :mod:`cmit.routing`.
+        """
+        if self.router is None:
+            self.router = self.router_class()
+        return self.router.route(pattern, command)
+
+
+__all__ = ["RouteMatch", "RoutingMixIn", "TopicRouter"]
@@ -0,0 +1,206 @@
+"""
+Priority queues of pending tasks.
+
+A single FIFO of tasks makes interactive jobs wait behind bulk backfills. A
+:class:`PriorityTaskQueue` keeps one FIFO per priority class and hands out the
+tasks of higher classes first::
+
+    tasks = PriorityTaskQueue()
+    tasks.set_priority("backfill.#", "low")
+
+    tasks.put(task, topic=handler.msg.topic, priority=handler.msg.priority)
+    ...
+    task = tasks.get(timeout=1.0)
+
+The class of a task is, in order: the ``priority`` given to :meth:`put` (e.g. the
+``priority`` field of the request message, a class name or index), the class of
+the first topic pattern (see :mod:`cmit.routing`) matching its topic, or
+``default_priority``.
+
+So that a steady flow of urgent tasks doesn't starve the others, a task waiting
+for ``aging_interval`` seconds is dequeued as if it were one class higher, and so
+on: taking the head of every class is O(number of classes).
+
+:meth:`PriorityTaskQueue.wait_depth` blocks until the number of queued tasks
+changes, for long POLLs.
+"""
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Optional, Sequence, Union
+
+from cmit.routing import TopicRouter
+
+
+class PriorityTaskQueue:
+    """
+    Thread-safe queue of tasks in priority classes, highest first, with aging.
+    """
+
+    def __init__(self, priorities: Sequence[str] = ("high", "normal", "low"), default_priority: str = "normal",
+                 aging_interval: Optional[float] = 10.0):
+        if default_priority not in priorities:
+            raise ValueError(f"Unknown default priority {default_priority!r}")
+
+        self.priorities = tuple(priorities)
+        self.default_priority = self.priorities.index(default_priority)
+        self.aging_interval = aging_interval
+
+        lock = threading.Lock()
+        # Notified when a task is queued, for get()
+        self._cond = threading.Condition(lock)
+        # Notified whenever the number of queued tasks changes, for wait_depth()
+        self._changed = threading.Condition(lock)
+        # One FIFO of (enqueued at, task) per class
+        self._queues = [deque() for _ in self.priorities]
+        self._topics = TopicRouter()
+
+        self.enqueued = [0] * len(self.priorities)
+        self.dequeued = [0] * len(self.priorities)
+        # Tasks dequeued ahead of a higher class thanks to aging
+        self.promoted = 0
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues)
+
+    def set_priority(self, pattern: str, priority: Union[str, int]):
+        """
+        Put the tasks whose topic matches ``pattern`` in class ``priority``, unless :meth:`put` is given one.
+        """
+        self._topics.add(pattern, self.priority_index(priority))
+
+    def priority_index(self, priority: Union[str, int]) -> int:
+        """
+        Return the index of a priority class, given by name or index.
+
+        Raise ValueError if there is no such class.
+        """
+        if isinstance(priority, str):
+            try:
+                return self.priorities.index(priority)
+            except ValueError:
+                raise ValueError(f"Unknown priority {priority!r}") from None
+
+        if isinstance(priority, bool) or not isinstance(priority, int) or not 0 <= priority < len(self.priorities):
+            raise ValueError(f"Unknown priority {priority!r}")
+        return priority
+
+    def classify(self, topic: Optional[str] = None, priority: Union[str, int, None] = None) -> int:
+        """
+        Return the class index of a task, see :meth:`put`.
+        """
+        if priority is not None:
+            return self.priority_index(priority)
+
+        if topic is not None:
+            route = self._topics.match(None, topic)
+            if route is not None:
+                return route.handler
+
+        return self.default_priority
+
+    def put(self, task: Any, topic: Optional[str] = None, priority: Union[str, int, None] = None):
+        """
+        Enqueue ``task`` in its class: ``priority`` if given, else the class of ``topic``, else the default one.
+        """
+        index = self.classify(topic, priority)
+        with self._cond:
+            self._queues[index].append((time.monotonic(), task))
+            self.enqueued[index] += 1
+            self._cond.notify()
+            self._changed.notify_all()
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        """
+        Dequeue the next task, waiting up to ``timeout`` seconds for one if ``block``.
+
+        Raise :class:`queue.Empty` if there is none.
+        """
+        with self._cond:
+            if block:
+                if not self._cond.wait_for(self._has_tasks, timeout):
+                    raise queue.Empty
+            elif not self._has_tasks():
+                raise queue.Empty
+
+            return self._pop()
+
+    def _has_tasks(self):
+        return any(self._queues)
+
+    def _pop(self):
+        # Must be called with _cond held and a task queued.
+        now = time.monotonic()
+        best = best_rank = None
+        first = None
+
+        for index, fifo in enumerate(self._queues):
+            if not fifo:
+                continue
+            if first is None:
+                first = index
+
+            rank = index
+            if self.aging_interval:
+                rank -= (now - fifo[0][0]) / self.aging_interval
+            if best is None or rank < best_rank:
+                best, best_rank = index, rank
+
+        if best != first:
+            self.promoted += 1
+
+        self.dequeued[best] += 1
+        self._changed.notify_all()
+        return self._queues[best].popleft()[1]
+
+    def remove(self, task: Any) -> bool:
+        """
+        Remove a queued task, return False if it isn't queued.
+        """
+        with self._cond:
+            for fifo in self._queues:
+                for entry in fifo:
+                    if entry[1] is task:
+                        fifo.remove(entry)
+                        self._changed.notify_all()
+                        return True
+        return False
+
+    def wait_depth(self, last: Optional[int] = None, timeout: Optional[float] = None) -> int:
+        """
+        Wait up to ``timeout`` seconds for the number of queued tasks to differ from ``last``, then return it.
+
+        If ``last`` is None, the number of tasks when called is used.
+        """
+        with self._changed:
+            if last is None:
+                last = sum(len(q) for q in self._queues)
+            self._changed.wait_for(lambda: sum(len(q) for q in self._queues) != last, timeout)
+            return sum(len(q) for q in self._queues)
+
+    def depths(self) -> dict:
+        """
+        Return the number of queued tasks of every class, by class name.
+        """
+        with self._cond:
+            return {name: len(fifo) for name, fifo in zip(self.priorities, self._queues)}
+
+    def stats(self) -> dict:
+        """
+        Return the queued, enqueued and dequeued tasks of every class, and the tasks promoted by aging.
+        """
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "depths": {name: len(fifo) for name, fifo in zip(self.priorities, self._queues)},
+                "oldest": {name: now - fifo[0][0] if fifo else 0.0
+                           for name, fifo in zip(self.priorities, self._queues)},
+                "enqueued": dict(zip(self.priorities, self.enqueued)),
+                "dequeued": dict(zip(self.priorities, self.dequeued)),
+                "promoted": self.promoted,
+            }
+
+
+__all__ = ["PriorityTaskQueue"]
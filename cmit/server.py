@@ -4,26 +4,152 @@ CMIT server classes.
 Note: BaseCMITRequestHandler doesn't implement any CMIT request; see
 SimpleCMITRequestHandler for simple implementation.
 """
+import array
+import base64
+import contextlib
+import copy
+import functools
+import io
 import json
 import logging
+import os
+import queue
+import select
+import signal
 import sys
 import socket
 import socketserver
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from secrets import randbits
 from typing import Any
 
 from cmit import CMITStatus
 from cmit.abc import _BaseStreamRequestHandler
-from cmit.messages import CMITMessage, ServerErrorMessage
-from cmit.utils import cmit_response
+from cmit.dedup import EVICTED, IN_PROGRESS
+from cmit.messages import CMITMessage, ServerErrorMessage, _is_deadline, _is_priority
+from cmit.oob import FDReceiver, map_payload
+from cmit.utils import cmit_response, send_message
 
 __version__ = "0.2.0"
 
 _MAXLINE = 65536
 
 
+@functools.lru_cache(maxsize=64)
+def _error_frame_parts(status, version, window, extra):
+    # The constant parts of an error response: the status and blank lines, and the
+    # JSON message following the msg_id and timestamp.
+    head = f"{version} {status.value} {status.phrase}\r\n\r\n".encode('latin-1')
+    payload = json.dumps(dict({
+        "code": status.value,
+        "reason": f"{status.phrase} - {status.description}",
+    }, **dict(extra)))
+    tail = ', "topic": %s, "payload": %s' % (json.dumps(f"error.{status.phrase}"), json.dumps(payload))
+    if window is not None:
+        tail += ', "window": %d' % window
+    return head, tail + '}'
+
+
+def error_frame(status, version, msg_id, window=None, **extra) -> bytes:
+    """
+    Return a complete error response for ``status``, ``extra`` items are added to its payload.
+
+    Only the msg_id and the timestamp of the message change from one response to the
+    next, everything else is built once. This keeps rejecting requests cheap when the
+    server is overloaded.
+    """
+    head, tail = _error_frame_parts(status, version, window, tuple(sorted(extra.items())))
+    msg = '{"_id": %s, "timestamp": %d%s' % (json.dumps(msg_id), time.time(), tail)
+    return head + base64.b64encode(msg.encode('latin-1')) + b"\r\n"
+
+
+def service_unavailable_frame(version, msg_id, retry_after, window=None) -> bytes:
+    """
+    Return a complete SERVICE_UNAVAILABLE response, telling the client to retry after ``retry_after`` seconds.
+    """
+    return error_frame(CMITStatus.SERVICE_UNAVAILABLE, version, msg_id, window, retry_after=retry_after)
+
+
+class AdmissionController:
+    """
+    Track the load of a server and decide whether new requests are admitted.
+
+    A request is rejected when ``max_in_flight`` requests are already being handled,
+    when more than ``max_queue_depth`` connections wait for a worker, or when the
+    requests completed during the last ``latency_window`` seconds took ``max_latency``
+    seconds on average. A limit set to None is not checked.
+
+    Since the latency only covers recently completed requests, it falls back to zero
+    once requests are rejected for ``latency_window`` seconds and requests are
+    admitted again.
+    """
+
+    def __init__(self, max_in_flight=None, max_queue_depth=None, max_latency=None, latency_window=1.0):
+        self.max_in_flight = max_in_flight
+        self.max_queue_depth = max_queue_depth
+        self.max_latency = max_latency
+        self.latency_window = latency_window
+
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        # (completion time, duration) of the requests completed within latency_window
+        self._latencies = deque()
+        self._latency_total = 0.0
+
+    def admit(self, queue_depth=0) -> bool:
+        """
+        Return True and count the request as in flight if it's admitted.
+        """
+        with self._lock:
+            if ((self.max_in_flight is not None and self.in_flight >= self.max_in_flight)
+                    or (self.max_queue_depth is not None and queue_depth > self.max_queue_depth)
+                    or (self.max_latency is not None and self._latency(time.monotonic()) > self.max_latency)):
+                self.rejected += 1
+                return False
+
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self, duration):
+        """
+        Record the completion of an admitted request that took ``duration`` seconds.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if self.max_latency is not None:
+                self._latencies.append((time.monotonic(), duration))
+                self._latency_total += duration
+
+    def _latency(self, now):
+        # Must be called with _lock held.
+        expired = now - self.latency_window
+        while self._latencies and self._latencies[0][0] < expired:
+            self._latency_total -= self._latencies.popleft()[1]
+        return self._latency_total / len(self._latencies) if self._latencies else 0.0
+
+    def stats(self) -> dict:
+        """
+        Return a snapshot of the requests in flight, admitted and rejected, and the recent latency.
+        """
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "latency": self._latency(time.monotonic()),
+            }
+
+
+_admission_lock = threading.Lock()
+
+
 class CMITServer(socketserver.TCPServer):
     address_family = socket.AF_UNIX
     logger = logging.getLogger()
@@ -45,6 +171,637 @@ class ThreadingCMITServer(socketserver.ThreadingMixIn, CMITServer):
     daemon_threads = True
 
 
+class ThreadPoolMixIn:
+    """
+    Mix-in class to handle requests in a bounded, autoscaling pool of threads.
+
+    Accepted connections are put on a queue of at most ``max_queue_size`` entries
+    and served by between ``min_threads`` and ``max_threads`` worker threads. A new
+    thread is only started when there are fewer idle workers than queued connections,
+    and threads above ``min_threads`` exit after ``thread_idle_timeout`` seconds
+    without work. Connections arriving while the queue is full are answered with
+    SERVICE_UNAVAILABLE and closed right away.
+
+    The time connections spent waiting in the queue is tracked and reported by
+    pool_stats(), which is what the pool limits should be sized from.
+    """
+
+    min_threads = 2
+    max_threads = 32
+    max_queue_size = 128
+    thread_idle_timeout = 30.0
+
+    # Number of most recent queue wait times kept for pool_stats().
+    queue_wait_window = 1024
+
+    _pool_queue = None
+
+    def server_activate(self):
+        super().server_activate()
+        self.start_pool()
+
+    def start_pool(self):
+        """
+        Create the request queue and start ``min_threads`` workers.
+        """
+        if self._pool_queue is not None:
+            return
+
+        self._pool_lock = threading.Lock()
+        self._pool_queue = queue.Queue(self.max_queue_size)
+        self._pool_threads = set()
+        self._pool_idle = 0
+        self._pool_served = 0
+        self._pool_rejected = 0
+        self._pool_wait_total = 0.0
+        self._pool_wait_max = 0.0
+        self._pool_waits = deque(maxlen=self.queue_wait_window)
+
+        with self._pool_lock:
+            for _ in range(self.min_threads):
+                self._spawn_pool_thread()
+
+    def _spawn_pool_thread(self):
+        # Must be called with _pool_lock held.
+        t = threading.Thread(target=self._pool_worker, daemon=True)
+        self._pool_threads.add(t)
+        self._pool_idle += 1
+        t.start()
+
+    def process_request(self, request, client_address):
+        """
+        Queue the connection for the worker pool, growing it if every worker is busy.
+        """
+        try:
+            self._pool_queue.put_nowait((request, client_address, time.monotonic()))
+        except queue.Full:
+            with self._pool_lock:
+                self._pool_rejected += 1
+            self.logger.warning(f"CMIT request queue full, rejecting connection from {client_address}")
+            self.reject_request(request)
+            return
+
+        with self._pool_lock:
+            if self._pool_idle < self._pool_queue.qsize() and len(self._pool_threads) < self.max_threads:
+                self._spawn_pool_thread()
+
+    def reject_request(self, request):
+        """
+        Answer a connection that can't be served with SERVICE_UNAVAILABLE and close it.
+        """
+        retry_after = getattr(self.RequestHandlerClass, "retry_after", 1.0)
+        try:
+            request.setblocking(False)
+            request.send(service_unavailable_frame("CMIT/1.0", "0", retry_after))
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def queue_depth(self) -> int:
+        """
+        Return the number of connections waiting for a worker thread.
+        """
+        return self._pool_queue.qsize() if self._pool_queue is not None else 0
+
+    def _pool_worker(self):
+        current = threading.current_thread()
+
+        while True:
+            try:
+                item = self._pool_queue.get(timeout=self.thread_idle_timeout)
+            except queue.Empty:
+                with self._pool_lock:
+                    if len(self._pool_threads) > self.min_threads:
+                        self._pool_threads.discard(current)
+                        self._pool_idle -= 1
+                        return
+                continue
+
+            # None is the shutdown sentinel put by server_close()
+            if item is None:
+                with self._pool_lock:
+                    self._pool_threads.discard(current)
+                    self._pool_idle -= 1
+                return
+
+            request, client_address, queued = item
+            wait = time.monotonic() - queued
+
+            with self._pool_lock:
+                self._pool_idle -= 1
+                self._pool_served += 1
+                self._pool_wait_total += wait
+                self._pool_wait_max = max(self._pool_wait_max, wait)
+                self._pool_waits.append(wait)
+
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._pool_lock:
+                    self._pool_idle += 1
+
+    def pool_stats(self) -> dict:
+        """
+        Return a snapshot of the pool size, queue depth and queue wait times (in seconds).
+        """
+        with self._pool_lock:
+            waits = sorted(self._pool_waits)
+            threads = len(self._pool_threads)
+            stats = {
+                "threads": threads,
+                "idle": self._pool_idle,
+                "busy": threads - self._pool_idle,
+                "queued": self._pool_queue.qsize(),
+                "served": self._pool_served,
+                "rejected": self._pool_rejected,
+                "queue_wait_avg": self._pool_wait_total / self._pool_served if self._pool_served else 0.0,
+                "queue_wait_max": self._pool_wait_max,
+            }
+
+        stats["queue_wait_p50"] = waits[len(waits) // 2] if waits else 0.0
+        stats["queue_wait_p99"] = waits[int(len(waits) * 0.99)] if waits else 0.0
+        return stats
+
+    def server_close(self):
+        super().server_close()
+
+        if self._pool_queue is None:
+            return
+
+        # Drop connections that never got served, then stop the workers.
+        while True:
+            try:
+                item = self._pool_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self.shutdown_request(item[0])
+
+        # Workers exit once they are done with their current connection.
+        with self._pool_lock:
+            threads = len(self._pool_threads)
+
+        for _ in range(threads):
+            self._pool_queue.put(None)
+
+
+class PreforkMixIn:
+    """
+    Mix-in class to serve requests from a set of pre-forked worker processes.
+
+    The parent process binds the listening socket as usual and then forks ``workers``
+    processes which all accept connections on the inherited socket. The parent only
+    supervises: a worker that exits while the server is running is replaced, SIGHUP
+    starts a rolling restart and SIGTERM/SIGINT are forwarded before the parent
+    itself stops.
+
+    In a rolling restart the workers are restarted ``restart_batch_size`` at a time:
+    each finishes its current request and exits, and the next ones are only
+    signalled once their replacements are ready to accept connections (or after
+    ``worker_ready_timeout`` seconds), so the others keep serving meanwhile.
+
+    Signal handlers are only installed when serve_forever() runs in the main thread;
+    otherwise use shutdown() to stop the server.
+    """
+
+    # Number of worker processes, defaults to the number of CPUs.
+    workers = None
+
+    # Seconds to wait before replacing a worker that died right after being spawned.
+    worker_restart_delay = 1.0
+
+    # Signals handled by the parent and forwarded to the workers.
+    forward_signals = (signal.SIGTERM, signal.SIGHUP, signal.SIGINT)
+
+    # Workers restarted together in a rolling restart.
+    restart_batch_size = 1
+
+    # Seconds a rolling restart waits for a replacement worker to be ready.
+    worker_ready_timeout = 10.0
+
+    worker_pids = None
+
+    _stopping = False
+    _is_shut_down = None
+    _restart_requested = False
+    _ready_fd = None
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Fork the workers and supervise them until shutdown.
+        """
+        self.worker_pids = {}
+        self._stopping = False
+        self._is_shut_down = threading.Event()
+        self._restart_requested = False
+        # Workers still to restart, and those being restarted
+        self._restart_queue = []
+        self._restart_batch = set()
+
+        previous_handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for sig in self.forward_signals:
+                previous_handlers[sig] = signal.signal(sig, self._handle_parent_signal)
+
+        try:
+            for _ in range(self.workers or os.cpu_count() or 1):
+                self.spawn_worker(poll_interval)
+
+            while self.worker_pids:
+                if self._restart_requested:
+                    self._restart_requested = False
+                    self._restart_queue = [pid for pid in self.worker_pids if pid not in self._restart_batch]
+                if not self._restart_batch and self._restart_queue and not self._stopping:
+                    self._restart_next()
+
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+
+                if not pid:
+                    time.sleep(poll_interval)
+                    continue
+
+                started = self.worker_pids.pop(pid, None)
+                if started is None:
+                    continue
+
+                if self._stopping:
+                    continue
+
+                restarted = pid in self._restart_batch
+                if status != 0:
+                    self.logger.warning(f"CMIT worker {pid} died (status {status}), restarting")
+
+                if not restarted and time.monotonic() - started < self.worker_restart_delay:
+                    time.sleep(self.worker_restart_delay)
+
+                if not self._stopping:
+                    self.spawn_worker(poll_interval, self.worker_ready_timeout if restarted else None)
+                self._restart_batch.discard(pid)
+
+        finally:
+            self.signal_workers(signal.SIGTERM)
+            for sig, handler in previous_handlers.items():
+                signal.signal(sig, handler)
+            self._is_shut_down.set()
+
+    def spawn_worker(self, poll_interval=0.5, ready_timeout=None):
+        """
+        Fork a single worker process serving the inherited listening socket.
+
+        With a ``ready_timeout``, wait up to that many seconds for the worker to be ready to accept connections.
+        """
+        ready_fd = write_fd = None
+        if ready_timeout is not None:
+            ready_fd, write_fd = os.pipe()
+
+        pid = os.fork()
+
+        if pid:
+            self.worker_pids[pid] = time.monotonic()
+            if ready_fd is not None:
+                os.close(write_fd)
+                try:
+                    if not select.select([ready_fd], [], [], ready_timeout)[0]:
+                        self.logger.warning(f"CMIT worker {pid} not ready after {ready_timeout}s")
+                finally:
+                    os.close(ready_fd)
+            return pid
+
+        # Before anything else: the parent's handlers would signal the other workers
+        self.worker_pids = {}
+        for sig in self.forward_signals:
+            signal.signal(sig, self._handle_worker_signal)
+
+        if ready_fd is not None:
+            os.close(ready_fd)
+        self._ready_fd = write_fd
+
+        status = 1
+        try:
+            self.serve_worker(poll_interval)
+            status = 0
+        except BaseException:
+            self.logger.exception(f"CMIT worker {os.getpid()} crashed")
+        finally:
+            os._exit(status)
+
+    def serve_worker(self, poll_interval=0.5):
+        """
+        Accept and handle requests inside a worker process until signalled to stop.
+        """
+        # Every worker is woken up for a new connection, only one wins the accept()
+        # and the others must not block on it.
+        self.socket.setblocking(False)
+
+        # Tell the parent a rolling restart may go on
+        if self._ready_fd is not None:
+            os.close(self._ready_fd)
+            self._ready_fd = None
+
+        super().serve_forever(poll_interval)
+        self.server_close()
+
+    def rolling_restart(self):
+        """
+        Restart the workers ``restart_batch_size`` at a time, see :class:`PreforkMixIn`.
+
+        Only flags the restart, serve_forever() carries it out.
+        """
+        self._restart_requested = True
+
+    def _restart_next(self):
+        batch = []
+        while self._restart_queue and len(batch) < self.restart_batch_size:
+            pid = self._restart_queue.pop(0)
+            if pid in self.worker_pids:
+                batch.append(pid)
+
+        self._restart_batch = set(batch)
+        for pid in batch:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    def signal_workers(self, signum):
+        """
+        Send a signal to every running worker.
+        """
+        for pid in list(self.worker_pids or ()):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def shutdown(self):
+        """
+        Stop the workers and the supervising serve_forever loop.
+
+        Must be called from another thread than the one running serve_forever().
+        """
+        self._stopping = True
+        self.signal_workers(signal.SIGTERM)
+        if self._is_shut_down is not None:
+            self._is_shut_down.wait()
+
+    def _handle_parent_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.rolling_restart()
+            return
+        self._stopping = True
+        self.signal_workers(signum)
+
+    def _handle_worker_signal(self, signum, frame):
+        # shutdown() blocks until serve_forever returns, so it can't run on the
+        # thread that is executing serve_forever.
+        threading.Thread(target=socketserver.BaseServer.shutdown, args=(self,), daemon=True).start()
+
+
+class HandoffMixIn:
+    """
+    Mix-in class to restart a server without refusing a single connection.
+
+    The next generation of the server, started while the current one is still
+    running, asks it for its listening socket over a UNIX socket at
+    ``handoff_address`` (by default the server address followed by ".handoff").
+    The current generation passes the listening socket, and the handoff socket
+    itself, to its successor as SCM_RIGHTS ancillary data. Once the successor
+    reports it's accepting connections, the current generation stops accepting
+    and drains its connections: requests are still answered, but as CMIT/1.0,
+    so persistent connections are closed after their next response and clients
+    reconnect to the new generation. Connections still open after
+    ``drain_timeout`` seconds are closed, then serve_forever() returns.
+
+    Connections waiting in the listen backlog belong to the socket and are
+    accepted by whichever generation calls accept() first, so none are lost.
+
+    The first generation binds the server address as usual, after removing a
+    stale socket file no server is listening on.
+    """
+
+    # Path of the UNIX socket the listening socket is handed over on.
+    handoff_address = None
+
+    # Seconds to wait for the predecessor, and the successor, during a handoff.
+    handoff_timeout = 5.0
+
+    # Seconds the connections of the previous generation have to complete once it stopped accepting.
+    drain_timeout = 30.0
+
+    # Set once the previous generation stops accepting, handlers then close the connection after each response.
+    draining = False
+
+    handed_off = False
+
+    _handoff_socket = None
+    _predecessor = None
+
+    def server_bind(self):
+        """
+        Take over the listening socket of a running server, or bind a new one.
+        """
+        if self.handoff_address is None:
+            self.handoff_address = f"{self.server_address}.handoff"
+
+        self._handoff_lock = threading.Condition()
+        self._handoff_connections = set()
+
+        if self.inherit_socket():
+            return
+
+        self._remove_stale_socket(self.server_address)
+        super().server_bind()
+
+        self._remove_stale_socket(self.handoff_address)
+        self._handoff_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._handoff_socket.bind(self.handoff_address)
+        self._handoff_socket.listen(1)
+
+    def server_activate(self):
+        super().server_activate()
+
+        # Tell the predecessor it can stop accepting
+        if self._predecessor is not None:
+            try:
+                self._predecessor.sendall(b"READY")
+            finally:
+                self._predecessor.close()
+                self._predecessor = None
+
+    def inherit_socket(self) -> bool:
+        """
+        Receive the listening and handoff sockets from a running server, return False if there is none.
+        """
+        predecessor = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        predecessor.settimeout(self.handoff_timeout)
+        try:
+            predecessor.connect(self.handoff_address)
+            fds = array.array("i")
+            msg, ancdata, flags, addr = predecessor.recvmsg(16, socket.CMSG_LEN(2 * fds.itemsize))
+        except (FileNotFoundError, ConnectionRefusedError):
+            predecessor.close()
+            return False
+
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+
+        if msg != b"HANDOFF" or len(fds) != 2:
+            for fd in fds:
+                os.close(fd)
+            predecessor.close()
+            raise OSError(f"Invalid handoff from {self.handoff_address}")
+
+        self.socket.close()
+        self.socket = socket.socket(self.address_family, self.socket_type, fileno=fds[0])
+        self._handoff_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=fds[1])
+        self.server_address = self.socket.getsockname()
+        self._predecessor = predecessor
+        self.logger.info(f"Took over the listening socket {self.server_address} from the previous generation")
+        return True
+
+    @staticmethod
+    def _remove_stale_socket(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        finally:
+            probe.close()
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Serve until shutdown() is called or a successor took over, then drain the connections.
+        """
+        self.handed_off = False
+        self._handoff_stopped = threading.Event()
+        listener = threading.Thread(target=self._serve_handoff, args=(poll_interval,), daemon=True)
+        listener.start()
+
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self._handoff_stopped.set()
+
+        if self.handed_off:
+            self.drain(self.drain_timeout)
+
+    def _serve_handoff(self, poll_interval):
+        self._handoff_socket.settimeout(poll_interval)
+
+        while not self._handoff_stopped.is_set():
+            try:
+                successor, _ = self._handoff_socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+
+            with successor:
+                if self.hand_off(successor):
+                    # serve_forever runs on another thread, so shutdown() can be called from here
+                    socketserver.BaseServer.shutdown(self)
+                    return
+
+    def hand_off(self, successor) -> bool:
+        """
+        Pass the listening and handoff sockets to a successor, return True once it accepts connections.
+        """
+        successor.settimeout(self.handoff_timeout)
+        fds = array.array("i", [self.socket.fileno(), self._handoff_socket.fileno()])
+        try:
+            successor.sendmsg([b"HANDOFF"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+            ready = successor.recv(16) == b"READY"
+        except OSError as e:
+            self.logger.warning(f"Handoff of {self.server_address} failed: {e!r}")
+            return False
+
+        if not ready:
+            self.logger.warning(f"Handoff of {self.server_address} failed, the successor didn't start")
+            return False
+
+        self.logger.info(f"Handed off {self.server_address} to the next generation, draining connections")
+        self.handed_off = True
+        return True
+
+    def process_request(self, request, client_address):
+        with self._handoff_lock:
+            self._handoff_connections.add(request)
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        super().shutdown_request(request)
+        with self._handoff_lock:
+            self._handoff_connections.discard(request)
+            self._handoff_lock.notify_all()
+
+    def drain(self, timeout=None):
+        """
+        Complete the requests in progress and close every connection within ``timeout`` seconds.
+
+        Every connection is closed after its next response, which tells the client
+        to reconnect, or once it has been idle for keep_alive_timeout seconds.
+        Closing idle persistent connections right away instead would fail requests
+        clients may be sending on them at that moment.
+        """
+        self.draining = True
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        with self._handoff_lock:
+            while self._handoff_connections:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    break
+                self._handoff_lock.wait(remaining)
+
+            leftovers = list(self._handoff_connections)
+
+        if leftovers:
+            self.logger.warning(f"Closing {len(leftovers)} connections still open after draining")
+            for request in leftovers:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def server_close(self):
+        super().server_close()
+        # The handoff socket file stays in place for the next generation
+        if self._handoff_socket is not None:
+            self._handoff_socket.close()
+
+
+class PooledCMITServer(ThreadPoolMixIn, CMITServer):
+    pass
+
+
+class PreforkCMITServer(PreforkMixIn, CMITServer):
+    pass
+
+
+class RestartableCMITServer(HandoffMixIn, ThreadingCMITServer):
+    pass
+
+
+def _is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def _version_number(version):
+    # "CMIT/1.2" -> (1, 2)
+    major, _, minor = version.partition("/")[2].partition(".")
+    return int(major), int(minor)
+
+
 class BaseCMITRequestHandler(_BaseStreamRequestHandler):
 
     """
@@ -119,6 +876,84 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
     The first thing to be written must be the response line. The follow
     with a blank line, and then the response message data.
 
+    Persistent connections:
+
+    A handler whose protocol_version is "CMIT/1.1" keeps the connection open
+    after answering a CMIT/1.1 request and serves further requests on it, until
+    the client closes it, no new request arrives within keep_alive_timeout
+    seconds or keep_alive_max_requests requests have been served. Since CMIT
+    has no headers, the version of the response line tells the client what
+    happens next: "CMIT/1.1" means the connection stays open, "CMIT/1.0" means
+    the server closes it after this response. Errors always close the
+    connection.
+
+    Clients may pipeline requests on a persistent connection, i.e. send further
+    requests before reading the responses. Requests are handled in order and
+    their responses are written in the same order.
+
+    Multiplexed connections:
+
+    A handler whose protocol_version is "CMIT/1.2" additionally accepts
+    CMIT/1.2 requests, which are persistent and multiplexed: every request is
+    handled concurrently (by up to mux_workers threads per connection) on a
+    shallow copy of the handler, and its response is written as soon as it is
+    ready, regardless of the order of the requests. Clients match responses to
+    requests by the msg_id of the message.
+
+    Flow control:
+
+    Responses on persistent connections carry a "window" field in their message,
+    the number of requests the client may have outstanding on the connection
+    (request_window). Every response written gives the client a credit back.
+    Clients that don't respect the window aren't served any faster: the server
+    reads a request only once it can handle it (one at a time, or up to
+    mux_workers on a multiplexed connection), the rest stays in the socket.
+
+    Admission control:
+
+    When max_in_flight, max_queue_depth or max_latency is set, the load of the
+    server is tracked by an AdmissionController shared by its handlers. Requests
+    arriving while the server is over one of these limits are answered with
+    SERVICE_UNAVAILABLE right away, the payload of the response holds a
+    retry_after hint (in seconds). The connection stays usable, so clients may
+    retry on it later. The controller's counters are reported by
+    admission_stats().
+
+    Deduplication:
+
+    The response frames of the commands in dedup_commands are cached by the
+    server's ResponseCache (see cmit.dedup), if it enables one. A request
+    re-using the command, topic and msg_id of one already handled gets the same
+    frame again, without running its route or do_* method.
+
+    Streamed responses:
+
+    A do_* method decorated with cmit_response may return an iterator of chunks
+    (e.g. a generator) instead of a message. Every chunk is sent as a frame of
+    its own as soon as it's produced, its message has "more" set to true, and
+    a terminator frame with "more" set to false ends the response. Its status
+    is INTERNAL_SERVER_ERROR if producing the chunks failed. Streamed responses
+    aren't cached for deduplication, and the messages of a BATCH collect the
+    payloads of their chunks in a list instead.
+
+    Optional commands:
+
+    This class doesn't implement any command. BATCH, SUBSCRIBE and PUBLISH, or
+    FETCH, COMMIT and PUBLISH are added by mixing BatchHandlerMixIn,
+    PubSubHandlerMixIn or TopicLogHandlerMixIn into the handler class, the
+    latter two along with the server mix-ins of cmit.pubsub and cmit.topiclog.
+    Routes, bulkheads, deduplication and result stores are enabled by mixing
+    their mix-in into the server class.
+
+    Out-of-band payloads:
+
+    On UNIX socket connections, a client may pass a large payload in a sealed
+    memory file whose descriptor is sent along with the request (see cmit.oob),
+    its message only carries the size of the payload in its "oob" field. The
+    handler maps the file read-only and sets it as the payload of self.msg,
+    self.msg.payload_view gives it without copying. Payloads larger than
+    max_oob_payload bytes are refused.
+
     """
 
     # The Python system version, truncated to its first component.
@@ -134,9 +969,85 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
     # The default request version.
     default_protocol_version = "CMIT/1.0"
 
+    # The highest protocol version served. Set this to "CMIT/1.1" to enable
+    # persistent connections; don't on servers handling one connection at a time.
+    protocol_version = "CMIT/1.0"
+
+    # Seconds a persistent connection may stay idle between two requests.
+    keep_alive_timeout = 5.0
+
+    # Number of requests served on a persistent connection before it's closed.
+    keep_alive_max_requests = 1000
+
+    # Threads handling the requests of one multiplexed (CMIT/1.2) connection,
+    # 0 handles them one after the other on the connection's thread.
+    mux_workers = 8
+
+    # Whether the current connection is multiplexed
+    multiplexed = False
+
+    # Requests a client may have outstanding (sent but not answered) on a persistent
+    # connection, advertised in the "window" field of every response message.
+    request_window = 32
+
+    # Admission control limits, None disables a limit. Requests are rejected with
+    # SERVICE_UNAVAILABLE while the server handles max_in_flight requests, more than
+    # max_queue_depth connections wait for a worker (see ThreadPoolMixIn) or the
+    # requests completed during the last latency_window seconds took more than
+    # max_latency seconds on average.
+    max_in_flight = None
+    max_queue_depth = None
+    max_latency = None
+    latency_window = 1.0
+
+    # Seconds rejected clients are told to wait before retrying.
+    retry_after = 1.0
+
+    admission_controller_class = AdmissionController
+
+    # Time the current request was admitted at, None if it wasn't counted
+    _admitted_at = None
+
+    # Route of the current request, see cmit.routing
+    route = None
+
+    # Whether requests may wait in the queue of a full bulkhead (see cmit.bulkhead),
+    # or are rejected right away.
+    bulkhead_wait = True
+
+    _bulkhead = None
+
+    # Commands whose responses are cached, to answer retries (see cmit.dedup)
+    dedup_commands = ("EXECUTE",)
+
+    # Key of the current request, claimed in the server's ResponseCache, see dedup_key()
+    _dedup_id = None
+
+    # Whether responses may be streamed, see send_stream()
+    allow_streaming = True
+
+    # Called with the frames of a streamed response, by servers writing them
+    # as the connection drains (see cmit.reactor), instead of writing them at once
+    stream_writer = None
+
+    # File the frames of a streamed response are written to, when the response
+    # of the current request is otherwise buffered
+    _stream_wfile = None
+
+    # Called, from any thread, when a stream paused by yielding None from its
+    # frames (e.g. a subscription) has more to send, on servers set up with a
+    # stream_writer. Given a number of seconds, the stream is resumed once they passed.
+    stream_wakeup = None
+
+    # Bytes of a payload passed out-of-band at most, 0 to not receive descriptors
+    max_oob_payload = 1 << 30
+
     # Tracks when it is time to close the request tunnel
     close_connection = False
 
+    # Number of requests parsed on this connection so far
+    requests_served = 0
+
     responses = {
         v: (v.phrase, v.description)
         for v in CMITStatus.__members__.values()
@@ -144,6 +1055,14 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
 
     logger = logging.getLogger()
 
+    def setup(self):
+        super().setup()
+
+        # Read with recvmsg, to receive the descriptors of out-of-band payloads
+        if self.max_oob_payload and getattr(self.connection, "family", None) == socket.AF_UNIX:
+            self.rfile.close()
+            self.rfile = io.BufferedReader(FDReceiver(self.connection))
+
     # noinspection PyUnresolvedReferences,PyAttributeOutsideInit
     def parse_request(self):
         """
@@ -156,11 +1075,12 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
         error response has already been sent back.
         """
 
-        # set default values for command, and request_version
+        # set default values for command, request_version and msg
         self.command = None
         self.request_version = version = self.default_protocol_version
+        self.msg = None
 
-        # As of right now all connections close after response
+        # Connections close after the response unless keep-alive is negotiated below
         self.close_connection = True
 
         # Convert from bytes to str
@@ -225,12 +1145,24 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
             if not 1 <= len(words) <= 2:
                 self.send_error(
                     CMITStatus.BAD_REQUEST,
-                    "Bad request syntax (%r)" % requestline)
+                    "Bad request syntax (%r)" % request_line)
                 return False
 
             # Store request command
             self.command = words[0]
 
+            self.requests_served += 1
+
+            # Keep the connection open if both ends speak CMIT/1.1, unless the server is draining
+            if (version_number >= (1, 1) and self.protocol_version >= "CMIT/1.1"
+                    and self.requests_served < self.keep_alive_max_requests
+                    and not getattr(self.server, "draining", False)):
+                self.close_connection = False
+
+            # ...and multiplex it if both ends speak CMIT/1.2
+            if version_number >= (1, 2) and self.protocol_version >= "CMIT/1.2":
+                self.multiplexed = True
+
             return True
 
     def parse_body(self):
@@ -261,11 +1193,40 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
             if not isinstance(self.msg, CMITMessage):
                 self.logger.debug(f"Invalid msg type: {type(self.msg)}")
 
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, ValueError):
             self.logger.error(f"Invalid request body: {msg_line}")
             self.send_error(CMITStatus.BAD_REQUEST, "Malformed request body")
             return False
 
+        if self.msg.oob is not None:
+            return self.attach_oob_payload()
+
+        return True
+
+    def attach_oob_payload(self):
+        """
+        Map the payload the current request passed out-of-band, and set it as the payload of its message.
+
+        Return False if the request was answered with an error.
+        """
+        receiver = getattr(getattr(self, "rfile", None), "raw", None)
+        if not isinstance(receiver, FDReceiver) or not receiver.fds:
+            self.send_error(CMITStatus.BAD_REQUEST, "Out-of-band payload missing",
+                            "Out-of-band payloads are only received on UNIX socket connections to threaded servers")
+            return False
+
+        fd = receiver.fds.popleft()
+        try:
+            if not _is_count(self.msg.oob) or self.msg.oob > self.max_oob_payload:
+                raise ValueError(f"Out-of-band payloads are at most {self.max_oob_payload} bytes")
+            self.msg.payload = map_payload(fd, self.msg.oob)
+        except (OSError, ValueError) as e:
+            self.send_error(CMITStatus.BAD_REQUEST, "Invalid out-of-band payload", str(e))
+            return False
+        finally:
+            os.close(fd)
+
+        self.msg.oob = None
         return True
 
     # noinspection PyUnresolvedReferences,PyAttributeOutsideInit
@@ -281,7 +1242,7 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
         try:
             self.logger.debug("handling request")
             # Read raw request line (first line in request)
-            self.raw_request_line = self.rfile.readline(_MAXLINE + 1)
+            self.raw_request_line = self.read_request_line()
             self.logger.debug(f"raw_request_line: {self.raw_request_line}")
 
             # If request line exceeds a maximum size, send error
@@ -306,28 +1267,49 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
             # prepare the method name
             mname = 'do_' + self.command
 
-            # check that method has been implemented on the server
-            if not hasattr(self, mname):
+            self.logger.debug(f"parsing body")
+            # retrieve data msg, reading the whole request before answering keeps
+            # a persistent connection usable after an error
+            if not self.parse_body():
+                return
+
+            # drop the request if the client stopped waiting for the response
+            if not self.check_deadline():
+                return
+
+            # check that a route or method has been implemented on the server
+            if not self.find_route() and not hasattr(self, mname):
                 self.send_error(
                     CMITStatus.NOT_IMPLEMENTED,
                     "Unsupported method (%r)" % self.command
                 )
                 return
 
-            self.logger.debug(f"parsing body")
-            # retrieve data msg
-            if not self.parse_body():
+            # shed the request if the server is overloaded
+            if not self.admit_request():
                 return
 
-            self.logger.debug(f"executing command: {mname}")
-            # retrieve command method
-            method = getattr(self, mname)
-
-            # call command method
-            method()
+            if self.multiplexed and self.mux_workers:
+                self.dispatch_multiplexed()
+                return
 
-            # flush write file and send response
-            self.wfile.flush()
+            self.logger.debug(f"executing command: {mname}")
+            # call the route or command method, within the bulkhead of the topic
+            try:
+                if self.enter_bulkhead():
+                    try:
+                        # the request may have waited for a bulkhead slot
+                        if self.check_deadline():
+                            self.invoke_once()
+                    finally:
+                        self.leave_bulkhead()
+            finally:
+                self.release_request()
+
+            # flush write file and send response, unless the client already pipelined
+            # further requests, whose responses are then sent along with this one
+            if self.close_connection or not self.has_pending_input():
+                self.wfile.flush()
 
         except socket.timeout as e:
             # a read or a write timed out.  Discard this connection
@@ -335,21 +1317,540 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
             self.close_connection = True
             return
 
-    def handle(self):
+    def find_route(self):
         """
-        Handle multiple requests if necessary.
+        Look up the route of the current request in the server's router.
+
+        The match is stored in the route attribute, return True if a route was found.
         """
-        self.close_connection = True
-        self.handle_one_request()
+        router = getattr(self.server, "router", None)
+        self.route = router.match(self.command, self.msg.topic) if router is not None else None
+        return self.route is not None
 
-        while not self.close_connection:
-            self.handle_one_request()
+    def invoke(self):
+        """
+        Run the route found by find_route(), or else the do_* method of the command.
+        """
+        if self.route is not None:
+            return self.route.handler(self)
+        return getattr(self, 'do_' + self.command)()
 
-    def send_error(self, code, message=None, explain=None, topic=None, msg_id=None):
+    def invoke_once(self):
         """
-        Send and log an error reply.
+        Run invoke(), unless the current request is the retry of one already handled.
+        """
+        if not self.claim_request():
+            return
 
-        This will send an error response, and therefore must be
+        with self.caching_response():
+            self.invoke()
+
+    @contextlib.contextmanager
+    def caching_response(self):
+        """
+        Cache the response written within the block for deduplication, see claim_request().
+
+        The response is buffered, then written to wfile. Nothing is cached if the
+        request isn't deduplicated, or if the block raises.
+        """
+        if self._dedup_id is None:
+            yield
+            return
+
+        wfile, self.wfile = self.wfile, io.BytesIO()
+        stream_wfile = self._stream_wfile
+        if stream_wfile is None:
+            self._stream_wfile = wfile
+        try:
+            yield
+        except BaseException:
+            self.abandon_request()
+            raise
+        else:
+            self.store_response(self.wfile.getvalue())
+        finally:
+            self._stream_wfile = stream_wfile
+            frame, self.wfile = self.wfile.getvalue(), wfile
+            wfile.write(frame)
+
+    @contextlib.contextmanager
+    def answering_errors(self, context=""):
+        """
+        Answer the current request with INTERNAL_SERVER_ERROR if the block raises.
+
+        Whatever the request wrote so far is discarded, ``context`` is appended to
+        the logged message.
+        """
+        try:
+            yield
+        except Exception:
+            self.logger.exception(f"Error handling {self.command} request {self.msg.msg_id}{context}")
+            self.wfile = io.BytesIO()
+            self._response_buffer = []
+            self.send_error(CMITStatus.INTERNAL_SERVER_ERROR)
+
+    def topic_logs(self):
+        """
+        Return the server's TopicLogStore, None if it keeps no topic logs.
+        """
+        get_topic_logs = getattr(self.server, "get_topic_logs", None)
+        return get_topic_logs() if get_topic_logs is not None else None
+
+    def result_store(self):
+        """
+        Return the server's TaskResultStore, None if it keeps no task results.
+        """
+        get_result_store = getattr(self.server, "get_result_store", None)
+        return get_result_store() if get_result_store is not None else None
+
+    def request_arguments(self) -> dict:
+        """
+        Return the fields of the payload of the current request, updated with its keyword arguments.
+        """
+        try:
+            payload = self.msg.payload
+        except UnicodeDecodeError:
+            # A binary out-of-band payload
+            return {}
+        if not isinstance(payload, str) or not payload.startswith("{"):
+            return {}
+
+        try:
+            payload = json.loads(payload)
+        except json.JSONDecodeError:
+            return {}
+
+        kwargs = payload.get("kwargs")
+        if isinstance(kwargs, dict):
+            payload.update(kwargs)
+        return payload
+
+    def dedup_cache(self):
+        """
+        Return the server's ResponseCache if the current request is subject to deduplication.
+        """
+        if self.command not in self.dedup_commands:
+            return None
+
+        get_response_cache = getattr(self.server, "get_response_cache", None)
+        return get_response_cache() if get_response_cache is not None else None
+
+    def claim_request(self):
+        """
+        Return True if the current request must be handled.
+
+        Retries of requests subject to deduplication are answered from the server's
+        ResponseCache instead: with the cached frame, PROCESSING while the first
+        request is still being handled, or DUPLICATE_REQUEST if its frame was
+        evicted. Otherwise its dedup_key() is claimed (_dedup_id) until the
+        response is stored or abandoned.
+        """
+        self._dedup_id = None
+        cache = self.dedup_cache()
+        if cache is None:
+            return True
+
+        key = self.dedup_key()
+        cached = cache.begin(key)
+        if cached is None:
+            self._dedup_id = key
+            return True
+
+        if cached is IN_PROGRESS:
+            frame = error_frame(CMITStatus.PROCESSING, self.response_version(), self.msg.msg_id,
+                                self.response_window())
+        elif cached is EVICTED:
+            frame = error_frame(CMITStatus.DUPLICATE_REQUEST, self.response_version(), self.msg.msg_id,
+                                self.response_window())
+        else:
+            # Answer with the version of this request, which may differ from the original one
+            frame = self.response_version().encode('latin-1') + cached[cached.index(b" "):]
+
+        self.send_frame(frame)
+        return False
+
+    def dedup_key(self):
+        """
+        Return the key of the current request in the server's ResponseCache.
+
+        Requests are the same if their command, topic and msg_id are, so
+        different requests reusing a msg_id aren't answered with each other's
+        response.
+        """
+        return "\0".join((self.command, str(self.msg.topic), str(self.msg.msg_id)))
+
+    def store_response(self, frame):
+        """
+        Cache the response frame of the current request, unless it's a server error.
+        """
+        if self._dedup_id is None:
+            # Released already, e.g. by a streamed response
+            return
+
+        if frame[frame.index(b" ") + 1:][:1] == b"4":
+            self.abandon_request()
+        elif self._dedup_id is not None:
+            self.dedup_cache().store(self._dedup_id, frame)
+            self._dedup_id = None
+
+    def abandon_request(self):
+        """
+        Release the msg_id of the current request without caching its response, so it's handled again.
+        """
+        if self._dedup_id is not None:
+            self.dedup_cache().abandon(self._dedup_id)
+            self._dedup_id = None
+
+    def check_deadline(self):
+        """
+        Return True if the deadline of the current request, if any, hasn't passed yet.
+
+        Otherwise the request is answered with REQUEST_TIMEOUT, a precomputed
+        response like SERVICE_UNAVAILABLE, and must not be handled.
+        """
+        deadline = self.msg.deadline
+        if deadline is None or time.time() < deadline:
+            return True
+
+        self.send_frame(error_frame(
+            CMITStatus.REQUEST_TIMEOUT, self.response_version(), self.msg.msg_id, self.response_window()
+        ))
+        return False
+
+    def find_bulkhead(self):
+        """
+        Return the server's Bulkhead matching the current request, None if there is none.
+        """
+        bulkheads = getattr(self.server, "bulkheads", None)
+        if bulkheads is None:
+            return None
+
+        match = bulkheads.match(self.command, self.msg.topic)
+        return match.handler if match is not None else None
+
+    def enter_bulkhead(self):
+        """
+        Take a slot of the bulkhead of the current request, see cmit.bulkhead.
+
+        Return True if the request may be handled, it must then leave the bulkhead
+        with leave_bulkhead(). Otherwise SERVICE_UNAVAILABLE was sent.
+        """
+        self._bulkhead = bulkhead = self.find_bulkhead()
+        if bulkhead is None:
+            return True
+
+        if bulkhead.acquire(self.bulkhead_wait):
+            return True
+
+        self._bulkhead = None
+        self.send_service_unavailable()
+        return False
+
+    def leave_bulkhead(self):
+        """
+        Give back the bulkhead slot taken by enter_bulkhead().
+        """
+        if self._bulkhead is not None:
+            self._bulkhead.release()
+            self._bulkhead = None
+
+    def dispatch_multiplexed(self):
+        """
+        Handle the current request of a multiplexed connection on a worker thread.
+
+        The request is handled by a shallow copy of this handler, which writes to its
+        own buffer. The buffer is written to the connection, in one piece, once the
+        response is complete.
+        """
+        if not hasattr(self, "_mux_executor"):
+            self._mux_executor = ThreadPoolExecutor(self.mux_workers, thread_name_prefix="cmit-mux")
+            self._mux_lock = threading.Lock()
+            self._mux_slots = threading.BoundedSemaphore(self.mux_workers)
+
+        # Stop reading further requests while every worker is busy
+        self._mux_slots.acquire()
+
+        request = copy.copy(self)
+        request.wfile = io.BytesIO()
+        request._response_buffer = []
+
+        self._mux_executor.submit(request.handle_multiplexed, self)
+
+    def handle_multiplexed(self, connection_handler):
+        """
+        Run the route or do_* method on a copy of the connection's handler (internal).
+        """
+        # The frames of a streamed response go to the connection right away
+        self._stream_wfile = connection_handler.wfile
+        try:
+            try:
+                with self.answering_errors():
+                    if self.enter_bulkhead():
+                        try:
+                            # the request may have waited for a worker or a bulkhead slot
+                            if self.check_deadline():
+                                self.invoke_once()
+                        finally:
+                            self.leave_bulkhead()
+            finally:
+                self.release_request()
+
+            with connection_handler._mux_lock:
+                try:
+                    connection_handler.wfile.write(self.wfile.getvalue())
+                    connection_handler.wfile.flush()
+                except OSError as e:
+                    self.log_error("Failed to send multiplexed response: %r", e)
+        finally:
+            connection_handler._mux_slots.release()
+
+    def admission_controller(self):
+        """
+        Return the AdmissionController of the server, None if no limit is set.
+
+        The controller is created by the first request handled by the server.
+        """
+        if self.max_in_flight is None and self.max_queue_depth is None and self.max_latency is None:
+            return None
+
+        controller = getattr(self.server, "admission_controller", None)
+        if controller is None:
+            with _admission_lock:
+                controller = getattr(self.server, "admission_controller", None)
+                if controller is None:
+                    controller = self.admission_controller_class(
+                        self.max_in_flight, self.max_queue_depth, self.max_latency, self.latency_window
+                    )
+                    self.server.admission_controller = controller
+        return controller
+
+    def admission_stats(self):
+        """
+        Return the statistics of the server's AdmissionController, None if admission control is disabled.
+        """
+        controller = self.admission_controller()
+        return controller.stats() if controller is not None else None
+
+    def admit_request(self):
+        """
+        Admit the current request, or reject it with SERVICE_UNAVAILABLE if the server is overloaded.
+
+        Return True if the request may be handled, it must then be released with
+        release_request() once answered.
+        """
+        self._admitted_at = None
+
+        controller = self.admission_controller()
+        if controller is None:
+            return True
+
+        queue_depth = getattr(self.server, "queue_depth", None)
+        if controller.admit(queue_depth() if queue_depth is not None else 0):
+            self._admitted_at = time.monotonic()
+            return True
+
+        self.send_service_unavailable()
+        return False
+
+    def release_request(self):
+        """
+        Record the completion of a request admitted by admit_request().
+        """
+        if self._admitted_at is not None:
+            self.admission_controller().release(time.monotonic() - self._admitted_at)
+            self._admitted_at = None
+
+    def send_service_unavailable(self):
+        """
+        Answer the current request with the precomputed SERVICE_UNAVAILABLE response.
+
+        Unlike send_error() the request isn't logged, the rejections are counted
+        by the AdmissionController instead.
+        """
+        self.send_frame(service_unavailable_frame(
+            self.response_version(), self.msg.msg_id, self.retry_after, self.response_window()
+        ))
+
+    def send_frame(self, frame):
+        """
+        Write a complete, pre-encoded response.
+        """
+        lock = getattr(self, "_mux_lock", None)
+        if lock is None:
+            self.wfile.write(frame)
+            if not self.close_connection:
+                self.wfile.flush()
+        else:
+            with lock:
+                self.wfile.write(frame)
+                self.wfile.flush()
+
+    def send_stream(self, status, chunks):
+        """
+        Answer the current request with a streamed response, one frame per chunk of ``chunks``.
+
+        A chunk is a CMITMessage or the payload of one. The frames are written as the
+        chunks are produced, so a large result never has to be held in memory, and
+        are followed by a terminator frame. Where streaming isn't possible (see
+        allow_streaming) a single message is sent instead, its payload the list of
+        the chunks' payloads.
+        """
+        # A retry is handled again rather than answered with a partial stream
+        self.abandon_request()
+
+        if not self.allow_streaming:
+            msg = CMITMessage(self.msg.topic, self.msg.msg_id)
+            msg.payload = [self.stream_message(chunk).payload for chunk in chunks]
+            send_message(self, status, msg)
+            return
+
+        self.log_request(status)
+        frames = self.stream_frames(status, chunks)
+        if self.stream_writer is not None:
+            self.stream_writer(frames)
+            return
+
+        try:
+            for frame in frames:
+                self.write_stream_frame(frame)
+        finally:
+            frames.close()
+
+    def stream_frames(self, status, chunks):
+        """
+        Yield the frames of a streamed response, see send_stream().
+        """
+        try:
+            try:
+                for chunk in chunks:
+                    yield self.response_frame(status, self.stream_message(chunk, more=True))
+            except Exception:
+                self.logger.exception(f"Error streaming the response to {self.command} request {self.msg.msg_id}")
+                yield self.stream_end_frame(CMITStatus.INTERNAL_SERVER_ERROR, failed=True)
+            else:
+                yield self.stream_end_frame(status)
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+
+    def stream_message(self, chunk, more=None):
+        """
+        Return the message of a chunk of the current request's streamed response.
+        """
+        if isinstance(chunk, CMITMessage):
+            msg = chunk
+        else:
+            msg = CMITMessage(self.msg.topic, self.msg.msg_id)
+            msg.payload = chunk
+
+        # The client matches the frames to the request by their msg_id
+        msg.msg_id = self.msg.msg_id
+        msg.more = more
+        return msg
+
+    def stream_end_frame(self, status, failed=False):
+        """
+        Return the terminator frame of the current request's streamed response.
+        """
+        if failed:
+            phrase = self.responses[status][0]
+            msg = self.error_message_class(
+                f"error.{phrase}", self.msg.msg_id, int(datetime.utcnow().timestamp()), status,
+                f"{phrase} - The streamed response was interrupted"
+            )
+        else:
+            msg = CMITMessage(self.msg.topic, self.msg.msg_id)
+
+        msg.more = False
+        return self.response_frame(status, msg)
+
+    def response_frame(self, status, msg):
+        """
+        Return a complete response frame carrying ``msg``.
+        """
+        self.advertise_window(msg)
+        phrase = self.responses[status][0] if status in self.responses else ''
+        line = "%s %d %s\r\n\r\n" % (self.response_version(), status, phrase)
+        return line.encode('latin-1') + msg() + b"\r\n"
+
+    def write_stream_frame(self, frame):
+        """
+        Write and flush a frame of a streamed response.
+        """
+        wfile = self._stream_wfile if self._stream_wfile is not None else self.wfile
+        lock = getattr(self, "_mux_lock", None)
+        if lock is None:
+            wfile.write(frame)
+            wfile.flush()
+        else:
+            with lock:
+                wfile.write(frame)
+                wfile.flush()
+
+    def discard_output(self):
+        """
+        Drop the output not yet sent to a client that went away, and close the connection.
+
+        Flushing it, after the request or when the handler finishes, would only fail again.
+        """
+        self.close_connection = True
+        wfile, self.wfile = self.wfile, io.BytesIO()
+        raw = getattr(wfile, "raw", None)
+        if raw is not None:
+            # The buffered writer is closed with it, without flushing
+            raw.close()
+
+    def has_pending_input(self):
+        """
+        Return True if more data from the client is waiting to be read.
+        """
+        connection = getattr(self, "connection", None)
+        if not isinstance(connection, socket.socket):
+            return False
+
+        poller = select.poll()
+        poller.register(connection, select.POLLIN)
+        return bool(poller.poll(0))
+
+    def read_request_line(self):
+        """
+        Read the raw request line.
+
+        On a persistent connection the next request line is waited for at most
+        keep_alive_timeout seconds, an idle connection is treated as closed.
+        """
+        if not self.requests_served or not hasattr(self, "connection"):
+            return self.rfile.readline(_MAXLINE + 1)
+
+        self.connection.settimeout(self.keep_alive_timeout)
+        try:
+            return self.rfile.readline(_MAXLINE + 1)
+        except socket.timeout:
+            return b""
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle(self):
+        """
+        Handle multiple requests if necessary.
+        """
+        self.close_connection = True
+        try:
+            self.handle_one_request()
+
+            while not self.close_connection:
+                self.handle_one_request()
+        finally:
+            # Let requests of a multiplexed connection finish before it's closed
+            if hasattr(self, "_mux_executor"):
+                self._mux_executor.shutdown(wait=True)
+
+    def send_error(self, code, message=None, explain=None, topic=None, msg_id=None):
+        """
+        Send and log an error reply.
+
+        This will send an error response, and therefore must be
         called before any other output is generated. First it logs
         the error, then it sends a :class:`ServerErrorMessage`
         formatted response to the client.
@@ -374,24 +1875,38 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
         if topic is None:
             topic = f"error.{message}"
         if msg_id is None:
-            msg_id = "%032x" % randbits(128)
+            msg_id = self.msg.msg_id if self.msg is not None else "%032x" % randbits(128)
 
         # Log the error
         self.log_error("code %d, message %s", code, message)
 
+        # Unless the whole request was read, the connection can't be reused
+        if self.msg is None:
+            self.close_connection = True
+
         # Prepare error_message_class
         msg = self.error_message_class(
             topic, msg_id, int(datetime.utcnow().timestamp()), code, f"{message} - {explain}"
         )
+        self.advertise_window(msg)
 
-        # append status and reason to response
+        # append status and reason to response, followed by the blank line and the error message
         self.send_response(code, message)
-
-        # flush the response line
-        self.flush_response_line()
-
-        # write error message to response body
-        self.wfile.write(msg())
+        self._response_buffer.append(b"\r\n")
+        self._response_buffer.append(msg() + b"\r\n")
+
+        # write the whole response at once, other requests of a multiplexed connection may be
+        # writing theirs concurrently
+        lock = getattr(self, "_mux_lock", None)
+        if lock is None:
+            self.flush_response_line()
+        else:
+            with lock:
+                self.flush_response_line()
+
+        # the client waits for the response if the connection stays open
+        if not self.close_connection:
+            self.wfile.flush()
 
     def send_response(self, code, message=None):
         """
@@ -409,7 +1924,13 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
 
     # noinspection PyAttributeOutsideInit
     def send_response_status(self, code, message=None):
-        """Send the response status line."""
+        """
+        Send the response status line.
+
+        The line carries protocol_version, or the request's version if that's
+        older, while the connection is kept open and "CMIT/1.0" when it will be
+        closed after this response.
+        """
         if message is None:
             if code in self.responses:
                 message = self.responses[code][0]
@@ -420,9 +1941,32 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
             self._response_buffer = []
 
         self._response_buffer.append(
-            ("%s %d %s\r\n" % (self.default_protocol_version, code, message)).encode('latin-1', 'strict')
+            ("%s %d %s\r\n" % (self.response_version(), code, message)).encode('latin-1', 'strict')
         )
 
+    def response_version(self):
+        """Return the protocol version of the response line."""
+        if self.close_connection:
+            return self.default_protocol_version
+        # Never newer than the client's version
+        return min(self.protocol_version, self.request_version, key=_version_number)
+
+    def response_window(self):
+        """
+        Return the request window advertised to the client, None if the connection is closed after the response.
+
+        Writing a response gives the client back one credit, so a client keeping at
+        most that many requests outstanding never has more requests waiting on
+        the server than the window. Override to adapt the window to the load.
+        """
+        return None if self.close_connection else self.request_window
+
+    def advertise_window(self, msg):
+        """
+        Add the request window to a response message.
+        """
+        msg.window = self.response_window()
+
     def end_response_line(self):
         """
         Send the blank line ending the response line.
@@ -530,6 +2074,441 @@ class BaseCMITRequestHandler(_BaseStreamRequestHandler):
         setattr(self, "request_msg", value)
 
 
+class BatchHandlerMixIn:
+    """
+    Mix-in class adding the BATCH command to a request handler.
+
+    A BATCH request carries a list of messages in its payload, each with its
+    own command, topic and msg_id. They are handled one after the other like
+    separate requests, and answered by a single response whose payload lists
+    the status and message payload of every one of them.
+    """
+
+    # Messages a BATCH request may carry at most
+    max_batch_size = 1000
+
+    def do_BATCH(self):
+        """
+        Serve a BATCH request, handling every message it carries.
+        """
+        entries = self.parse_batch()
+        if entries is None:
+            return
+
+        results = []
+        with self.handling_batch():
+            for entry in entries:
+                with self.handling_batch_entry(results):
+                    if self.begin_batch_entry(entry) and self.check_deadline() and self.enter_bulkhead():
+                        try:
+                            self.invoke_once()
+                        finally:
+                            self.leave_bulkhead()
+
+        self.send_batch_results(results)
+
+    @contextlib.contextmanager
+    def handling_batch(self):
+        """
+        Restore the state of the BATCH request once the block handled its entries.
+        """
+        batch = self.msg, self.command, self.route, self.close_connection, self.allow_streaming
+        try:
+            # A batch is answered by a single frame
+            self.allow_streaming = False
+            yield
+        finally:
+            self.msg, self.command, self.route, self.close_connection, self.allow_streaming = batch
+
+    @contextlib.contextmanager
+    def handling_batch_entry(self, results):
+        """
+        Append the result of the batch entry the block handles to ``results``.
+
+        The response of the entry is buffered, an entry failing gets an error
+        status rather than failing the batch.
+        """
+        wfile, self.wfile = self.wfile, io.BytesIO()
+        try:
+            with self.answering_errors(" of a batch"):
+                yield
+        finally:
+            frame, self.wfile = self.wfile.getvalue(), wfile
+        results.append(self.batch_result(frame))
+
+    def parse_batch(self):
+        """
+        Return the entries of the current BATCH request, None if it was answered with an error.
+        """
+        try:
+            payload = json.loads(self.msg.payload)
+            entries = payload["messages"]
+        except (ValueError, TypeError, KeyError):
+            entries = None
+
+        if not isinstance(entries, list):
+            self.send_error(CMITStatus.BAD_REQUEST, "Invalid batch",
+                            "The payload of a BATCH request must hold a list of messages")
+            return None
+
+        if len(entries) > self.max_batch_size:
+            self.send_error(CMITStatus.BAD_REQUEST, "Batch too large",
+                            f"A batch carries at most {self.max_batch_size} messages")
+            return None
+
+        return entries
+
+    def begin_batch_entry(self, entry):
+        """
+        Make a message of the current batch the current request, return True if it's to be handled.
+
+        Otherwise it was answered with an error.
+        """
+        if not isinstance(entry, dict) or not isinstance(entry.get("command"), str) or \
+                not isinstance(entry.get("topic"), str) or not _is_priority(entry.get("priority")) or \
+                not _is_deadline(entry.get("deadline")):
+            self.send_error(CMITStatus.BAD_REQUEST, "Invalid batch message",
+                            "Batch messages need a command and a topic, a priority class name or index and a "
+                            "timestamp deadline if any",
+                            msg_id=(entry.get("_id") if isinstance(entry, dict) else None) or "")
+            return False
+
+        msg = CMITMessage(entry["topic"], msg_id=entry.get("_id") or "%032x" % randbits(128))
+        msg.payload = entry.get("payload", "")
+        msg.deadline = entry.get("deadline", self.msg.deadline)
+        msg.priority = entry.get("priority")
+
+        self.msg = msg
+        # Commands are case-sensitive, like in a request line
+        self.command = entry["command"]
+        self.route = None
+
+        if self.command in ("BATCH", "SUBSCRIBE", "FETCH") or \
+                (not self.find_route() and not hasattr(self, 'do_' + self.command)):
+            self.send_error(CMITStatus.NOT_IMPLEMENTED, "Unsupported method in a batch (%r)" % self.command)
+            return False
+
+        # The messages of a batch are handled one after the other, one waiting would hold up the others
+        if self.command == "WAIT" or (self.command == "POLL" and self.request_arguments().get("wait")):
+            self.send_error(CMITStatus.BAD_REQUEST, "Waiting requests can't be batched",
+                            "WAIT requests and POLL requests with a wait budget must be sent on their own")
+            return False
+
+        return True
+
+    @staticmethod
+    def batch_result(frame):
+        """
+        Return the entry of the BATCH response for the response frame of one of its messages.
+        """
+        try:
+            status_line, _, message_line = frame.split(b"\r\n")[:3]
+            status = int(status_line.split(None, 2)[1])
+            msg = CMITMessage.parse_message(message_line)
+        except (ValueError, IndexError):
+            return {"_id": None, "status": CMITStatus.INTERNAL_SERVER_ERROR.value, "payload": ""}
+
+        payload = msg.payload
+        if payload.startswith("{"):
+            payload = json.loads(payload)
+        return {"_id": msg.msg_id, "status": status, "topic": msg.topic, "payload": payload}
+
+    def send_batch_results(self, results):
+        """
+        Answer the current BATCH request with the results of its messages.
+        """
+        msg = CMITMessage(self.msg.topic, self.msg.msg_id)
+        msg.payload = {"results": results}
+        send_message(self, CMITStatus.OK, msg)
+
+
+class PubSubHandlerMixIn:
+    """
+    Mix-in class adding the SUBSCRIBE and PUBLISH commands to a request handler.
+
+    A SUBSCRIBE request, its topic a topic pattern, turns its connection into a
+    streamed response carrying the messages published to the matching topics,
+    until the client closes it. A PUBLISH request publishes its message to the
+    subscribers of its topic, and appends it to the log of its topic if the
+    server keeps topic logs. The server needs a broker, see cmit.pubsub.
+    """
+
+    # Seconds between the checks that the client of a subscription is still
+    # connected, on servers without a stream_writer
+    subscriber_poll_interval = 1.0
+
+    def do_SUBSCRIBE(self):
+        """
+        Serve a SUBSCRIBE request, pushing the messages published to the topics matching its topic.
+        """
+        subscription = self.begin_subscription()
+        if subscription is None:
+            return
+
+        if self.stream_writer is not None and self.stream_wakeup is not None:
+            subscription.wakeup = self.stream_wakeup
+            self.stream_writer(self.subscription_frames(subscription))
+            return
+
+        frames = self.subscription_frames(subscription, self.subscriber_poll_interval)
+        try:
+            for frame in frames:
+                if frame is not None:
+                    self.write_stream_frame(frame)
+                elif self.client_disconnected():
+                    break
+        except OSError as e:
+            self.log_error("Subscriber of %s went away: %r", subscription.pattern, e)
+            self.discard_output()
+        finally:
+            frames.close()
+
+    def begin_subscription(self):
+        """
+        Subscribe to the topics matching the topic of the current request, and acknowledge it.
+
+        Return the Subscription, None if the request was answered with an error.
+        """
+        get_broker = getattr(self.server, "get_broker", None)
+        if get_broker is None:
+            self.send_error(CMITStatus.NOT_IMPLEMENTED, "Unsupported method (%r)" % self.command)
+            return None
+
+        if self.multiplexed:
+            self.send_error(CMITStatus.BAD_REQUEST, "Subscriptions need a connection of their own",
+                            "SUBSCRIBE isn't supported on multiplexed connections")
+            return None
+
+        try:
+            subscription = get_broker().subscribe(self.msg.topic)
+        except ValueError as e:
+            self.send_error(CMITStatus.BAD_REQUEST, "Invalid topic pattern", str(e))
+            return None
+
+        # The subscription holds the connection until the client closes it, it
+        # doesn't count as a request in flight
+        self.close_connection = True
+        self.leave_bulkhead()
+        self.release_request()
+
+        self.log_request(CMITStatus.OK)
+        ack = self.stream_message({"subscribed": self.msg.topic}, more=True)
+        self.write_stream_frame(self.response_frame(CMITStatus.OK, ack))
+        return subscription
+
+    def subscription_frames(self, subscription, timeout=0.0):
+        """
+        Yield the frames of a subscription as they're published, then its terminator frame.
+
+        None is yielded when no frame arrived within ``timeout`` seconds. The
+        subscription is ended once the generator is closed.
+        """
+        try:
+            while True:
+                frames = subscription.take(timeout)
+                if frames is None:
+                    break
+                yield b"".join(frames) if frames else None
+
+            if subscription.overflowed:
+                yield self.stream_end_frame(CMITStatus.SERVICE_UNAVAILABLE, failed=True)
+            else:
+                yield self.stream_end_frame(CMITStatus.OK)
+        finally:
+            self.server.get_broker().unsubscribe(subscription)
+
+    def client_disconnected(self):
+        """
+        Return True if the client closed the connection, without consuming its pending input.
+        """
+        if not self.has_pending_input():
+            return False
+
+        try:
+            return not self.connection.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    @cmit_response
+    def do_PUBLISH(self):
+        """
+        Serve a PUBLISH request, appending its message to the log of its topic and pushing it to its subscribers.
+        """
+        publish = getattr(self.server, "publish", None)
+        topic_logs = self.topic_logs()
+        msg = CMITMessage(self.msg.topic, self.msg.msg_id)
+        if publish is None and topic_logs is None:
+            return CMITStatus.NOT_IMPLEMENTED, msg
+
+        try:
+            data = self.msg.payload
+        except UnicodeDecodeError:
+            # An out-of-band payload may be binary, messages are relayed as text
+            msg.payload = {"error": "Published payloads must be UTF-8 text"}
+            return CMITStatus.BAD_REQUEST, msg
+
+        payload = {}
+        if topic_logs is not None:
+            try:
+                payload["offset"] = topic_logs.append(self.msg.topic, data, self.msg.msg_id)
+            except ValueError as e:
+                msg.payload = {"error": str(e)}
+                return CMITStatus.BAD_REQUEST, msg
+
+        if publish is not None:
+            payload["subscribers"] = publish(self.msg.topic, data)
+        msg.payload = payload
+        return CMITStatus.OK, msg
+
+
+class TopicLogHandlerMixIn:
+    """
+    Mix-in class adding the FETCH, COMMIT and PUBLISH commands to a request handler.
+
+    A PUBLISH request is appended to the log of its topic (and pushed to its
+    subscribers if the server has a broker). A FETCH request reads a batch of
+    the log from the offset in its payload, up to max_bytes, as a streamed
+    response whose frames are copied from the log file to the socket. A COMMIT
+    request records the offset a consumer group goes on from. The server needs
+    topic logs, see cmit.topiclog.
+    """
+
+    # Bytes of messages a FETCH response carries at most
+    fetch_max_bytes = 1 << 20
+
+    do_PUBLISH = PubSubHandlerMixIn.do_PUBLISH
+
+    def do_FETCH(self):
+        """
+        Serve a FETCH request, sending a batch of the messages of the log of its topic.
+        """
+        batch = self.begin_fetch()
+        if batch is None:
+            return
+
+        frames = self.fetch_frames(batch)
+        if self.stream_writer is not None:
+            self.stream_writer(frames)
+            return
+
+        connection = getattr(self, "connection", None)
+        if not batch.count or self._stream_wfile is not None or not isinstance(connection, socket.socket):
+            try:
+                for frame in frames:
+                    self.write_stream_frame(frame)
+            finally:
+                frames.close()
+            return
+
+        frames.close()
+        try:
+            self.write_stream_frame(self.fetch_head())
+            with open(batch.fd, "rb", buffering=0, closefd=False) as f:
+                connection.sendfile(f, batch.position, batch.size)
+            self.write_stream_frame(self.fetch_end_frame(batch))
+        finally:
+            batch.close()
+
+    def begin_fetch(self):
+        """
+        Read the batch of messages a FETCH request asks for.
+
+        Return the LogBatch, to be sent and closed, None if the request was answered with an error.
+        """
+        topic_logs = self.topic_logs()
+        if topic_logs is None:
+            self.send_error(CMITStatus.NOT_IMPLEMENTED, "Unsupported method (%r)" % self.command)
+            return None
+
+        if self.multiplexed:
+            self.send_error(CMITStatus.BAD_REQUEST, "Fetches can't be multiplexed",
+                            "FETCH isn't supported on multiplexed connections")
+            return None
+
+        arguments = self.request_arguments()
+        offset = arguments.get("offset")
+        max_bytes = arguments.get("max_bytes", self.fetch_max_bytes)
+        group = arguments.get("group")
+        if not (offset is None or _is_count(offset)) or not _is_count(max_bytes) or not max_bytes or \
+                not (group is None or isinstance(group, str)):
+            self.send_error(CMITStatus.BAD_REQUEST, "Invalid FETCH arguments",
+                            "offset and max_bytes are non-negative integers, group a string")
+            return None
+
+        try:
+            batch = topic_logs.read(self.msg.topic, offset, min(max_bytes, self.fetch_max_bytes), group)
+        except ValueError as e:
+            self.send_error(CMITStatus.BAD_REQUEST, "Invalid log topic", str(e))
+            return None
+
+        self.abandon_request()
+        self.log_request(CMITStatus.OK)
+        return batch
+
+    def fetch_frames(self, batch, chunk_size=64 << 10):
+        """
+        Yield the frames of a FETCH response, the messages of ``batch`` read in chunks of ``chunk_size`` bytes.
+
+        Used where the batch can't be copied to the socket by the kernel. The batch
+        is closed once the generator is.
+        """
+        try:
+            if batch.count:
+                yield self.fetch_head()
+
+                position, end = batch.position, batch.position + batch.size
+                while position < end:
+                    chunk = os.pread(batch.fd, min(chunk_size, end - position), position)
+                    if not chunk:
+                        raise EOFError(f"Log of {self.msg.topic} truncated while being read")
+                    position += len(chunk)
+                    yield chunk
+
+            yield self.fetch_end_frame(batch)
+        finally:
+            batch.close()
+
+    def fetch_head(self):
+        """
+        Return the response line of a FETCH response, sent in place of the one of its first frame.
+        """
+        return ("%s %d %s\r\n\r\n" % (self.response_version(), CMITStatus.OK, CMITStatus.OK.phrase)).encode('latin-1')
+
+    def fetch_end_frame(self, batch):
+        """
+        Return the terminator frame of a FETCH response, carrying the offsets to go on from.
+        """
+        msg = CMITMessage(self.msg.topic, self.msg.msg_id)
+        msg.payload = {"offset": batch.offset, "next_offset": batch.next_offset, "end_offset": batch.end_offset}
+        msg.more = False
+        return self.response_frame(CMITStatus.OK, msg)
+
+    @cmit_response
+    def do_COMMIT(self):
+        """
+        Serve a COMMIT request, recording the offset of the log of its topic a consumer group goes on from.
+        """
+        msg = CMITMessage(self.msg.topic, self.msg.msg_id)
+        topic_logs = self.topic_logs()
+        if topic_logs is None:
+            return CMITStatus.NOT_IMPLEMENTED, msg
+
+        arguments = self.request_arguments()
+        group, offset = arguments.get("group"), arguments.get("offset")
+        if not isinstance(group, str) or not _is_count(offset):
+            msg.payload = {"error": "COMMIT needs a group and a non-negative integer offset"}
+            return CMITStatus.BAD_REQUEST, msg
+
+        try:
+            topic_logs.commit(self.msg.topic, group, offset)
+        except ValueError as e:
+            msg.payload = {"error": str(e)}
+            return CMITStatus.BAD_REQUEST, msg
+
+        msg.payload = {"group": group, "offset": offset}
+        return CMITStatus.OK, msg
+
+
 class SimpleCMITRequestHandler(BaseCMITRequestHandler):
     """
     Simple CMIT request handler with just PING command.
@@ -539,6 +2518,15 @@ class SimpleCMITRequestHandler(BaseCMITRequestHandler):
 
     server_version = "SimpleCMIT/" + __version__
 
+    # Seconds a long POLL may wait for a change at most, 0 to answer every POLL right away
+    max_poll_wait = 30.0
+
+    # Seconds a WAIT request may wait for its task to finish at most, 0 to answer right away
+    max_task_wait = 60.0
+
+    # Seconds before the deadline of a long POLL or a WAIT at which it's answered, to reach the client in time
+    poll_deadline_margin = 0.5
+
     @cmit_response
     def do_PING(self):
         """
@@ -553,23 +2541,211 @@ class SimpleCMITRequestHandler(BaseCMITRequestHandler):
     def do_EXECUTE(self):
         """
         Handle the EXECUTE command.
+
+        If the server keeps a result store (see cmit.results), the task is
+        recorded as done in it, for POLL and WAIT requests to find.
         """
 
         msg = CMITMessage(self.msg.topic, self.msg.msg_id)
         msg.payload = {"res": "Processed"}
 
+        results = self.result_store()
+        if results is not None:
+            results.add(self.msg.msg_id, self.msg.topic)
+            results.complete(self.msg.msg_id, {"res": "Processed"})
+
         return CMITStatus.ACCEPTED, msg
 
-    @cmit_response
     def do_POLL(self):
         """
         Handle the POLL command
+
+        A POLL naming a task returns its state and result from the server's result
+        store, otherwise the number of tasks of its topic still queued or running.
+        Without a result store, there are no tasks. With a ``wait`` budget it's a
+        long poll, see poll_wait(). On servers with a
+        stream_writer it's parked rather than blocking, see park_response().
         """
+        wait = self.poll_wait()
+        if wait and self.stream_writer is not None and self.stream_wakeup is not None:
+            key, changed = self.poll_watch()
+            self.park_response(changed, wait, lambda: (CMITStatus.OK, self.poll_payload()), **key)
+            return
 
         msg = CMITMessage(self.msg.topic, self.msg.msg_id)
-        msg.payload = {"depth": 0}
+        msg.payload = self.poll_payload(wait)
+        send_message(self, CMITStatus.OK, msg)
 
-        return CMITStatus.OK, msg
+    def poll_payload(self, wait=0.0):
+        """
+        Return the payload of the response to the current POLL request.
+
+        If ``wait`` is given, wait up to that many seconds for it to differ from the
+        value the client saw last, see poll_watch().
+        """
+        results = self.result_store()
+        task_id = self.poll_task_id()
+
+        if wait:
+            key, changed = self.poll_watch()
+            results.wait_for(changed, wait, **key)
+
+        if task_id is None:
+            return {"depth": results.pending(self.msg.topic) if results is not None else 0}
+
+        task = results.get(task_id) if results is not None else None
+        return task.as_payload() if task is not None else {"msg_id": task_id, "state": "unknown"}
+
+    def poll_watch(self):
+        """
+        Return what a long POLL waits for: the key to watch in the result store, and a predicate.
+
+        The key is given as keyword arguments of TaskResultStore.watch(). The
+        predicate returns True once the value polled differs from the ``last``
+        argument of the request, or from the value when this was called.
+        """
+        results = self.result_store()
+        task_id = self.poll_task_id()
+        last = self.request_arguments().get("last")
+
+        if task_id is None:
+            topic = self.msg.topic
+            if last is None:
+                last = results.pending(topic)
+            return {"topic": topic}, lambda: results.pending(topic) != last
+
+        if last is None:
+            last = results.state(task_id)
+        return {"msg_id": task_id}, lambda: results.state(task_id) != last
+
+    def do_WAIT(self):
+        """
+        Handle the WAIT command
+
+        A WAIT names a task like a POLL, and is answered once the task is done or
+        failed, with its state and result. If it isn't finished within task_wait()
+        seconds the request is answered with ACCEPTED and its current state. On
+        servers with a stream_writer it's parked like a long POLL.
+        """
+        task_id = self.poll_task_id()
+        if task_id is None:
+            self.send_error(CMITStatus.BAD_REQUEST, "Missing msg_id", "WAIT requests name the msg_id of a task")
+            return
+
+        wait = self.task_wait()
+        if wait and self.stream_writer is not None and self.stream_wakeup is not None:
+            key, finished = self.wait_watch(task_id)
+            self.park_response(finished, wait, lambda: self.wait_payload(task_id), **key)
+            return
+
+        msg = CMITMessage(self.msg.topic, self.msg.msg_id)
+        status, msg.payload = self.wait_payload(task_id, wait)
+        send_message(self, status, msg)
+
+    def park_response(self, changed, wait, respond, **key):
+        """
+        Answer the current request once ``changed()`` returns True, or ``wait`` seconds passed.
+
+        The response is handed to stream_writer as a stream paused until the result
+        store updates the task or topic named by ``key`` (see TaskResultStore.watch())
+        or the wait is over, so the server's thread isn't blocked meanwhile.
+        ``respond()`` returns the status and payload of the response.
+        """
+        self.stream_writer(self.parked_frames(changed, wait, respond, key))
+
+    def parked_frames(self, changed, wait, respond, key):
+        """
+        Yield None until ``changed()`` returns True or ``wait`` seconds passed, then the response frame.
+
+        See park_response().
+        """
+        deadline = time.monotonic() + wait
+        wakeup = self.stream_wakeup
+        unwatch = self.result_store().watch(wakeup, **key)
+        try:
+            wakeup(wait)
+            while not changed() and time.monotonic() < deadline:
+                yield None
+        finally:
+            unwatch()
+
+        msg = CMITMessage(self.msg.topic, self.msg.msg_id)
+        status, msg.payload = respond()
+
+        self.log_request(status)
+        yield self.response_frame(status, msg)
+
+    def wait_payload(self, task_id, wait=0.0):
+        """
+        Return the status and payload of the response to a WAIT request for ``task_id``.
+        """
+        results = self.result_store()
+        if wait:
+            key, finished = self.wait_watch(task_id)
+            results.wait_for(finished, wait, **key)
+
+        task = results.get(task_id) if results is not None else None
+        if task is None:
+            return CMITStatus.OK, {"msg_id": task_id, "state": "unknown"}
+        if not task.state.finished:
+            return CMITStatus.ACCEPTED, task.as_payload()
+        return CMITStatus.OK, task.as_payload()
+
+    def wait_watch(self, task_id):
+        """
+        Return what a WAIT request for ``task_id`` waits for, like poll_watch().
+        """
+        results = self.result_store()
+        return {"msg_id": task_id}, lambda: results.finished(task_id)
+
+    def task_wait(self):
+        """
+        Return the number of seconds the current WAIT request may wait for its task to finish.
+
+        It's the ``wait`` argument of the request if given, at most max_task_wait and
+        ending poll_deadline_margin seconds before the request's deadline. It's 0
+        on servers without a result store, where there are no tasks to wait for.
+        """
+        if self.result_store() is None:
+            return 0.0
+        return self.wait_budget(self.request_arguments().get("wait", self.max_task_wait), self.max_task_wait)
+
+    def poll_wait(self):
+        """
+        Return the number of seconds the current POLL request may wait for a change, 0 to answer right away.
+
+        It's the ``wait`` argument of the request, at most max_poll_wait and ending
+        poll_deadline_margin seconds before the request's deadline. The request is
+        answered as soon as the value polled differs from its ``last`` argument,
+        the state of the task or the number of tasks the client saw last (by
+        default, the value when the request arrived). It's 0 on servers without
+        a result store.
+        """
+        if self.result_store() is None:
+            return 0.0
+        return self.wait_budget(self.request_arguments().get("wait"), self.max_poll_wait)
+
+    def wait_budget(self, wait, limit):
+        """
+        Return the number of seconds the current request may wait, given its ``wait`` argument.
+
+        That's at most ``limit``, and ends poll_deadline_margin seconds before the request's deadline.
+        """
+        if not isinstance(wait, (int, float)) or wait <= 0:
+            return 0.0
+
+        wait = min(wait, limit)
+        if self.msg.deadline is not None:
+            wait = min(wait, self.msg.deadline - time.time() - self.poll_deadline_margin)
+        return max(wait, 0.0)
+
+    def poll_task_id(self):
+        """
+        Return the msg_id of the task a POLL request asks for, None if there is none.
+
+        It's read from the ``msg_id`` keyword argument of the payload, or its ``msg_id`` field.
+        """
+        return self.request_arguments().get("msg_id")
 
 
 __all__ = ['BaseCMITRequestHandler']
@@ -0,0 +1,464 @@
+"""
+Durable topic streams.
+
+Messages pushed to subscribers (see :mod:`cmit.pubsub`) are gone once delivered.
+With a topic log, every ``PUBLISH`` is also appended to a log of its topic, where
+consumers read it at their own pace, from any offset still retained. Servers
+keep topic logs by mixing in :class:`TopicLogMixIn`, and their handlers serve
+them by mixing in :class:`cmit.server.TopicLogHandlerMixIn`
+(:class:`cmit.aio.AsyncTopicLogHandlerMixIn` for asyncio servers)::
+
+    class DemoServer(TopicLogMixIn, ThreadingCMITServer):
+        topic_log_directory = "/var/lib/demo/topics"
+        topic_log_retention_bytes = 1 << 30
+
+    class DemoHandler(TopicLogHandlerMixIn, SimpleCMITRequestHandler):
+        pass
+
+Consumers send ``FETCH`` requests, the topic of the request the topic of the log,
+with the ``offset`` of the first message wanted and the ``max_bytes`` of messages
+returned at most. The response is streamed, a frame per message, the message
+carrying its ``offset``. Consumers of a ``group`` may leave out the offset to
+resume from the one committed by a ``COMMIT`` request.
+
+The log of a topic is a directory of segment files, named after the offset of
+their first message. A message is stored as the very frame sent to consumers, so
+that a FETCH is answered by copying a range of a segment file to the socket
+(``sendfile``) without reading it into the process, whatever the number of
+messages. Publishing only ever appends to the last segment, consumers reading
+older ones don't hold it up.
+
+Once the last segment grows over ``segment_size`` bytes a new one is started.
+The oldest segments are deleted while the log is larger than ``retention_bytes``,
+or when their last message is older than ``retention_seconds``. The last segment
+is kept whatever its size or age. Offsets committed by consumer groups are kept
+in ``offsets.json`` in the directory of the log.
+
+Appends are written to the page cache, they survive the process crashing but
+not a power failure unless ``fsync`` is set. A log is written by a single process.
+"""
+import json
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from secrets import randbits
+from typing import Dict, Optional
+
+from cmit import CMITStatus
+from cmit.messages import CMITMessage
+
+# Status line of the stored frames. A FETCH response replaces the one of its first
+# frame, the client only reads the version of that one.
+_RECORD_HEAD = ("CMIT/1.1 %d %s\r\n\r\n" % (CMITStatus.OK, CMITStatus.OK.phrase)).encode("latin-1")
+
+_SUFFIX = ".log"
+
+_OFFSETS = "offsets.json"
+
+# Topics are directory names: dot separated words, no wildcards
+_TOPIC_NAME = re.compile(r"[\w-]+(\.[\w-]+)*", re.ASCII)
+
+
+class LogBatch:
+    """
+    Messages of a topic log read by a FETCH request.
+
+    The ``size`` bytes of the open file ``fd`` from ``position`` on are the frames of
+    the ``count`` messages from ``offset`` on, without the status line of the first
+    one. ``end_offset`` is the offset the next message published will get.
+    """
+
+    __slots__ = ["fd", "position", "size", "offset", "count", "end_offset"]
+
+    def __init__(self, fd: Optional[int], position: int, size: int, offset: int, count: int, end_offset: int):
+        self.fd = fd
+        self.position = position
+        self.size = size
+        self.offset = offset
+        self.count = count
+        self.end_offset = end_offset
+
+    def __repr__(self):
+        return '<%s %d+%d>' % (self.__class__.__name__, self.offset, self.count)
+
+    @property
+    def next_offset(self) -> int:
+        return self.offset + self.count
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class _LogSegment:
+    """
+    Segment file of a topic log, and the positions of its frames.
+    """
+
+    __slots__ = ["base", "path", "fd", "positions", "size", "modified"]
+
+    def __init__(self, directory: str, base: int):
+        self.base = base
+        self.path = os.path.join(directory, "%020d%s" % (base, _SUFFIX))
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.positions = array("Q")
+        self.size = 0
+        self.modified = os.fstat(self.fd).st_mtime
+        self._scan()
+
+    def _scan(self):
+        """
+        Index the frames of the file, truncating it after the last complete one.
+        """
+        with open(self.path, "rb") as f:
+            position = 0
+            while True:
+                line = f.readline()
+                if not line.startswith(b"CMIT/") or f.readline() != b"\r\n":
+                    break
+                line = f.readline()
+                if len(line) < 3 or not line.endswith(b"\r\n"):
+                    break
+                self.positions.append(position)
+                position = f.tell()
+
+        self.size = position
+        if os.fstat(self.fd).st_size > position:
+            os.ftruncate(self.fd, position)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TopicLog:
+    """
+    Segmented log of the messages published to a topic, and the offsets committed by its consumer groups.
+    """
+
+    def __init__(self, directory: str, topic: str, segment_size: int = 64 << 20,
+                 retention_bytes: Optional[int] = None, retention_seconds: Optional[float] = None,
+                 fsync: bool = False):
+        self.directory = directory
+        self.topic = topic
+        self.segment_size = segment_size
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.fsync = fsync
+
+        self._lock = threading.Lock()
+        self._retention_checked = 0.0
+
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(directory)
+                       if name.endswith(_SUFFIX) and name[:-len(_SUFFIX)].isdigit())
+        self._segments = [_LogSegment(directory, base) for base in bases or [0]]
+        self._bases = [segment.base for segment in self._segments]
+
+        try:
+            with open(os.path.join(directory, _OFFSETS)) as f:
+                self._committed: Dict[str, int] = json.load(f)
+        except FileNotFoundError:
+            self._committed = {}
+
+        self.appended = 0
+        self.deleted = 0
+
+    def __repr__(self):
+        return '<%s %s [%d, %d)>' % (self.__class__.__name__, self.topic, self.start_offset, self.end_offset)
+
+    @property
+    def start_offset(self) -> int:
+        """
+        Offset of the oldest message retained.
+        """
+        return self._segments[0].base
+
+    @property
+    def end_offset(self) -> int:
+        """
+        Offset of the next message appended.
+        """
+        segment = self._segments[-1]
+        return segment.base + len(segment)
+
+    def append(self, payload="", msg_id=None) -> int:
+        """
+        Append a message to the log, return its offset.
+        """
+        now = time.time()
+        with self._lock:
+            offset = self.end_offset
+
+            msg = CMITMessage(self.topic, msg_id=msg_id or "%032x" % randbits(128))
+            msg.payload = payload
+            msg.more = True
+            msg.offset = offset
+            frame = _RECORD_HEAD + msg() + b"\r\n"
+
+            segment = self._segments[-1]
+            if segment.size and segment.size + len(frame) > self.segment_size:
+                segment = self._roll(offset)
+
+            written = 0
+            while written < len(frame):
+                written += os.write(segment.fd, frame[written:])
+            if self.fsync:
+                os.fsync(segment.fd)
+
+            segment.positions.append(segment.size)
+            segment.size += len(frame)
+            segment.modified = now
+            self.appended += 1
+
+            if now - self._retention_checked >= 1.0:
+                self._retain(now)
+            return offset
+
+    def _roll(self, base):
+        segment = _LogSegment(self.directory, base)
+        self._segments.append(segment)
+        self._bases.append(base)
+        return segment
+
+    def _retain(self, now):
+        """
+        Delete the oldest segments beyond the retention limits, never the last one.
+        """
+        self._retention_checked = now
+        size = sum(segment.size for segment in self._segments)
+
+        while len(self._segments) > 1:
+            segment = self._segments[0]
+            if not ((self.retention_bytes is not None and size > self.retention_bytes) or
+                    (self.retention_seconds is not None and segment.modified < now - self.retention_seconds)):
+                break
+
+            # FETCH responses still sending it hold a descriptor of their own
+            del self._segments[0], self._bases[0]
+            segment.close()
+            os.unlink(segment.path)
+            size -= segment.size
+            self.deleted += 1
+
+    def read(self, offset: Optional[int], max_bytes: int) -> LogBatch:
+        """
+        Return the batch of messages from ``offset`` on, up to ``max_bytes`` of frames but at least one message.
+
+        An offset no longer retained, or None, reads from the oldest message. The
+        batch ends with the segment of its first message, the caller must close it.
+        """
+        with self._lock:
+            end_offset = self.end_offset
+            if offset is None or offset < self.start_offset:
+                offset = self.start_offset
+            if offset >= end_offset:
+                return LogBatch(None, 0, 0, end_offset, 0, end_offset)
+
+            segment = self._segments[bisect_right(self._bases, offset) - 1]
+            first = offset - segment.base
+            start = segment.positions[first]
+
+            limit = start + max_bytes
+            if segment.size <= limit:
+                last = len(segment)
+            else:
+                last = max(bisect_right(segment.positions, limit, first) - 1, first + 1)
+            end = segment.positions[last] if last < len(segment) else segment.size
+
+            # A descriptor of its own, the segment may be deleted while the batch is sent
+            fd = os.open(segment.path, os.O_RDONLY)
+
+        head = len(_RECORD_HEAD)
+        return LogBatch(fd, start + head, end - start - head, offset, last - first, end_offset)
+
+    def commit(self, group: str, offset: int):
+        """
+        Record ``offset`` as the next one to be read by the consumers of ``group``.
+        """
+        with self._lock:
+            self._committed[group] = offset
+
+            path = os.path.join(self.directory, _OFFSETS)
+            with open(path + ".tmp", "w") as f:
+                json.dump(self._committed, f)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+
+    def committed(self, group: str) -> Optional[int]:
+        """
+        Return the offset committed by ``group``, None if it committed none.
+        """
+        with self._lock:
+            return self._committed.get(group)
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
+
+    def stats(self) -> dict:
+        """
+        Return the offsets, size and segments of the log, and the offsets committed.
+        """
+        with self._lock:
+            return {
+                "start_offset": self.start_offset,
+                "end_offset": self.end_offset,
+                "segments": len(self._segments),
+                "bytes": sum(segment.size for segment in self._segments),
+                "appended": self.appended,
+                "deleted_segments": self.deleted,
+                "committed": dict(self._committed),
+            }
+
+
+class TopicLogStore:
+    """
+    The topic logs of a directory, opened on first use.
+    """
+
+    log_class = TopicLog
+
+    def __init__(self, directory: str, segment_size: int = 64 << 20, retention_bytes: Optional[int] = None,
+                 retention_seconds: Optional[float] = None, fsync: bool = False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.fsync = fsync
+
+        self._lock = threading.Lock()
+        self._logs: Dict[str, TopicLog] = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+    def log(self, topic: str, create: bool = True) -> Optional[TopicLog]:
+        """
+        Return the log of ``topic``, None if it has none and ``create`` is False.
+
+        Raise ValueError if the topic can't name a log.
+        """
+        log = self._logs.get(topic)
+        if log is not None:
+            return log
+
+        if not _TOPIC_NAME.fullmatch(topic):
+            raise ValueError(f"Invalid log topic {topic!r}, expected dot separated words")
+
+        directory = os.path.join(self.directory, topic)
+        with self._lock:
+            log = self._logs.get(topic)
+            if log is None and (create or os.path.isdir(directory)):
+                log = self._logs[topic] = self.log_class(
+                    directory, topic, self.segment_size, self.retention_bytes, self.retention_seconds, self.fsync
+                )
+        return log
+
+    def append(self, topic: str, payload="", msg_id=None) -> int:
+        """
+        Append a message to the log of ``topic``, return its offset.
+        """
+        return self.log(topic).append(payload, msg_id)
+
+    def read(self, topic: str, offset: Optional[int], max_bytes: int, group: Optional[str] = None) -> LogBatch:
+        """
+        Return a batch of messages of the log of ``topic``, see :meth:`TopicLog.read`.
+
+        Without an offset, the one committed by ``group`` is read from.
+        """
+        log = self.log(topic, create=False)
+        if log is None:
+            return LogBatch(None, 0, 0, 0, 0, 0)
+
+        if offset is None and group is not None:
+            offset = log.committed(group)
+        return log.read(offset, max_bytes)
+
+    def commit(self, topic: str, group: str, offset: int):
+        """
+        Record the offset of the log of ``topic`` the consumers of ``group`` go on from.
+        """
+        self.log(topic).commit(group, offset)
+
+    def close(self):
+        with self._lock:
+            for log in self._logs.values():
+                log.close()
+            self._logs.clear()
+
+    def stats(self) -> dict:
+        """
+        Return the stats of every log opened, by topic.
+        """
+        with self._lock:
+            logs = list(self._logs.values())
+        return {log.topic: log.stats() for log in logs}
+
+
+class TopicLogMixIn:
+    """
+    Mix-in class giving a server a :class:`TopicLogStore`, where PUBLISH requests are appended.
+    """
+
+    topic_log_store_class = TopicLogStore
+
+    # Directory of the topic logs, None to disable them
+    topic_log_directory: Optional[str] = None
+
+    # Size a segment file grows to before a new one is started
+    topic_log_segment_size = 64 << 20
+
+    # Limits of the size of a log and of the age of its messages, None for no limit
+    topic_log_retention_bytes: Optional[int] = None
+    topic_log_retention_seconds: Optional[float] = None
+
+    # Whether appends and commits are written to disk before being acknowledged
+    topic_log_fsync = False
+
+    topic_logs = None
+
+    def get_topic_logs(self) -> Optional[TopicLogStore]:
+        """
+        Return the server's TopicLogStore, creating it on first use. None if topic logs are disabled.
+        """
+        if self.topic_log_directory is None:
+            return None
+
+        topic_logs = self.topic_logs
+        if topic_logs is None:
+            with _topic_logs_lock:
+                if self.topic_logs is None:
+                    self.topic_logs = self.topic_log_store_class(
+                        self.topic_log_directory, self.topic_log_segment_size, self.topic_log_retention_bytes,
+                        self.topic_log_retention_seconds, self.topic_log_fsync
+                    )
+                topic_logs = self.topic_logs
+        return topic_logs
+
+    def close_topic_logs(self):
+        """
+        Close the topic logs.
+        """
+        if self.topic_logs is not None:
+            self.topic_logs.close()
+            self.topic_logs = None
+
+    def server_close(self):
+        super().server_close()
+        self.close_topic_logs()
+
+
+_topic_logs_lock = threading.Lock()
+
+
+__all__ = ["LogBatch", "TopicLog", "TopicLogMixIn", "TopicLogStore"]
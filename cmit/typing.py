@@ -6,7 +6,7 @@ from typing import Callable, Union
 
 
 TopicType = Union[str, bytes, Callable[[], str]]
-PayloadType = Union[str, dict, bytes, Callable[[], str]]
+PayloadType = Union[str, dict, bytes, memoryview, Callable[[], str]]
 
 
 __all__ = ["PayloadType", "TopicType"]
@@ -2,7 +2,10 @@
 CMIT Server Utilities
 """
 import base64
+import inspect
+import logging
 import socket
+from collections.abc import AsyncIterator, Iterator
 from typing import Any, Callable
 
 
@@ -55,24 +58,62 @@ def log_command(func):
     return wrapper
 
 
+def send_message(ref, status, msg):
+    """
+    Send ``msg`` as the response of the request handled by ``ref``, with the given status.
+    """
+    advertise_window = getattr(ref, "advertise_window", None)
+    if advertise_window is not None:
+        advertise_window(msg)
+
+    msg = f"{base64.b64encode(bytes(msg)).decode()}\r\n"
+
+    ref.send_response(status)
+    ref.end_response_line()
+    ref.wfile.write(msg.encode())
+
+
 def cmit_response(func: Callable[[Any], list]):
+    """
+    Decorator turning a ``(status, msg)`` returning ``do_*`` method into a full CMIT response.
 
-    def wrapper(ref):
+    ``msg`` may also be an iterator (or async iterator) of chunks, e.g. a generator,
+    which are sent as a streamed response, see ``send_stream()`` of the handler.
+
+    Coroutine functions are wrapped in a coroutine so that they can be used with
+    :class:`cmit.aio.AsyncCMITRequestHandler`.
+    """
 
-        if hasattr(ref, "logger"):
+    def log(ref):
+        # Formatting the message decodes its payload, which may be large
+        if hasattr(ref, "logger") and ref.logger.isEnabledFor(logging.DEBUG):
             command = getattr(ref, "command") if hasattr(ref, "command") else "UNKNOWN"
             ref.logger.debug(f"Received {command.upper()} request: {str(ref.msg)}")
             ref.logger.debug(f"Msg Type: {type(ref.msg)}")
 
-        status, msg = func(ref)
+    if inspect.iscoroutinefunction(func):
 
-        msg = f"{base64.b64encode(bytes(msg)).decode()}\r\n"
+        async def async_wrapper(ref):
+            log(ref)
+            status, msg = await func(ref)
+            if isinstance(msg, (Iterator, AsyncIterator)):
+                result = ref.send_stream(status, msg)
+                if inspect.isawaitable(result):
+                    await result
+                return
+            send_message(ref, status, msg)
 
-        ref.send_response(status)
-        ref.end_response_line()
-        ref.wfile.write(msg.encode())
+        return async_wrapper
+
+    def wrapper(ref):
+        log(ref)
+        status, msg = func(ref)
+        if isinstance(msg, (Iterator, AsyncIterator)):
+            # Asynchronous handlers return a coroutine, awaited by their invoke_once()
+            return ref.send_stream(status, msg)
+        send_message(ref, status, msg)
 
     return wrapper
 
 
-__all__ = ["create_connection", "encode", "log_command", "cmit_response"]
+__all__ = ["create_connection", "encode", "log_command", "send_message", "cmit_response"]
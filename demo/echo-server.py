@@ -1,51 +1,104 @@
 import logging
 import socketserver
+import threading
 
 from cmit import messages, server, utils, CMITStatus
+from cmit.journal import JournalMixIn
+from cmit.scheduling import PriorityTaskQueue
 
 logging.basicConfig(filename="/var/log/cmit/echo-server.log", level=logging.DEBUG)
 
 SOCKET_FILE = "/src/echo.sock"
 
+# Accepted tasks are journaled there, and queued again when the server restarts
+JOURNAL_DIR = "/src/echo-journal"
+
 common_logger = logging.getLogger()
 
 
-class UNIXServer(server.CMITServer):
+class UNIXServer(JournalMixIn, server.CMITServer):
     request_queue_size = 10
     task_router = {}
+    task_router_lock = threading.Lock()
     logger = common_logger
+    journal_directory = JOURNAL_DIR
+
+    def get_task_queue(self, route) -> PriorityTaskQueue:
+        """
+        Return the task queue of ``route``, creating it and starting its worker on first use.
+        """
+        with self.task_router_lock:
+            if route not in self.task_router:
+                self.task_router[route] = PriorityTaskQueue()
+                threading.Thread(target=self.process_tasks, args=(route, self.task_router[route]),
+                                 name=f"tasks-{route}", daemon=True).start()
+            return self.task_router[route]
+
+    def process_tasks(self, route, task_queue):
+        """
+        Process the tasks of ``route`` one after the other, completing them in the journal once done.
+        """
+        while True:
+            task = task_queue.get()
+            self.logger.debug(f"Processing task: {task['task_id']} - {route}")
+            # An echo server has nothing to do, the task is done
+            self.complete_task(task)
+
+    def complete_task(self, task):
+        """
+        Record that a task is done, so it isn't queued again after a restart.
+        """
+        journal = self.get_journal()
+        if journal is not None:
+            journal.complete(task["task_id"])
+
+    def restore_tasks(self):
+        """
+        Queue the tasks of the journal again, those accepted and not completed before a restart.
+        """
+        journal = self.get_journal()
+        for task_id, task in journal.pending():
+            self.logger.debug(f"Restoring task: {task_id} - {task['route']}")
+            try:
+                self.get_task_queue(task["route"]).put(task, task["route"], task.get("priority"))
+            except (TypeError, ValueError) as e:
+                self.logger.warning(f"Dropping task {task_id} from the journal: {e}")
+                journal.complete(task_id)
 
 
 class TaskHandler(server.SimpleCMITRequestHandler):
     server: UNIXServer
     logger = common_logger
 
-    def get_task_queue(self, que_name) -> list:
+    def get_task_queue(self, que_name) -> PriorityTaskQueue:
 
         self.logger.debug(f"Retrieving job queue for {que_name}")
 
-        # check if the task_router has been created
-        if not hasattr(self.server, 'task_router'):
-            setattr(self.server, 'task_router', {})
-
-        if que_name not in self.server.task_router:
-            self.server.task_router[que_name] = []
-
-        return self.server.task_router[que_name]
+        return self.server.get_task_queue(que_name)
 
-    def register_task(self, task_route, task_id, task_args=None, task_kwargs=None, task_data=None):
+    def register_task(self, task_route, task_id, task_args=None, task_kwargs=None, task_data=None, priority=None):
 
         self.logger.debug(f"Registering task: {task_id} - {task_route}")
 
+        # Classify the task first: one that can't be queued must not be journaled either
+        task_queue = self.get_task_queue(task_route)
+        priority = task_queue.classify(task_route, priority)
+
         new_task = {
             "route": task_route,
             "task_id": task_id,
             "args": task_args,
             "kwargs": task_kwargs,
-            "data": task_data
+            "data": task_data,
+            "priority": priority
         }
 
-        self.get_task_queue(task_route).append(new_task)
+        # Journal the task before it's acknowledged, so it survives a restart
+        journal = self.server.get_journal()
+        if journal is not None:
+            journal.append(task_id, new_task)
+
+        task_queue.put(new_task, task_route, priority)
 
     @utils.cmit_response
     def do_EXECUTE(self):
@@ -53,10 +106,15 @@ class TaskHandler(server.SimpleCMITRequestHandler):
         Handle the EXECUTE command.
         """
 
-        # Add job to inbox
-        self.register_task(self.msg.topic, self.msg.msg_id)
-
         msg = messages.CMITMessage(self.msg.topic, self.msg.msg_id)
+
+        # Add job to inbox, in the priority class requested by the client
+        try:
+            self.register_task(self.msg.topic, self.msg.msg_id, priority=self.msg.priority)
+        except ValueError as e:
+            msg.payload = {"error": str(e)}
+            return CMITStatus.BAD_REQUEST, msg
+
         msg.payload = {"res": "Processed"}
 
         return CMITStatus.ACCEPTED, msg
@@ -65,12 +123,19 @@ class TaskHandler(server.SimpleCMITRequestHandler):
     def do_POLL(self):
         """
         Handle the POLL command
+
+        A long POLL waits for the depth of the queue to differ from the last one seen by the client.
         """
 
-        length = len(self.get_task_queue(self.msg.topic))
+        task_queue = self.get_task_queue(self.msg.topic)
+        wait = self.poll_wait()
+        if wait:
+            task_queue.wait_depth(self.request_arguments().get("last"), wait)
+
+        depths = task_queue.depths()
 
         msg = messages.CMITMessage(self.msg.topic, self.msg.msg_id)
-        msg.payload = {"depth": length}
+        msg.payload = {"depth": sum(depths.values()), "priorities": depths}
 
         return CMITStatus.OK, msg
 
@@ -89,6 +154,8 @@ def run(address, threading=False, on_bind=None, server_cls=UNIXServer):
     else:
         unixd_cls = server_cls
     unixd = unixd_cls(address, TaskHandler, bind_and_activate=True)
+    if unixd.journal_directory is not None:
+        unixd.restore_tasks()
     if on_bind:
         on_bind(getattr(unixd, "server_address", address))
 